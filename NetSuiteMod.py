@@ -4,38 +4,53 @@
 # The module is organized into 7 method classes - Set up, Data pull, Output, Fix up, Computation
 
 #1) Set up - Import modules, grab cursor, set default dictionary
-    # getNetsuiteCursor - Gets the cursor to traverse the Net Suite tables using configurations in fdb.ini file in setting directory
+    # getNetsuiteCursor - Gets the cursor to traverse the Net Suite tables using configurations in fdb.ini file in setting directory (fdbPool.NetsuiteConnectionPool hands out pooled cursors for concurrent pulls)
+    # fetchRows - Streams the rows of the last executed query in fetchmany batches so result sets are never held in memory whole
+    # filteredQuery - Pushes the row filters in queryFilters into a query's WHERE clause
+    # queryRows - Executes a query and streams its rows, through the fdbCache on-disk result cache when it is enabled
+    # queryColumns - Executes a query and streams its result in column batches (NumPy buffers where the driver provides them)
+    # executeQuery - Executes a query, timing it for the fdbQueryLog query log (execute latency, time to first row, rows, bytes and throughput per query)
+    # runChunkedPull - Reads a transaction pull in resumable transaction_id ranges, in parallel over the connection pool
 
 #2) Data Pull - Pull indices & data from Net Suite tables and return in dictionaries
+    # getIDMappingFile - Pulls the account family mappings (from the fdbMappingStore mapping store, importing new dated mapping files into it, when one is given)
+    # getEntityOverrideFile - Pulls the entity overrides (likewise from the mapping store when one is given)
     # readRevenueInput - Temporary method to pull *.csv file of revenue pulled from NS.  Ideally want to pull directly from tables in the future.
     # getCurrencyIndex - Pulls currency symbols by currency code
-    # getExchangeRateIndex - Pulls exchange rate by currency and date
+    # getExchangeRateIndex - Pulls exchange rates by currency into an as-of index (rate in effect on any date, crossed through USD where needed)
     # getNetsuiteVerticalIndex - Pulls vertical name by NS identifier
     # getNetsuiteItemsIndex - Pulls product name by NS identifier
     # getNetsuiteCustomerIndex - Pulls customer level information by NS identifier
     # getNetsuiteContractsIndex - Pulls contract information by NS identifier
-    # getNetsuitePaymentEntries - Grabs NS payment entries by NS client identifier and month
-    # getNetsuiteRevenueEntries - THIS METHOD DOES NOT CURRENTLY WORK.  Ideally should pull revenue from underlying tables.  Will replace readRevenueInput method when this works.
-    # getNetsuiteBillingsEntries - Pulls net billing by NS ids
+    # getNetsuitePaymentEntries - Grabs NS payment entries by NS client identifier and month (optionally as a delta against the fdbState store, or chunked by transaction id range)
+    # getNetsuiteRevenueEntries - Pulls revenue by client, item and month from the revenue account posting lines (optionally as a delta against the fdbState store, or chunked by transaction id range).  Replaces the readRevenueInput export.
+    # getNetsuiteBillingsEntries - Pulls net billing by NS ids (optionally as a delta against the fdbState store, or chunked by transaction id range)
+    # getNetsuiteARTransactionEntries - Pulls payment and billing entries together in one pass over the Accounts Receivable transaction lines (optionally summed in NumPy column batches)
 
 #3) Prepare legacy data from PowerReviews
     # prepLegacyBible - Prepares the client by client revenue & billing file such that it can be consolidated with the NetSuite extract
+    # getExpressRevenue - Converts the Express file rows into revenue entries for the current client flags
+    # readLegacyFiles - Reads the Bible and Express files in one pass each into the legacy revenue, billing, client and Express revenue lists
 
 #4) Combine NetSuite and Legacy information
-    # combineCustomerIndicies - combines the customer tables, and produces data to populate the dim_client table
+    # combineCustomerIndicies - combines the customer tables, and produces data to populate the dim_client table (new clients get AFIDs in NSID order, from the mapping store's counters when one is given)
 
 #5) Fix up - Update data dictionaries based on desired criteria
     # fixupContractTypes - This updated the contracts dictionary to indicate whether the contract reflects and Uptick or Downtick
     # fixupCustomerFirstBookingsAndCohorts - Sets client go live date, cohort, and old never live flag
 
 #6) Computation - Computes desired values based on raw data from Net Suite
-    # getMonthlyCumulativeASFEntries - Gathers cumulative ASF entries by client and month
+    # getMonthlyCumulativeASFEntries - Gathers cumulative ASF entries by client and month (every month, only the changes, or valid from / valid to spans - see fdbBookingSpans)
+    # getClientBookings - Cumulative ASF by client and product as of a month, from the contract timeline
     # getMonthlyIncrementalASFEntries - Gathers incremental ASF entries by client and month
+    # getRevenueSeriesIndex - Builds the monthly revenue series of every top client (fdbRevenueSeries), shared by the stages that scan revenue month by month
     # computeClientGoLiveDates - Computes the go live date for a give client base on go live criteria
     # computeFirstBookings - Computes the first booking date by top client & product
+    # getContractTimeline - Sorts and groups the contracts once (fdbContractTimeline) for the bookings computations
 
 #7) Output - Output *.CSV files in desired format
     # outputCumulativeBookings
+    # outputCumulativeBookingSpans
     # outputIncrementalBookings
     # outputCustomers
     # outputProducts
@@ -46,16 +61,27 @@
 ''''''''''''''''''''''''''''''
 
 ''''''''''''''' Set up '''''''''''''''
-import ConfigParser
 from collections import defaultdict
-from win32com.client import DispatchEx
 from datetime import datetime
 import os
-import operator
 import csv
 import glob
-import pyodbc
+import itertools
 import time
+import fdbBookingSpans
+import fdbCache
+import fdbColumnar
+import fdbContractTimeline
+import fdbCurrentClients
+import fdbInputCache
+import fdbMappingStore
+import fdbPool
+import fdbQueryLog
+import fdbRates
+import fdbRevenueInput
+import fdbRevenueSeries
+import fdbState
+import fdbXlsx
 from fdbMappings import *
 from fdbUtils import *
 from excel_constants import *
@@ -96,27 +122,221 @@ connectionsOnlyProducts = (
     357
 )
 
+# Output file of the cumulative bookings in each mode of getMonthlyCumulativeASFEntries
+cumulativeBookingsFiles = {
+    'dense': "fact_bookings.csv",
+    'changes': "fact_bookings_changes.csv",
+    'spans': "fact_bookings_spans.csv"
+}
+
 # Get the Net Suite cursor - This is used to traverse the tables in Net Suite.  It is a parameter for pretty much all of the functions in this module.
+# For the full extract use fdbPool.NetsuiteConnectionPool instead, which runs the pulls concurrently over several connections.
 def getNetsuiteCursor():
-    parser = ConfigParser.RawConfigParser()
-    parser.read("../settings/fdb.ini")
-    cnxn = pyodbc.connect(parser.get('Netsuite', 'connection_string'))
+    cnxn = fdbPool.getNetsuiteConnection()
     return cnxn.cursor()
 
-# This method pulls in the account family id mapping file and puts it into a dictionary.  It also captures the max account family id so that new entries can be added sequentially.
-def getIDMappingFile():
-    mappingFileList = glob.glob(r'C:\Projects\fdb\accountFamilyMapping\*.csv')
+# Streams the result set of the last statement executed on the cursor.  Rows are pulled with fetchmany so the data pulls can aggregate as rows arrive instead of holding the whole result set next to the dictionaries built from it.
+# The batch size starts at batchSize (fetchBatchSize by default) and, when adaptive, doubles or halves between fetchMinBatchSize and fetchMaxBatchSize to keep each round trip close to fetchTargetSeconds.
+fetchBatchSize = 5000
+fetchMinBatchSize = 500
+fetchMaxBatchSize = 100000
+fetchTargetSeconds = 0.5
+
+# stats (the fdbQueryLog.QueryStats returned by executeQuery) records each batch and is finished when the rows run out or the caller stops reading.
+def fetchRows(cursor, batchSize=None, adaptive=True, stats=None):
+    if not batchSize:
+        batchSize = fetchBatchSize
+    try:
+        while True:
+            start = time.time()
+            rows = cursor.fetchmany(batchSize)
+            if not rows:
+                break
+            elapsed = time.time() - start
+            if stats:
+                stats.fetched(len(rows), elapsed, rows[0])
+            for row in rows:
+                yield row
+            if adaptive:
+                if elapsed < fetchTargetSeconds/2 and batchSize < fetchMaxBatchSize:
+                    batchSize = min(batchSize*2, fetchMaxBatchSize)
+                elif elapsed > fetchTargetSeconds*2 and batchSize > fetchMinBatchSize:
+                    batchSize = max(batchSize/2, fetchMinBatchSize)
+    finally:
+        if stats:
+            stats.finish()
+
+# Row filters pushed into the WHERE clause of the Net Suite queries, keyed by query.  Rows these drop are never transferred or converted.
+# Null handling mirrors the Python filters they replaced (e.g. a contract with no renewal flag is kept, one with no MSF is dropped).
+queryFilters = {
+    'Contract': [
+        "(renewal_contract IS NULL OR renewal_contract <> 'T')", # Skip renewal contracts
+        "msf_booking <> 0",                                      # Skip contracts with zero or no MSF
+        "effective_date IS NOT NULL"                             # Skip contracts with no effective date
+    ],
+    'implementations': [
+        "(implementation_phase.list_item_name IS NULL OR implementation_phase.list_item_name NOT IN ('Completed', 'Cancelled', 'Not Implemented - Retired'))"
+    ]
+}
+
+# Appends the filters in queryFilters[filterName] to the query's WHERE clause
+def filteredQuery(query, filterName):
+    filters = queryFilters.get(filterName)
+    if not filters:
+        return query
+    if " WHERE " in query.upper():
+        return query + " AND " + " AND ".join(filters)
+    return query + " WHERE " + " AND ".join(filters)
+
+# Fingerprint queries for the on-disk result cache (see fdbCache), keyed by table.  A cached result is only reused while the fingerprint of the table it was read from is unchanged.
+# Tables with a last_modified_date include its maximum, so edited rows expire their entries.  Currencies, Vertical, Items and billing_cycle have none: their entries only expire when rows are added or removed,
+# so a renamed currency, vertical, item or billing frequency keeps being served from the cache.  After renaming one, run without the query cache or clear it (fdbCache.clearCache).
+cacheFingerprints = {
+    'Currencies': "SELECT COUNT(*), MAX(currency_id) FROM Currencies",
+    'CurrencyRates': "SELECT COUNT(*), MAX(DATE_EFFECTIVE) FROM CurrencyRates",
+    'Vertical': "SELECT COUNT(*), MAX(list_id) FROM Vertical",
+    'Items': "SELECT COUNT(*), MAX(item_id) FROM Items",
+    'Customers': "SELECT COUNT(*), MAX(customer_id), MAX(last_modified_date) FROM Customers",
+    'Contract': "SELECT COUNT(*), MAX(contract_id), MAX(last_modified_date) FROM Contract",
+    'transactions': "SELECT COUNT(*), MAX(transaction_id), MAX(last_modified_date) FROM transactions",
+    'billing_cycle': "SELECT COUNT(*), MAX(list_id) FROM billing_cycle",
+    'implementations': "SELECT COUNT(*), MAX(last_modified_date) FROM implementations"
+}
 
-    # Grab the most recent mapping file based on the date prefix
+# Executes a query and streams its rows.  If cacheTable names a fingerprint in cacheFingerprints and fdbCache.cacheEnabled is set, the rows come from the on-disk cache while that fingerprint is unchanged.
+def queryRows(cursor, query, params=None, cacheTable=None):
+    if cacheTable and fdbCache.cacheEnabled:
+        fingerprint = fdbCache.getFingerprint(cursor, cacheFingerprints[cacheTable])
+        stats = fdbQueryLog.QueryStats(query, params, source="cache")
+        rows = fdbCache.loadRows(query, params, fingerprint)
+        if rows is not None:
+            stats.executed()
+            return fdbQueryLog.trackRows(stats, rows)
+        stats = executeQuery(cursor, query, params)
+        return fdbCache.storeRows(query, params, fingerprint, len(cursor.description), fetchRows(cursor, stats=stats))
+    stats = executeQuery(cursor, query, params)
+    return fetchRows(cursor, stats=stats)
+
+# Executes a query and streams its result as batches of columns for the columnar sums (see fdbColumnar) - typed NumPy buffers from drivers that fill them, otherwise the columns of each fetchmany batch
+def queryColumns(cursor, query, params=None, cacheTable=None):
+    if cacheTable and fdbCache.cacheEnabled:
+        return fdbColumnar.columnBatches(queryRows(cursor, query, params, cacheTable))
+    stats = executeQuery(cursor, query, params)
+    return fdbQueryLog.trackBatches(stats, fdbColumnar.fetchColumnBatches(cursor))
+
+# Executes a query and returns the fdbQueryLog.QueryStats timing it, with the execute latency recorded.  Whoever reads the result records the fetches and finishes the stats (fetchRows does both).
+def executeQuery(cursor, query, params=None):
+    stats = fdbQueryLog.QueryStats(query, params)
+    if params:
+        cursor.execute(query, params)
+    else:
+        cursor.execute(query)
+    stats.executed()
+    return stats
+
+# Opens the local state store for an incremental pull and returns [store, lastModified watermark].
+# A full refresh clears what is stored for the table first (unless a chunked read of it is part way through, which is resumed instead); with no watermark the caller reads the whole table.
+def startDeltaPull(tableName, fullRefresh):
+    store = fdbState.openStateStore()
+    if fullRefresh and not fdbState.hasChunkPlan(store, tableName):
+        fdbState.resetTable(store, tableName)
+    lastModified = fdbState.getWatermark(store, tableName)
+    return [store, lastModified]
+
+# Transaction ids per chunk in chunked reads (see runChunkedPull)
+transactionChunkSize = 50000
+
+''' Reads a transaction pull in transaction_id ranges into the fdbState store, so a dropped connection only costs the chunk in flight.
+query is the pull's SQL with rows per transaction, groupBy its GROUP BY clause and scope the condition on transactions that picks the pull's transactions, used to plan the ranges.
+A pull can feed several stored tables: sumRows(rows) turns one chunk's rows into a list of contributions {(transactionID, clientID, month, ...): amount}, one per name in tableNames.
+fetch(cursor, query, params) runs each chunk's query (queryRows, or queryColumns for sums that take column batches).
+Chunks are read on the cursor and, if pool is given, concurrently on its idle connections.  Each chunk is recorded as it completes; if the read fails the next one resumes from the unfinished chunks.
+Returns the list of the tables' totals (see fdbState.getTotals, keyLengths gives each table's key length) once every chunk is in. '''
+def runChunkedPull(cursor, pool, tableNames, query, groupBy, scope, sumRows, keyLengths, fetch=queryRows):
+    store = fdbState.openStateStore()
+    if not [tableName for tableName in tableNames if not fdbState.hasChunkPlan(store, tableName)]:
+        chunks = sorted(set([tuple(chunk) for tableName in tableNames for chunk in fdbState.getUnfinishedChunks(store, tableName)]))
+        print "resuming " + str(len(chunks)) + " unfinished chunks...",
+    else:
+        stats = executeQuery(cursor, "SELECT MIN(transaction_id), MAX(transaction_id), MAX(last_modified_date) FROM transactions WHERE " + scope)
+        lowID, highID, lastModified = fdbQueryLog.fetchOne(cursor, stats)
+        for tableName in tableNames:
+            chunks = fdbState.planChunks(store, tableName, lowID, highID, lastModified, transactionChunkSize)
+    store.close()
+
+    def pullChunk(chunkCursor, chunk):
+        contributions = sumRows(fetch(chunkCursor, query + " AND transactions.transaction_id BETWEEN ? AND ?" + groupBy, tuple(chunk)))
+        chunkStore = fdbState.openStateStore()
+        for (tableName, tableContributions) in zip(tableNames, contributions):
+            fdbState.completeChunk(chunkStore, tableName, chunk, tableContributions)
+        chunkStore.close()
+    fdbPool.runChunks(pool, cursor, chunks, pullChunk)
+
+    store = fdbState.openStateStore()
+    totals = []
+    for (tableName, keyLength) in zip(tableNames, keyLengths):
+        fdbState.finishChunks(store, tableName)
+        totals.append(fdbState.getTotals(store, tableName, keyLength))
+    store.close()
+    return totals
+
+# Moves the watermark forward to cover a pulled row
+def advanceWatermark(lastModified, rowModified):
+    if rowModified and (not lastModified or rowModified > lastModified):
+        lastModified = rowModified
+    return lastModified
+
+# Returns [changedTransactionIDs, lastModified]: the ids of every transaction modified since the lastModified watermark, whatever its lines, and the watermark advanced over them.
+# A delta pull's rows only cover the changed transactions whose lines still match the pull; replacing the contributions of all of them drops those whose lines no longer do (see fdbState.mergeContributions).
+# Read before the pull's rows, so a transaction modified in between is in the rows as well.
+def getChangedTransactions(cursor, lastModified):
+    changedTransactionIDs = set()
+    for row in queryRows(cursor, "SELECT transactions.transaction_id, transactions.last_modified_date FROM transactions WHERE transactions.last_modified_date >= ?", (lastModified,)):
+        changedTransactionIDs.add(int(row[0]))
+        lastModified = advanceWatermark(lastModified, row[1])
+    return [changedTransactionIDs, lastModified]
+
+# Reconciles a delta pull's stored contributions against Net Suite: drops those of transactions no longer there (deleted), keeping the transactions scope picks (see fdbState.keepTransactions)
+def reconcileDeltaPull(cursor, store, tableName, scope):
+    transactionIDs = [int(row[0]) for row in queryRows(cursor, "SELECT transactions.transaction_id FROM transactions WHERE " + scope)]
+    dropped = fdbState.keepTransactions(store, tableName, transactionIDs)
+    if dropped:
+        print "dropped " + str(dropped) + " deleted " + tableName + " transactions...",
+
+# Default folders of the dated account family mapping and entity override files
+accountFamilyMappingFolder = r'C:\Projects\fdb\accountFamilyMapping'
+entityOverridesFolder = r'C:\Projects\fdb\entityOverridesFolder'
+
+# Returns the most recent of the folder's yyyy.mm.dd_*.csv files based on the date prefix ('No file found' if there are none).  Files without a date prefix are skipped.
+def getMostRecentDatedFile(folder):
     min_date = datetime(1990,1,1)
     mostRecentFile = 'No file found'
-    for file in mappingFileList:
-        temp = file[file.rfind('\\')+1:file.rfind('_')]
-        date = datetime(int(temp[0:temp.find(".")]),int(temp[temp.find(".")+1:temp.rfind(".")]),int(temp[temp.rfind(".")+1:]))
+    for file in glob.glob(os.path.join(folder, '*.csv')):
+        name = os.path.basename(file)
+        temp = name[0:name.rfind('_')]
+        try:
+            date = datetime(int(temp[0:temp.find(".")]),int(temp[temp.find(".")+1:temp.rfind(".")]),int(temp[temp.rfind(".")+1:]))
+        except ValueError:
+            continue
         if date > min_date:
             min_date = date
             mostRecentFile = file
+    return mostRecentFile
 
+# This method pulls in the account family id mapping file and puts it into a dictionary.  It also captures the max account family id so that new entries can be added sequentially.
+# With a mapping store (see fdbMappingStore) the mappings come from the store instead: the most recent dated file and the working mapping file are imported into it first if their contents are new, and the maxima are the store's AFID counters.
+def getIDMappingFile(folder=accountFamilyMappingFolder, mappingStore=None):
+    mostRecentFile = getMostRecentDatedFile(folder)
+    if mappingStore is None:
+        return fdbInputCache.cachedInput('idMapping', [mostRecentFile], lambda: parseIDMappingFile(mostRecentFile))
+
+    for filename in [mostRecentFile, os.path.join(folder, fdbMappingStore.workingMappingFilename)]:
+        if os.path.exists(filename) and not fdbMappingStore.isImported(mappingStore, "mapping", filename):
+            mappingDict, maxAFIDBV, maxAFIDPR = parseIDMappingFile(filename)
+            fdbMappingStore.importMappings(mappingStore, mappingDict, maxAFIDBV, maxAFIDPR, filename)
+    return fdbMappingStore.getMappings(mappingStore)
+
+def parseIDMappingFile(mostRecentFile):
     #Import file
     csvReader = csv.reader(open(mostRecentFile,'rb'), delimiter=',', quotechar='"')
     mappingDict = defaultdict(dict)
@@ -156,19 +376,17 @@ def getIDMappingFile():
     return [mappingDict,maxAFIDBV,maxAFIDPR]
 
 # This method pulls entity override file. This is to facilitate the breakout of Connections-only and Enterprise clients while they are still building out the seperate revenue account structure in NetSuite
-def getEntityOverrideFile():
-    mappingFileList = glob.glob(r'C:\Projects\fdb\entityOverridesFolder\*.csv')
+# With a mapping store the overrides come from the store, after importing the most recent file into it if its contents are new.
+def getEntityOverrideFile(folder=entityOverridesFolder, mappingStore=None):
+    mostRecentFile = getMostRecentDatedFile(folder)
+    if mappingStore is None:
+        return fdbInputCache.cachedInput('entityOverrides', [mostRecentFile], lambda: parseEntityOverrideFile(mostRecentFile))
 
-    # Grab the most recent mapping file based on the date prefix
-    min_date = datetime(1990,1,1)
-    mostRecentFile = 'No file found'
-    for file in mappingFileList:
-        temp = file[file.rfind('\\')+1:file.rfind('_')]
-        date = datetime(int(temp[0:temp.find(".")]),int(temp[temp.find(".")+1:temp.rfind(".")]),int(temp[temp.rfind(".")+1:]))
-        if date > min_date:
-            min_date = date
-            mostRecentFile = file
+    if os.path.exists(mostRecentFile) and not fdbMappingStore.isImported(mappingStore, "override", mostRecentFile):
+        fdbMappingStore.importOverrides(mappingStore, parseEntityOverrideFile(mostRecentFile), mostRecentFile)
+    return fdbMappingStore.getOverrides(mappingStore)
 
+def parseEntityOverrideFile(mostRecentFile):
     #Import file
     csvReader = csv.reader(open(mostRecentFile,'rb'), delimiter=',', quotechar='"')
     entityOverrideDict = defaultdict(dict)
@@ -188,24 +406,59 @@ def getEntityOverrideFile():
 
     return entityOverrideDict
 
-''' This function pulls the manual overrides data from the specified file location '''
-def grabOverrides(filename):
+''' This function pulls the manual overrides data from the specified file location.
+The workbook is read in Python (fdbXlsx), so no Excel is needed; useExcel=True reads it through an Excel instance over COM instead (Windows only). '''
+def grabOverrides(filename, useExcel=False):
+    if useExcel:
+        clientDateData, clientData = readOverrideSheetsWithExcel(filename)
+    else:
+        clientDateData, clientData = readOverrideSheets(filename)
+    return parseOverrideSheets(clientDateData, clientData, filename)
+
+# Reads the cells of the override_by_client_date and override_by_client sheets (from A1 to the ends of the filled runs along row 1 and down column A; the first two columns of override_by_client)
+def readOverrideSheets(filename):
+    workbook = fdbXlsx.XlsxWorkbook(filename)
+    try:
+        return [workbook.readTable("override_by_client_date"), workbook.readTable("override_by_client", 2)]
+    finally:
+        workbook.close()
+
+# Reads the same cells as readOverrideSheets through an Excel instance
+def readOverrideSheetsWithExcel(filename):
 
     # Set up excel application
+    from win32com.client import DispatchEx
     xlapp = DispatchEx("Excel.Application")
     xlapp.DisplayAlerts = False
     wb = xlapp.Workbooks.Open(filename)
 
-    ''' Grab the overrides for specific client/date combinations '''
     ws = wb.Worksheets("override_by_client_date")
     ws.Activate
-
-    # Select data in excel file
-    assert ws.Cells(1,1).Value == "AFID"       # Ensure data is in expected structure
-    assert ws.Cells(1,2).Value == "Parent Name"
     lastFilledCol = ws.Range("A1").End(xlToRight).Column
     lastFilledRow = ws.Range("A1").End(xlDown).Row
-    data = ws.Range(ws.Cells(1,1),ws.Cells(lastFilledRow,lastFilledCol)).Value
+    clientDateData = ws.Range(ws.Cells(1,1),ws.Cells(lastFilledRow,lastFilledCol)).Value
+
+    ws =wb.Worksheets("override_by_client")
+    ws.Activate
+    lastFilledRow = ws.Range("A1").End(xlDown).Row
+    clientData = ws.Range(ws.Cells(1,1),ws.Cells(lastFilledRow,2)).Value
+
+    # Close the excel application
+    wb.Close()
+    xlapp.DisplayAlerts = True
+    xlapp.Quit()
+
+    return [clientDateData, clientData]
+
+# Checks the override sheets' cells and returns [overrideDict, entitiesToExclude]
+def parseOverrideSheets(clientDateData, clientData, filename):
+
+    ''' Grab the overrides for specific client/date combinations '''
+    data = clientDateData
+    assert data[0][0] == "AFID"       # Ensure data is in expected structure
+    assert data[0][1] == "Parent Name"
+    lastFilledRow = len(data)
+    lastFilledCol = len(data[0])
 
     # Create dictionary from data 
     uniqueClientSet = set([])   # Set is used to ensure clients in spreadsheet are unique.  Throw error if not.
@@ -246,14 +499,10 @@ def grabOverrides(filename):
         ''' End - "Grab the overrides for specific client/date combinations" '''   
 
     ''' Grab the overrides by client '''
-    ws =wb.Worksheets("override_by_client")
-    ws.Activate
-
-    # Select data in excel file
-    assert ws.Cells(1,1).Value == "NSID"       # Ensure data is in expected structure
-    assert ws.Cells(1,2).Value == "Client name"
-    lastFilledRow = ws.Range("A1").End(xlDown).Row
-    data = ws.Range(ws.Cells(1,1),ws.Cells(lastFilledRow,1)).Value
+    data = clientData
+    assert data[0][0] == "NSID"       # Ensure data is in expected structure
+    assert data[0][1] == "Client name"
+    lastFilledRow = len(data)
 
     # Create a list of the entities to exclude
     entitiesToExclude = []      
@@ -265,33 +514,20 @@ def grabOverrides(filename):
             entitiesToExclude.append(str(int(data[row][0])))
     ''' End - "Grab the overrides by client '''
 
-    # Close the excel application
-    wb.Close()
-    xlapp.DisplayAlerts = True
-    xlapp.Quit()
-
     return [overrideDict, entitiesToExclude]
 
 ''''''''''''''' Data pull methods '''''''''''''''
 # Read csv file of revenue (not reading directly from Netsuite yet, due to no documented way of pulling revenue directly).
-# File is lines of Date (yyyymmdd), ProductID, ClientID, Recurring (0 or 1), Revenue
-def readRevenueInput(filename):
-    csvReader = csv.reader(open(filename, "rb"), delimiter=",", quoting=csv.QUOTE_NONE)
-    entries = []
-    for row in [row for row in csvReader][1:]: # Throw away first row (header row)
-        time = datetime.strptime(row[0], "%Y%m%d")
-        month = date(time.year, time.month, time.day)
-        entry = {"month": month,
-                 "itemID": int(row[1]),
-                 "clientID": str(int(row[2])),
-                 "recurring": int(row[3]),
-                 "amount": float(row[4]),
-                 "entity": "BV"
-                 }
-        entries.append(entry)
-    return entries
+# File is lines of Date (yyyymmdd), ProductID, ClientID, Recurring (0 or 1), Revenue.  It is parsed by fdbRevenueInput, by column and in a process pool for large files
+# (which also offers the rows as a generator, iterRevenueEntries, or as columns, readRevenueColumns), and kept compiled in the fdbInputCache while the file is unchanged.
+def readRevenueInput(filename, processes=None):
+    return fdbInputCache.cachedInput('revenueInput', [filename], lambda: fdbRevenueInput.compileColumns(fdbRevenueInput.readRevenueColumns(filename, processes)), fdbRevenueInput.compiledEntries)
 
+# The readers of the flat-file inputs below keep what they read in the fdbInputCache, so unchanged files are not parsed again
 def readLegacyBible(filename):
+    return fdbInputCache.cachedInput('legacyBible', [filename], lambda: parseLegacyBible(filename))
+
+def parseLegacyBible(filename):
     # Prep orig data
     csvReader = csv.reader(open(filename, "rb"), delimiter=",", quoting=csv.QUOTE_NONE)
     entries = []
@@ -320,6 +556,9 @@ def readLegacyBible(filename):
 
 
 def readExpressFile(filename):
+    return fdbInputCache.cachedInput('expressFile', [filename], lambda: parseExpressFile(filename))
+
+def parseExpressFile(filename):
     # Prep orig data
     csvReader = csv.reader(open(filename, "rb"), delimiter=",", quoting=csv.QUOTE_NONE)
     entries = []
@@ -386,6 +625,21 @@ def getLegacyBibleClients(legacy_bible):
     return customersByID
 
 
+# Express rows as readExpressFile gives them, as revenue entries (the expressRevenue of readLegacyFiles) for identifyCurrentClientsThroughTime
+def getExpressRevenue(data):
+    entries = []
+    for row in data:
+        entry = {"month": row["month"],
+                 "itemID": -1,
+                 "clientID": row["clientId"],
+                 "recurring": 1,
+                 "amount": row["amount"],
+                 "entity":"EX"
+                 }
+        entries.append(entry)
+
+    return entries
+
 def getExpressClients(data):
     customersByID = defaultdict(dict)
     for entry in data:
@@ -393,33 +647,68 @@ def getExpressClients(data):
         
     return customersByID
 
+# Month column positions of the legacy files: Bible columns 26-37 and Express columns 102-113, each headed yyyymm
+legacyBibleMonthColumns = range(26,38)
+expressMonthColumns = range(102,114)
+
+# Month (first of the month) of each month column, parsed once from the header row
+def legacyMonthHeaders(headers, columns):
+    return [date(int(headers[i][0:4]), int(headers[i][4:6]), 1) for i in columns]
+
+''' Reads the PowerReviews legacy Bible and Express files in one pass each, instead of unpivoting every month cell into a dictionary and rescanning that list once per output.
+Returns [legacyRev, legacyBill, legacyClient, expressClient, expressRevenue], the first four as getLegacyBibleRevenue, getLegacyBibleBilling, getLegacyBibleClients and getExpressClients return them
+and expressRevenue the Express rows as revenue entries, ready for identifyCurrentClientsThroughTime. '''
+def readLegacyFiles(bibleFilename, expressFilename):
+    return fdbInputCache.cachedInput('legacyFiles', [bibleFilename, expressFilename], lambda: parseLegacyFiles(bibleFilename, expressFilename))
+
+def parseLegacyFiles(bibleFilename, expressFilename):
+    # Bible: billing (B) and revenue (R) rows summed by client and month
+    csvReader = csv.reader(open(bibleFilename, "rb"), delimiter=",", quoting=csv.QUOTE_NONE)
+    months = legacyMonthHeaders(next(csvReader), legacyBibleMonthColumns)
+    sums = {'r': defaultdict(lambda:0), 'b': defaultdict(lambda:0)}
+    legacyClient = defaultdict(dict)
+    for row in csvReader:
+        id = "PR"+row[1][-5:]
+        t_dict = sums.get(row[2].lower())
+        if t_dict is not None:
+            for (month, amt) in zip(months, row[legacyBibleMonthColumns[0]:legacyBibleMonthColumns[-1]+1]):
+                t_dict[(id, month)] += float(amt or '0')
+        legacyClient[id] = {'nsID':id, 'name': row[0],'parentID':id,'vertical':"Retail",'country':"US",'region':"North America", "entity":"PR"}
+    legacyRev = [{"month": key[1], "itemID": -1, "clientID": key[0], "recurring": 1, "amount": amount, "entity":"PR"} for (key, amount) in sums['r'].iteritems()]
+    legacyBill = [{"month": key[1], "clientID": key[0], "amount": amount} for (key, amount) in sums['b'].iteritems()]
+
+    # Express: a recurring revenue flag per client and month
+    csvReader = csv.reader(open(expressFilename, "rb"), delimiter=",", quoting=csv.QUOTE_NONE)
+    months = legacyMonthHeaders(next(csvReader), expressMonthColumns)
+    expressClient = defaultdict(dict)
+    expressRevenue = []
+    for row in csvReader:
+        clientID = row[0]
+        for (month, amt) in zip(months, map(int, row[expressMonthColumns[0]:expressMonthColumns[-1]+1])):
+            expressRevenue.append({"month": month, "itemID": -1, "clientID": clientID, "recurring": 1, "amount": amt, "entity":"EX"})
+        expressClient[clientID] = {'nsID':clientID, 'name': row[6],'parentID':clientID,'vertical':"Retail",'country':"US",'region':"North America", "entity":"EX"}
+
+    return [legacyRev, legacyBill, legacyClient, expressClient, expressRevenue]
+
 # Get translation of currency IDs from "Currencies" table.  Currency symbol (e.g. USD for US Dollars) by NS currency ID.
 def getCurrencyIndex(cursor):
     """ Returns an index of currencies, keyed by internal id.
     Returns dict {id, {id, symbol}}"""
     print "Fetching Currencies from Netsuite...",
     currenciesByID = {}
-    cursor.execute("SELECT currency_id, symbol FROM Currencies")
-    rows = cursor.fetchall()
-    for row in rows:
+    for row in queryRows(cursor, "SELECT currency_id, symbol FROM Currencies", cacheTable='Currencies'):
         currency = {"id": int(row[0]), "symbol": row[1] }
         currenciesByID[currency["id"]] = currency
     print "Done"
     return currenciesByID
 
 
-# Get exchange rate dictionary by currency_id and date from the "CurrencyRates" table
+# Get the exchange rate index by currency_id and date from the "CurrencyRates" table
 def getExchangeRateIndex(cursor):
-    """ Returns an index of exchange rates, keyed by foreign currency (relative to USD) and exchange daate
-    Returns dict currencyID, {effectiveDate: rate}}"""
+    """ Returns an as-of index of exchange rates to USD (see fdbRates), looked up by foreign currency and date.
+    Returns fdbRates.ExchangeRateIndex, index[(currencyID, date)] = rate to USD in effect on that date"""
     print "Fetching Exchange Rates from Netsuite...",
-    exchangeRate = defaultdict(float)
-    cursor.execute("SELECT BASE_CURRENCY_ID, CURRENCY_ID, DATE_EFFECTIVE, EXCHANGE_RATE FROM CurrencyRates")
-    rows = cursor.fetchall()
-    for row in rows:
-        if int(row[0]) == 1: #Only populate if we are looking at currency relative to USD
-            key = (int(row[1]),row[2])
-            exchangeRate[key] = float(row[3])
+    exchangeRate = fdbRates.ExchangeRateIndex(queryRows(cursor, "SELECT BASE_CURRENCY_ID, CURRENCY_ID, DATE_EFFECTIVE, EXCHANGE_RATE FROM CurrencyRates", cacheTable='CurrencyRates'))
     print "Done"
     return exchangeRate
 
@@ -427,9 +716,7 @@ def getExchangeRateIndex(cursor):
 # Returns the vertical identifier and vertical name from the "Vertical" table.  Key return variable is vertical.
 def getNetsuiteVerticalIndex(cursor):
     verticalsByID = {}
-    cursor.execute("SELECT list_id, list_item_name FROM Vertical")
-    rows = cursor.fetchall()
-    for row in rows:
+    for row in queryRows(cursor, "SELECT list_id, list_item_name FROM Vertical", cacheTable='Vertical'):
         vertical = {"nsID": int(row[0]), "name": row[1] }
         verticalsByID[vertical["nsID"]] = vertical
     return verticalsByID
@@ -440,9 +727,7 @@ def getNetsuiteItemsIndex(cursor):
     """ Returns an index of items, keyed by internal id.
     Returns dict {id, {id, name}}"""
     itemsByID = {-1: missingProduct}
-    cursor.execute("SELECT item_id, name FROM Items")
-    rows = cursor.fetchall()
-    for row in rows:
+    for row in queryRows(cursor, "SELECT item_id, name FROM Items", cacheTable='Items'):
         familyName = "Other"
         id = int(row[0])
         if id in productFamilyMap:
@@ -459,9 +744,7 @@ def getNetsuiteCustomerIndex(cursor, verticalsByID):
     """ Returns an index of companies, keyed by internal id.
     Returns dict {id, {id, name, country, vertical}}"""
     customersByID = {-1: missingCustomer}
-    cursor.execute("SELECT customer_id, full_name, country, vertical_id, parent_id FROM Customers")
-    rows = cursor.fetchall()
-    for row in rows:
+    for row in queryRows(cursor, "SELECT customer_id, full_name, country, vertical_id, parent_id FROM Customers", cacheTable='Customers'):
         verticalName = None
         verticalID = int(row[3] or 0)
         if verticalID in verticalsByID:
@@ -482,27 +765,25 @@ def getNetsuiteCustomerIndex(cursor, verticalsByID):
         
     return customersByID
 
-def getConnectionsOnlyIDs(cumulativeBookings):
+# clientBookings is the latest cumulative ASF by client and product, {clientID: {itemID: asf}}, as getMonthlyCumulativeASFEntries returns it
+def getConnectionsOnlyIDs(clientBookings):
     connectionsOnlyIDs = []
-    cumulativeBookingsSorted = sorted(cumulativeBookings.keys()) # Sort so we can easily get last date for which we have bookings
-    lastmonth = cumulativeBookingsSorted[len(cumulativeBookingsSorted)-1]
- 
-    for clientID in cumulativeBookings[lastmonth]:
+
+    for clientID in clientBookings:
         connectionASF, otherASF = 0, 0
-        if clientID == '5711' or clientID == '2576':
-            pause = 1
-        for prod in cumulativeBookings[lastmonth][clientID]:
+        for prod in clientBookings[clientID]:
             if prod in connectionsOnlyProducts:
-                connectionASF += cumulativeBookings[lastmonth][clientID][prod]
+                connectionASF += clientBookings[clientID][prod]
             else:
-                otherASF += cumulativeBookings[lastmonth][clientID][prod]
+                otherASF += clientBookings[clientID][prod]
         if connectionASF > 0 and otherASF < 10: # allow 10 slop
             connectionsOnlyIDs.append(str(int(clientID)))
 
     return connectionsOnlyIDs
 
-def combineCustomerIndicies(fromNetSuite, fromLegacy, fromExpress, idMappingDict, maxAFIDBV, maxAFIDPR):
-    notInMappingFileCtBV, notInMappingFileCtPR = 1,1
+# Clients that are not in the mapping yet get new AFIDs in NSID order.  With a mapping store the AFIDs come from (and are saved to) the store, so they do not change from run to run.
+def combineCustomerIndicies(fromNetSuite, fromLegacy, fromExpress, idMappingDict, maxAFIDBV, maxAFIDPR, mappingStore=None):
+    notInMappingFile = []
     # Combine the customer indicies from NetSuite and the Legacy Bible
     customersByID = dict(fromNetSuite.items() + fromLegacy.items() + fromExpress.items())
 
@@ -525,14 +806,9 @@ def combineCustomerIndicies(fromNetSuite, fromLegacy, fromExpress, idMappingDict
             customer["isIr500"] = idMappingDict[customer["nsID"]]['isIr500']
             customer["ciqUltParent"] = idMappingDict[customer["nsID"]]['ciqUltParent']
             customer["custOrigination"] = idMappingDict[customer["nsID"]]['custOrigination']
-        # Handle case where client has yet to be mapped.  Name should already be set to customer name, but need to create a new AFID.
+        # Handle case where client has yet to be mapped.  Name should already be set to customer name, but need to create a new AFID (allocated below, once all of them are known).
         else:
-            if customer["entity"] == 'BV':
-                customer["afID"] =  "AF-"+str(maxAFIDBV + notInMappingFileCtBV).zfill(8)
-                notInMappingFileCtBV+=1
-            else:
-                customer["afID"] =  "AF-"+str(maxAFIDPR + notInMappingFileCtPR).zfill(8)
-                notInMappingFileCtPR+=1
+            notInMappingFile.append(customer)
             # Update non-AFID vars
             customer["BU"] = "TBD"
             customer["ciqID"] = "TBD"
@@ -551,6 +827,18 @@ def combineCustomerIndicies(fromNetSuite, fromLegacy, fromExpress, idMappingDict
             customer["country"] = "Multi"
             customer["region"] = idRegionMap[customer["nsID"]]            
 
+    if mappingStore is not None:
+        fdbMappingStore.allocateAFIDs(mappingStore, notInMappingFile)
+    else:
+        notInMappingFileCt = {'BV': 0, 'PR': 0}
+        for customer in sorted(notInMappingFile, key=lambda customer: fdbMappingStore.nsidSortKey(customer["nsID"])):
+            if customer["entity"] == 'BV':
+                notInMappingFileCt['BV'] += 1
+                customer["afID"] = fdbMappingStore.formatAFID(maxAFIDBV + notInMappingFileCt['BV'])
+            else:
+                notInMappingFileCt['PR'] += 1
+                customer["afID"] = fdbMappingStore.formatAFID(maxAFIDPR + notInMappingFileCt['PR'])
+
     return customersByID
 
 def combineRevenue(fromNetSuite, fromLegacy):
@@ -582,11 +870,8 @@ def fixUpConnectionsRevenue(revenueEntries,connectionsOnlyIDs,entityOverrides):
 # Returns the contract information from the "Contract" table.  Results in a contract by contract id.  Key variables customer id, product, isf, msf, asf, and contract effective date
 def getNetsuiteContractsIndex(cursor, customersByID, itemsByID):
     contractsByID = {}
-    cursor.execute("SELECT contract_id, customer_name_id, product_type_id, isf, msf_booking, effective_date, renewal_contract, live_adjustment, implementation_debooking FROM Contract")
-    rows = cursor.fetchall()
-
-    # Skip renewal contracts, contracts with no effective date, and contracts with zero MSF
-    for row in [row for row in rows if row[6]!= 'T' and row[4] and row[5]]:
+    # Renewal contracts, contracts with no effective date, and contracts with zero MSF are skipped by the Contract query filters
+    for row in queryRows(cursor, filteredQuery("SELECT contract_id, customer_name_id, product_type_id, isf, msf_booking, effective_date, renewal_contract, live_adjustment, implementation_debooking FROM Contract", 'Contract'), cacheTable='Contract'):
 
         if row[1]:
             customer = customersByID[str(int(row[1]))]
@@ -619,7 +904,11 @@ def getNetsuiteContractsIndex(cursor, customersByID, itemsByID):
     return contractsByID
     
 # Returns payment amounts by client and month from the "Transactions" and "Transaction_Lines" tables
-def getNetsuitePaymentEntries(cursor, exchangeRatesByID):
+# With incremental set, only transactions modified since the last pull are read and merged into the totals kept in the local state store (see fdbState).  fullRefresh rebuilds the stored totals from a full scan.
+# With serverAggregate set, the lines are summed by client/month/currency/subsidiary in the Net Suite SQL and only the groups cross ODBC.
+# With chunked set, full reads go through runChunkedPull - transaction_id ranges read in parallel over pool's connections and resumable after a failure.  Delta reads are small and stay a single query.
+# With reconcile set, a delta pull also drops the stored contributions of transactions deleted in Net Suite since (see reconcileDeltaPull), at the cost of reading the ids of the pull's transactions.
+def getNetsuitePaymentEntries(cursor, exchangeRatesByID, incremental=False, fullRefresh=False, serverAggregate=False, chunked=False, pool=None, reconcile=False):
     # Filters currently set on Payments in NetSuite
         # 1) Account Type == AcctRec (Accounts receiveable)
         # 2) Transaction Type == Payment
@@ -628,21 +917,40 @@ def getNetsuitePaymentEntries(cursor, exchangeRatesByID):
     Returns dict {id, {id, external id, id of renewed transaction, id of followon transaction, status}} """
     print "Fetching Payment Entries from Netsuite...",
     paymentEntries = []
-    cursor.execute("SELECT transaction_lines.amount, transaction_lines.company_id, transactions.trandate, transactions.currency_id, transaction_lines.subsidiary_id FROM transaction_lines, transactions, accounts WHERE transaction_lines.transaction_id = transactions.transaction_id AND transaction_lines.account_id = accounts.account_id AND transactions.transaction_type = 'Payment' AND accounts.type_name = 'Accounts Receivable'")
-    rows = cursor.fetchall()
-
-    # Collapse payments by client/date
-    summedAmounts = defaultdict(lambda: 0)
-    for row in rows:
-        # Grab currency adjustment if we are dealing with a subsidiary
-        if row[3]!=1 and row[4]!=1:
-            currencyAdjustment = exchangeRatesByID[(row[3],row[2])]  # Adjust foreign currency to USD
+    select = "SELECT transaction_lines.amount, transaction_lines.company_id, transactions.trandate, transactions.currency_id, transaction_lines.subsidiary_id, transactions.transaction_id, transactions.last_modified_date"
+    groupBy = ""
+    if serverAggregate:
+        # USD lines are grouped by month.  Foreign currency lines keep their transaction date so the exchange rate below is applied to each group exactly as it is to each line.
+        paymentDate = "CASE WHEN transactions.currency_id = 1 OR transaction_lines.subsidiary_id = 1 THEN TRUNC(transactions.trandate, 'MM') ELSE transactions.trandate END"
+        select = "SELECT SUM(transaction_lines.amount), transaction_lines.company_id, " + paymentDate + ", transactions.currency_id, transaction_lines.subsidiary_id"
+        groupBy = " GROUP BY transaction_lines.company_id, " + paymentDate + ", transactions.currency_id, transaction_lines.subsidiary_id"
+        if incremental or chunked:
+            select += ", transactions.transaction_id, MAX(transactions.last_modified_date)"
+            groupBy += ", transactions.transaction_id"
+    scope = "transactions.transaction_type = 'Payment'"
+    query = select + " FROM transaction_lines, transactions, accounts WHERE transaction_lines.transaction_id = transactions.transaction_id AND transaction_lines.account_id = accounts.account_id AND " + scope + " AND accounts.type_name = 'Accounts Receivable'"
+    lastModified = None
+    if incremental:
+        store, lastModified = startDeltaPull('payments', fullRefresh)
+    if chunked and not lastModified:
+        if incremental:
+            store.close()
+        summedAmounts = runChunkedPull(cursor, pool, ['payments'], query, groupBy, scope, lambda rows: sumPaymentRows(rows, exchangeRatesByID, True)[0:1], [2])[0]
+    else:
+        changedTransactionIDs = None # Set on delta reads
+        if lastModified:
+            changedTransactionIDs, changedModified = getChangedTransactions(cursor, lastModified)
+            rows = queryRows(cursor, query + " AND transactions.last_modified_date >= ?" + groupBy, (lastModified,))
+            lastModified = changedModified
         else:
-            currencyAdjustment = 1  # Dealing with USD
-        d = row[2]
-        month = date(d.year, d.month, 1)
-        key = (int(row[1] or 0), month)
-        summedAmounts[key]+= -1*row[0]*currencyAdjustment
+            rows = queryRows(cursor, query + groupBy, cacheTable=(None if incremental else 'transactions'))
+        summedAmounts, lastModified = sumPaymentRows(rows, exchangeRatesByID, incremental, lastModified)
+        if incremental:
+            fdbState.mergeContributions(store, 'payments', summedAmounts, lastModified, changedTransactionIDs or [])
+            if reconcile and changedTransactionIDs is not None:
+                reconcileDeltaPull(cursor, store, 'payments', scope)
+            summedAmounts = fdbState.getTotals(store, 'payments', 2)
+            store.close()
 
     # Create payment entries
     for key in summedAmounts.keys():
@@ -652,18 +960,36 @@ def getNetsuitePaymentEntries(cursor, exchangeRatesByID):
     print "Done"
     return paymentEntries
 
+# Collapses payment rows by client/date (by transaction/client/date with byTransaction, so they can be merged into the stored totals)
+# Returns [summedAmounts, lastModified], the watermark advanced over the rows when byTransaction is set
+def sumPaymentRows(rows, exchangeRatesByID, byTransaction, lastModified=None):
+    summedAmounts = defaultdict(lambda: 0)
+    for row in rows:
+        d = row[2]
+        key = (int(row[1] or 0), date(d.year, d.month, 1))
+        if byTransaction:
+            key = (int(row[5]),) + key
+            lastModified = advanceWatermark(lastModified, row[6])
+        summedAmounts[key]+= -1*row[0]*usdRate(row, exchangeRatesByID)
+    return [summedAmounts, lastModified]
+
+# Grab currency adjustment if we are dealing with a subsidiary - the rate taking a transaction row's amount (row[0]) in currency row[3] on date row[2] to USD
+def usdRate(row, exchangeRatesByID):
+    if row[3]!=1 and row[4]!=1:
+        return exchangeRatesByID[(row[3],row[2])]  # Adjust foreign currency to USD
+    return 1  # Dealing with USD
+
 def getNetsuiteBillingFreqEntries(cursor):
     print "Fetching Billing Frequency list..."
-    cursor.execute("SELECT list_id, list_item_name FROM billing_cycle")
-    rows = cursor.fetchall()
     billFreqDict = {-1:{'nsID':-1,'name':"Unknown"}}
-    for row in rows:
+    for row in queryRows(cursor, "SELECT list_id, list_item_name FROM billing_cycle", cacheTable='billing_cycle'):
         billFreqDict[int(row[0])] = {'nsID':int(row[0]),'name':row[1]}
     print "Done"
     return billFreqDict
 
 # Returns Net Billing amounts by client and month from the "Transactions" and "Transaction_Lines" tables
-def getNetsuiteBillingsEntries(cursor, exchangeRatesByID):
+# incremental, fullRefresh, serverAggregate, chunked, pool and reconcile work as they do for getNetsuitePaymentEntries
+def getNetsuiteBillingsEntries(cursor, exchangeRatesByID, incremental=False, fullRefresh=False, serverAggregate=False, chunked=False, pool=None, reconcile=False):
     # Filters currently set on Payments in NetSuite
         # 1) Account Type == AcctRec (Accounts receiveable)
         # 2) Transaction Type == Invoice or Credit Memo
@@ -672,36 +998,39 @@ def getNetsuiteBillingsEntries(cursor, exchangeRatesByID):
     Returns dict {id, {id, external id, id of renewed transaction, id of followon transaction, status}} """
     print "Fetching Billing Entries from Netsuite...",
     billingEntries = []
-    cursor.execute("SELECT transaction_lines.amount, transaction_lines.company_id, accounting_periods.starting, transactions.currency_id, transaction_lines.subsidiary_id, transactions.transaction_type, transactions.billing_frequency_id FROM transaction_lines, transactions, accounts, accounting_periods WHERE transaction_lines.transaction_id = transactions.transaction_id AND transactions.accounting_period_id = accounting_periods.accounting_period_id AND transaction_lines.account_id = accounts.account_id AND accounts.type_name = 'Accounts Receivable' AND (transactions.transaction_type = 'Invoice' OR transactions.transaction_type = 'Credit Memo')")
-    rows = cursor.fetchall()
-
-    # Collapse payments by client/date
-    summedAmounts = defaultdict(lambda: 0)
-    for row in rows:
-
-        # Create link for invoice type dim table
-        if row[5]=="Invoice":
-            transType = 1
-        elif row[5]=="Credit Memo":
-            transType = 0
-        else:
-            transType = -1
-
-        # Create a link to the billing frequency dim table
-        if row[6]:
-            billFreq = row[6]
+    select = "SELECT transaction_lines.amount, transaction_lines.company_id, accounting_periods.starting, transactions.currency_id, transaction_lines.subsidiary_id, transactions.transaction_type, transactions.billing_frequency_id, transactions.transaction_id, transactions.last_modified_date"
+    groupBy = ""
+    if serverAggregate:
+        # The accounting period start is already the month, and it is also the exchange rate date, so grouping on it is exact
+        select = "SELECT SUM(transaction_lines.amount), transaction_lines.company_id, accounting_periods.starting, transactions.currency_id, transaction_lines.subsidiary_id, transactions.transaction_type, transactions.billing_frequency_id"
+        groupBy = " GROUP BY transaction_lines.company_id, accounting_periods.starting, transactions.currency_id, transaction_lines.subsidiary_id, transactions.transaction_type, transactions.billing_frequency_id"
+        if incremental or chunked:
+            select += ", transactions.transaction_id, MAX(transactions.last_modified_date)"
+            groupBy += ", transactions.transaction_id"
+    scope = "(transactions.transaction_type = 'Invoice' OR transactions.transaction_type = 'Credit Memo')"
+    query = select + " FROM transaction_lines, transactions, accounts, accounting_periods WHERE transaction_lines.transaction_id = transactions.transaction_id AND transactions.accounting_period_id = accounting_periods.accounting_period_id AND transaction_lines.account_id = accounts.account_id AND accounts.type_name = 'Accounts Receivable' AND " + scope
+    lastModified = None
+    if incremental:
+        store, lastModified = startDeltaPull('billings', fullRefresh)
+    if chunked and not lastModified:
+        if incremental:
+            store.close()
+        summedAmounts = runChunkedPull(cursor, pool, ['billings'], query, groupBy, scope, lambda rows: sumBillingRows(rows, exchangeRatesByID, True)[0:1], [4])[0]
+    else:
+        changedTransactionIDs = None # Set on delta reads
+        if lastModified:
+            changedTransactionIDs, changedModified = getChangedTransactions(cursor, lastModified)
+            rows = queryRows(cursor, query + " AND transactions.last_modified_date >= ?" + groupBy, (lastModified,))
+            lastModified = changedModified
         else:
-            billFreq = -1
-            
-        # Grab currency adjustment if we are dealing with a subsidiary
-        if row[3]!=1 and row[4]!=1:
-            currencyAdjustment = exchangeRatesByID[(row[3],row[2])]  # Adjust foreign currency to USD
-        else:
-            currencyAdjustment = 1  # Dealing with USD
-        d = row[2]
-        month = date(d.year, d.month, 1)
-        key = (int(row[1] or 0), month, transType, billFreq)
-        summedAmounts[key]+= row[0]*currencyAdjustment
+            rows = queryRows(cursor, query + groupBy, cacheTable=(None if incremental else 'transactions'))
+        summedAmounts, lastModified = sumBillingRows(rows, exchangeRatesByID, incremental, lastModified)
+        if incremental:
+            fdbState.mergeContributions(store, 'billings', summedAmounts, lastModified, changedTransactionIDs or [])
+            if reconcile and changedTransactionIDs is not None:
+                reconcileDeltaPull(cursor, store, 'billings', scope)
+            summedAmounts = fdbState.getTotals(store, 'billings', 4)
+            store.close()
 
     # Create payment entries
     for key in summedAmounts.keys():
@@ -711,6 +1040,120 @@ def getNetsuiteBillingsEntries(cursor, exchangeRatesByID):
     print "Done"
     return billingEntries
 
+# Collapses billing rows by client/date/type/frequency (by transaction as well with byTransaction, so they can be merged into the stored totals)
+# Returns [summedAmounts, lastModified], the watermark advanced over the rows when byTransaction is set
+def sumBillingRows(rows, exchangeRatesByID, byTransaction, lastModified=None):
+    summedAmounts = defaultdict(lambda: 0)
+    for row in rows:
+        key = billingKey(row)
+        if byTransaction:
+            key = (int(row[7]),) + key
+            lastModified = advanceWatermark(lastModified, row[8])
+        summedAmounts[key]+= row[0]*usdRate(row, exchangeRatesByID)
+    return [summedAmounts, lastModified]
+
+# Returns the (clientID, month, transType, billFreqID) a billing row is summed under
+def billingKey(row):
+
+    # Create link for invoice type dim table
+    if row[5]=="Invoice":
+        transType = 1
+    elif row[5]=="Credit Memo":
+        transType = 0
+    else:
+        transType = -1
+
+    # Create a link to the billing frequency dim table
+    if row[6]:
+        billFreq = row[6]
+    else:
+        billFreq = -1
+
+    d = row[2]
+    return (int(row[1] or 0), date(d.year, d.month, 1), transType, billFreq)
+
+# Returns [paymentEntries, billingEntries], as getNetsuitePaymentEntries and getNetsuiteBillingsEntries do, from one pass over the Accounts Receivable transaction lines.
+# Each Payment, Invoice and Credit Memo line is read once and routed to the payment or billing sums by its transaction type.
+# incremental, fullRefresh, serverAggregate, chunked, pool and reconcile work as they do for the separate pulls.  A delta read starts from the older of the payment and billing watermarks, so it covers both.
+# With columnar set (and NumPy installed) the result is fetched and summed in typed column batches by fdbColumnar rather than one row at a time.
+def getNetsuiteARTransactionEntries(cursor, exchangeRatesByID, incremental=False, fullRefresh=False, serverAggregate=False, chunked=False, pool=None, columnar=False, reconcile=False):
+    print "Fetching Payment and Billing Entries from Netsuite...",
+    fetch, sumRows = queryRows, sumARRows
+    if columnar and fdbColumnar.available():
+        fetch, sumRows = queryColumns, fdbColumnar.sumARColumns
+    # Payments are dated by transaction date, billing by accounting period start.  Billing lines with no accounting period are skipped, as the separate billing pull's join drops them.
+    entryDate = "CASE WHEN transactions.transaction_type = 'Payment' THEN transactions.trandate ELSE accounting_periods.starting END"
+    select = "SELECT transaction_lines.amount, transaction_lines.company_id, " + entryDate + ", transactions.currency_id, transaction_lines.subsidiary_id, transactions.transaction_type, transactions.billing_frequency_id, transactions.transaction_id, transactions.last_modified_date"
+    groupBy = ""
+    if serverAggregate:
+        # Grouped as the separate pulls group: USD payments by month, foreign currency payments by transaction date and billing by accounting period
+        entryDate = "CASE WHEN transactions.transaction_type <> 'Payment' THEN accounting_periods.starting WHEN transactions.currency_id = 1 OR transaction_lines.subsidiary_id = 1 THEN TRUNC(transactions.trandate, 'MM') ELSE transactions.trandate END"
+        select = "SELECT SUM(transaction_lines.amount), transaction_lines.company_id, " + entryDate + ", transactions.currency_id, transaction_lines.subsidiary_id, transactions.transaction_type, transactions.billing_frequency_id"
+        groupBy = " GROUP BY transaction_lines.company_id, " + entryDate + ", transactions.currency_id, transaction_lines.subsidiary_id, transactions.transaction_type, transactions.billing_frequency_id"
+        if incremental or chunked:
+            select += ", transactions.transaction_id, MAX(transactions.last_modified_date)"
+            groupBy += ", transactions.transaction_id"
+    scope = "transactions.transaction_type IN ('Payment', 'Invoice', 'Credit Memo')"
+    query = select + " FROM transaction_lines, accounts, transactions LEFT OUTER JOIN accounting_periods ON transactions.accounting_period_id = accounting_periods.accounting_period_id WHERE transaction_lines.transaction_id = transactions.transaction_id AND transaction_lines.account_id = accounts.account_id AND accounts.type_name = 'Accounts Receivable' AND " + scope
+    lastModified = None
+    if incremental:
+        paymentStore, paymentModified = startDeltaPull('payments', fullRefresh)
+        billingStore, billingModified = startDeltaPull('billings', fullRefresh)
+        if paymentModified and billingModified:
+            lastModified = min(paymentModified, billingModified)
+    if chunked and not lastModified:
+        if incremental:
+            paymentStore.close()
+            billingStore.close()
+        paymentSums, billingSums = runChunkedPull(cursor, pool, ['payments', 'billings'], query, groupBy, scope, lambda rows: sumRows(rows, exchangeRatesByID, True)[0:2], [2, 4], fetch)
+    else:
+        changedTransactionIDs = None # Set on delta reads
+        if lastModified:
+            changedTransactionIDs, changedModified = getChangedTransactions(cursor, lastModified)
+            rows = fetch(cursor, query + " AND transactions.last_modified_date >= ?" + groupBy, (lastModified,))
+            lastModified = changedModified
+        else:
+            rows = fetch(cursor, query + groupBy, cacheTable=(None if incremental else 'transactions'))
+        paymentSums, billingSums, lastModified = sumRows(rows, exchangeRatesByID, incremental, lastModified)
+        if incremental:
+            fdbState.mergeContributions(paymentStore, 'payments', paymentSums, lastModified, changedTransactionIDs or [])
+            if reconcile and changedTransactionIDs is not None:
+                reconcileDeltaPull(cursor, paymentStore, 'payments', scope)
+            paymentSums = fdbState.getTotals(paymentStore, 'payments', 2)
+            paymentStore.close()
+            fdbState.mergeContributions(billingStore, 'billings', billingSums, lastModified, changedTransactionIDs or [])
+            if reconcile and changedTransactionIDs is not None:
+                reconcileDeltaPull(cursor, billingStore, 'billings', scope)
+            billingSums = fdbState.getTotals(billingStore, 'billings', 4)
+            billingStore.close()
+
+    paymentEntries = [{"amount": amount, "clientID": key[0], "month": key[1]} for (key, amount) in paymentSums.iteritems()]
+    billingEntries = [{"amount": amount, "clientID": key[0], "month": key[1], "invID": key[2], "billFreqID": key[3]} for (key, amount) in billingSums.iteritems()]
+    print "Done"
+    return [paymentEntries, billingEntries]
+
+# Routes AR rows (laid out as billing rows) to the payment and billing sums by transaction type.  Returns [paymentSums, billingSums, lastModified].
+def sumARRows(rows, exchangeRatesByID, byTransaction, lastModified=None):
+    paymentSums = defaultdict(lambda: 0)
+    billingSums = defaultdict(lambda: 0)
+    for row in rows:
+        if row[2] is None:
+            continue
+        if row[5]=="Payment":
+            d = row[2]
+            key = (int(row[1] or 0), date(d.year, d.month, 1))
+            sums = paymentSums
+            amount = -1*row[0]*usdRate(row, exchangeRatesByID)
+        else:
+            key = billingKey(row)
+            sums = billingSums
+            amount = row[0]*usdRate(row, exchangeRatesByID)
+        if byTransaction:
+            key = (int(row[7]),) + key
+            lastModified = advanceWatermark(lastModified, row[8])
+        sums[key]+= amount
+    return [paymentSums, billingSums, lastModified]
+
 # Returns Implementation records amounts by client and month from the implementations table
 def getNetsuiteImplementationRecords(cursor):
 
@@ -718,34 +1161,30 @@ def getNetsuiteImplementationRecords(cursor):
     Returns dict {id, {id, external id, id of renewed transaction, id of followon transaction, status}} """
     print "Fetching Implementation Entries from Netsuite...",
 
-    # Pull in implementation phase data
-    imp_phase_dict = defaultdict(str)
-    imp_phase_dict[-1] = "N/A"  
-    cursor.execute("SELECT implementation_phase.list_id, implementation_phase.list_item_name FROM implementation_phase")
-    rows = cursor.fetchall()
-    for row in rows:
-        imp_phase_dict[int(row[0])] = row[1]
-        
-    cursor.execute("SELECT implementations.implementation_customer_nam_id, implementations.projected_bv_launch, implementations.actual_client_launch, implementations.imp_phase_id, implementations.implementation_msf FROM implementations")
-    rows = cursor.fetchall()
+    # Implementation phase names are joined in server-side.  Completed, cancelled and retired implementations are skipped by the implementations query filters.
 
     # Collapse ASF by client/date
     impEntries = []
     missingDateList = []
     summedAmounts = defaultdict(lambda: 0)
-    for row in rows:
-        if imp_phase_dict[row[3]] == "Completed" or imp_phase_dict[row[3]] == "Cancelled" or imp_phase_dict[row[3]] =="Not Implemented - Retired":
-            continue
+    for row in queryRows(cursor, filteredQuery("SELECT implementations.implementation_customer_nam_id, implementations.projected_bv_launch, implementations.actual_client_launch, implementations.imp_phase_id, implementations.implementation_msf, implementation_phase.list_item_name, implementation_phase.list_id FROM implementations LEFT OUTER JOIN implementation_phase ON implementations.imp_phase_id = implementation_phase.list_id", 'implementations'), cacheTable='implementations'):
+        # Phase name as the implementation_phase lookup gives it - blank for phases missing from that table
+        if row[6] is not None:
+            impPhase = row[5]
+        elif row[3] == -1:
+            impPhase = "N/A"
+        else:
+            impPhase = ""
         if (row[2] or row[1]):
             if row[2]:
                 d = row[2]
             else:
                 d = row[1]
             month = date(d.year, d.month, 1)
-            key = (int(row[0] or 0), month, imp_phase_dict[row[3]])
+            key = (int(row[0] or 0), month, impPhase)
             summedAmounts[key]+= (row[4] or 0)*12
         else:
-            missingDateList.append([row[0],(imp_phase_dict[row[3]] or "N/A"),(row[4] or 0)*12])
+            missingDateList.append([row[0],(impPhase or "N/A"),(row[4] or 0)*12])
             
     # Create payment entries
     for key in summedAmounts.keys():
@@ -755,31 +1194,80 @@ def getNetsuiteImplementationRecords(cursor):
     print "Done"
     return [impEntries,missingDateList]
 
-# This method is not functioning.  It needs to be finished.
-#def getNetsuiteRevenueEntries(cursor):
-#    """ Returns an index of revenue entries, keyed by transaction id.
-#    Returns dict {id, {id, external id, id of renewed transaction, id of followon transaction, status}} """
-#    print "Fetching Revenue Entries from Netsuite...",
-#    revenueEntries = []
-#
-#    searchAccounts = ','.join(map(str, accountIDRecurringMap.iterkeys()))
-#    cursor.execute("SELECT transaction_lines.amount, transaction_lines.account_id, transaction_lines.company_id, transaction_lines.item_id, transactions.trandate FROM transaction_lines, transactions where non_posting_line = 'No' and transaction_lines.transaction_id = transactions.transaction_id and transaction_lines.account_id in (" + searchAccounts + ")")
-#    rows = cursor.fetchall()
-#    for row in rows:
-#        recurring = accountIDRecurringMap[int(row[1])]
-#        d = row[4]
-#        month = date(d.year, d.month, 1)
-#        revenueEntry = {"amount": row[0], "recurring": recurring, "clientID": int(row[2] or 0), "itemID": int(row[3] or 0), "month": month}
-#        revenueEntries.append(revenueEntry)
-#
-#    print "Done"
-#    return revenueEntries
+# Returns revenue entries by client, item and month, as readRevenueInput does from the exported fact_revenue_input.csv, read straight from the posting lines of the revenue accounts in accountIDRecurringMap
+# Lines are bucketed by client, item, month and recurring flag in the query, so only one row per bucket (per transaction for delta and chunked reads) is transferred.  Amounts are as posted, like the export.
+# incremental, fullRefresh, chunked, pool and reconcile work as they do for getNetsuitePaymentEntries
+def getNetsuiteRevenueEntries(cursor, incremental=False, fullRefresh=False, chunked=False, pool=None, reconcile=False):
+    print "Fetching Revenue Entries from Netsuite...",
+    revenueEntries = []
+    searchAccounts = ",".join(map(str, sorted(accountIDRecurringMap.iterkeys())))
+    recurringAccounts = ",".join([str(accountID) for accountID in sorted(accountIDRecurringMap.iterkeys()) if accountIDRecurringMap[accountID]])
+    revenueMonth = "TRUNC(transactions.trandate, 'MM')"
+    recurring = "CASE WHEN transaction_lines.account_id IN (" + recurringAccounts + ") THEN 1 ELSE 0 END"
+    select = "SELECT SUM(transaction_lines.amount), transaction_lines.company_id, transaction_lines.item_id, " + revenueMonth + ", " + recurring
+    groupBy = " GROUP BY transaction_lines.company_id, transaction_lines.item_id, " + revenueMonth + ", " + recurring
+    if incremental or chunked:
+        select += ", transactions.transaction_id, MAX(transactions.last_modified_date)"
+        groupBy += ", transactions.transaction_id"
+    query = select + " FROM transaction_lines, transactions WHERE transaction_lines.transaction_id = transactions.transaction_id AND transaction_lines.non_posting_line = 'No' AND transaction_lines.account_id IN (" + searchAccounts + ")"
+    scope = "transactions.transaction_id IN (SELECT transaction_lines.transaction_id FROM transaction_lines WHERE transaction_lines.account_id IN (" + searchAccounts + "))"
+    lastModified = None
+    if incremental:
+        store, lastModified = startDeltaPull('revenue', fullRefresh)
+    if chunked and not lastModified:
+        if incremental:
+            store.close()
+        summedAmounts = runChunkedPull(cursor, pool, ['revenue'], query, groupBy, scope, lambda rows: sumRevenueRows(rows, True)[0:1], [4])[0]
+    else:
+        changedTransactionIDs = None # Set on delta reads
+        if lastModified:
+            changedTransactionIDs, changedModified = getChangedTransactions(cursor, lastModified)
+            rows = queryRows(cursor, query + " AND transactions.last_modified_date >= ?" + groupBy, (lastModified,))
+            lastModified = changedModified
+        else:
+            rows = queryRows(cursor, query + groupBy, cacheTable=(None if incremental else 'transactions'))
+        summedAmounts, lastModified = sumRevenueRows(rows, incremental, lastModified)
+        if incremental:
+            fdbState.mergeContributions(store, 'revenue', summedAmounts, lastModified, changedTransactionIDs or [])
+            if reconcile and changedTransactionIDs is not None:
+                reconcileDeltaPull(cursor, store, 'revenue', scope)
+            summedAmounts = fdbState.getTotals(store, 'revenue', 4)
+            store.close()
+
+    # Create revenue entries
+    for key in sorted(summedAmounts.keys(), key=lambda key: (key[1], key[2], key[0], key[3])):
+        revenueEntry = {"month": key[1],
+                        "itemID": key[2],
+                        "clientID": str(key[0]),
+                        "recurring": key[3],
+                        "amount": float(summedAmounts[key]),
+                        "entity": "BV"
+                        }
+        revenueEntries.append(revenueEntry)
+
+    print "Done"
+    return revenueEntries
+
+# Collapses revenue rows by client/month/item/recurring (by transaction as well with byTransaction, so they can be merged into the stored totals)
+# Returns [summedAmounts, lastModified], the watermark advanced over the rows when byTransaction is set
+def sumRevenueRows(rows, byTransaction, lastModified=None):
+    summedAmounts = defaultdict(lambda: 0)
+    for row in rows:
+        d = row[3]
+        if d is None:
+            continue
+        key = (int(row[1] or 0), date(d.year, d.month, 1), int(row[2] or 0), int(row[4]))
+        if byTransaction:
+            key = (int(row[5]),) + key
+            lastModified = advanceWatermark(lastModified, row[6])
+        summedAmounts[key]+= row[0] or 0
+    return [summedAmounts, lastModified]
 
 ''''''''''''''' Fix up methods '''''''''''''''
 # This method sets the variable that indicates whether the contract is an uptick or a downtick
-def fixupContractTypes(contractsByID, firstBookingsByClientTopName):
-    contractsByDate = sorted(contractsByID.values(), key=operator.itemgetter('effectiveDate'))
-    for contract in contractsByDate:
+# contracts is contractsByID or the ContractTimeline built from it (see getContractTimeline)
+def fixupContractTypes(contracts, firstBookingsByClientTopName):
+    for contract in fdbContractTimeline.timelineOf(contracts).contracts:
         if contract['effectiveDate'] == firstBookingsByClientTopName[contract['customer']['topName']]:
             contractType = "New"
         elif contract['asf'] < 0:
@@ -819,72 +1307,75 @@ def fixupCustomerFirstBookingsAndCohorts(customersByID, firstBookingsByClientTop
 
 
 ''''''''''''''' Computation methods '''''''''''''''
-# Returns the cumulative ASF paid by a client for a given product at one month intervals.
-def getMonthlyCumulativeASFEntries(contractsByID):
+# The contracts sorted by effective date and grouped by month, client and product once (see fdbContractTimeline), for the bookings computations below.  Build it once and pass it to each of them.
+def getContractTimeline(contractsByID):
+    return fdbContractTimeline.ContractTimeline(contractsByID)
+
+''' Returns the cumulative ASF paid by a client for a given product at one month intervals.  contracts is contractsByID or its ContractTimeline.
+In 'dense' mode there is an entry for every client and product in every month from its first booking on.  In 'changes' mode there are only the entries whose (rounded) ASF differs
+from the client and product's entry the month before, and in 'spans' mode the changes become valid from / valid to spans (fdbBookingSpans.bookingSpans).
+fdbBookingSpans.densifyBookings gives the dense entries back from changes or spans, for the months with contracts up to today.
+Returns [asfEntries, clientBookings], clientBookings being the cumulative ASF by client and product, {clientID: {itemID: asf}}, as of the last month (getClientBookings gives it for earlier months). '''
+def getMonthlyCumulativeASFEntries(contracts, mode='dense'):
+    if mode not in cumulativeBookingsFiles:
+        raise ValueError("Unknown cumulative bookings mode " + str(mode))
     today = date.today()
 
-    contractsByDate = sorted(contractsByID.values(), key=operator.itemgetter('effectiveDate'))
-
-    contractsByMonth = defaultdict(list)
-
-    for contract in contractsByDate:
-        contractDate = contract['effectiveDate']
-        month = date(contractDate.year, contractDate.month, 1)
-        contractsByMonth[month].append(contract)
-
     productClientAccumulators = defaultdict(float)
-    monthlyClientBooking = {}
+    lastASFs = {}
+    months = []
 
     asfEntries = []
 
-    sortedMonths = sorted(contractsByMonth.keys())
-
-    for month in [month for month in sortedMonths if month <= today]:
-        tempClientDict = {}
-
-        monthContracts = contractsByMonth.get(month)
+    for (month, monthContracts) in fdbContractTimeline.timelineOf(contracts).monthBuckets(today):
+        months.append(month)
 
+        changedKeys = []
         for contract in monthContracts:
             key = (contract['item']['nsID'], str(contract['customer']['nsID']))
             productClientAccumulators[key] += contract['asf']
+            changedKeys.append(key)
+
+        # Only the clients and products with contracts this month can have changed
+        if mode != 'dense':
+            for key in changedKeys:
+                asf = round(productClientAccumulators[key], 4)
+                if key not in lastASFs or lastASFs[key] != asf:
+                    lastASFs[key] = asf
+                    asfEntries.append({"itemID": key[0], "clientID": key[1], "month": month, "asf": asf})
+
+        if mode == 'dense':
+            for ((itemID,clientID),asf) in productClientAccumulators.iteritems():
+                asfEntries.append({"itemID": itemID, "clientID": clientID, "month": month, "asf": round(asf, 4)})
+
+    if mode == 'spans':
+        asfEntries = fdbBookingSpans.bookingSpans(asfEntries, months)
+    return [asfEntries,clientBookingsOf(productClientAccumulators)]
+
+# {clientID: {itemID: asf}} of cumulative bookings accumulators keyed (itemID, clientID)
+def clientBookingsOf(productClientAccumulators):
+    clientBookings = defaultdict(dict)
+    for ((itemID,clientID),asf) in productClientAccumulators.iteritems():
+        clientBookings[clientID][itemID] = asf
+    return dict(clientBookings)
+
+# The cumulative ASF by client and product, {clientID: {itemID: asf}}, as of the end of month (today if None) - the clientBookings of getMonthlyCumulativeASFEntries for an earlier month, worked out from the ContractTimeline when it is wanted.  contracts is contractsByID or its ContractTimeline.
+def getClientBookings(contracts, month=None):
+    productClientAccumulators = defaultdict(float)
+    for contract in fdbContractTimeline.timelineOf(contracts).contractsUntil(month or date.today()):
+        productClientAccumulators[(contract['item']['nsID'], str(contract['customer']['nsID']))] += contract['asf']
+    return clientBookingsOf(productClientAccumulators)
 
-        for ((itemID,clientID),asf) in productClientAccumulators.iteritems():
-            entry = {"itemID": itemID, "clientID": clientID, "month": month, "asf": round(asf, 4)}
-            asfEntries.append(entry)
-            if tempClientDict.has_key(clientID):
-                if tempClientDict[clientID].has_key(itemID):
-                    tempClientDict[clientID][itemID] += asf
-                else:
-                    tempClientDict[clientID][itemID] = asf
-            else:
-                tempClientDict[clientID] = {itemID:asf}
-            
-        monthlyClientBooking[month] = tempClientDict
-        
-    return [asfEntries,monthlyClientBooking]
-
-# Returns the incremental ASF paid by a client for a given product at one month intervals.
-def getMonthlyIncrementalASFEntries(contractsByID):
+# Returns the incremental ASF paid by a client for a given product at one month intervals.  contracts is contractsByID or its ContractTimeline.
+def getMonthlyIncrementalASFEntries(contracts):
     today = date.today()
 
-    contractsByDate = sorted(contractsByID.values(), key=operator.itemgetter('effectiveDate'))
-
-    contractsByMonth = defaultdict(list)
-
-    for contract in contractsByDate:
-        contractDate = contract['effectiveDate']
-        month = date(contractDate.year, contractDate.month, 1)
-        contractsByMonth[month].append(contract)
-
     asfEntries = []
 
-    sortedMonths = sorted(contractsByMonth.keys())
-    for month in [month for month in sortedMonths if month <= today]:
+    for (month, monthContracts) in fdbContractTimeline.timelineOf(contracts).monthBuckets(today):
 
         productClientContractTypeAccumulators = defaultdict(float)
 
-        monthContracts = contractsByMonth.get(month)
-
         for contract in monthContracts:
             key = (contract['item']['nsID'], str(contract['customer']['nsID']), contract['contractType'], contract['booking_id'])
             productClientContractTypeAccumulators[key] += contract['asf']
@@ -895,63 +1386,55 @@ def getMonthlyIncrementalASFEntries(contractsByID):
 
     return asfEntries
 
-def getMontlyDealCount(contractsByID):
+# Counts the distinct effective dates of each client's new bookings (booking_id 1) by month, going through each client's contracts in date order.  contracts is contractsByID or its ContractTimeline.
+def getMontlyDealCount(contracts):
+    timeline = fdbContractTimeline.timelineOf(contracts)
     dealCountEntries = defaultdict(lambda:0)
-    for contract in contractsByID:
-        if contractsByID[contract]['booking_id']==1:
-            key = (contractsByID[contract]['customer']['nsID'],dateToDateKey(contractsByID[contract]['effectiveDate']))
-            if dealCountEntries.has_key(key):
-                if contractsByID[contract]['effectiveDate'] not in dealCountEntries[key]['dealDateSet']:
-                    dealCountEntries[key] = {'nsID':key[0],'dateKey':key[1],'count':dealCountEntries[key]['count']+1,'dealDateSet':dealCountEntries[key]['dealDateSet']+[contractsByID[contract]['effectiveDate']]}
-            else:
-                dealCountEntries[key] = {'nsID':key[0],'dateKey':key[1],'count':1,'dealDateSet':[contractsByID[contract]['effectiveDate']]}
+    for (clientID, positions) in timeline.byClient.iteritems():
+        for contract in timeline.groupContracts(positions):
+            if contract['booking_id']==1:
+                key = (clientID,dateToDateKey(contract['effectiveDate']))
+                if dealCountEntries.has_key(key):
+                    if contract['effectiveDate'] not in dealCountEntries[key]['dealDateSet']:
+                        dealCountEntries[key]['count'] += 1
+                        dealCountEntries[key]['dealDateSet'].append(contract['effectiveDate'])
+                else:
+                    dealCountEntries[key] = {'nsID':key[0],'dateKey':key[1],'count':1,'dealDateSet':[contract['effectiveDate']]}
     return dealCountEntries
     
 
 # Process incoming revenue - input is list of {Date, ProductID, ClientID, Revenue} from Netsuite report
 # - Go-live = Three consecutive months of rev rec >= $500
-def computeClientGoLiveDates(revenueEntries, customersByID):
+# Monthly revenue series by top client name (see fdbRevenueSeries), for the stages that look at a client's revenue month by month.  Build it once and pass it to each of them.
+def getRevenueSeriesIndex(revenueEntries, customersByID):
+    return fdbRevenueSeries.RevenueSeriesIndex(revenueEntries, fdbRevenueSeries.topClientKey(customersByID))
+
+# Go live is the earliest month satisfying the rule of its fiscal year, found by scanning each top client's monthly revenue series.  seriesIndex is built from the entries if not given.
+def computeClientGoLiveDates(revenueEntries, customersByID, seriesIndex=None):
     goLiveRevenueAmount = 500
+    if seriesIndex is None:
+        seriesIndex = getRevenueSeriesIndex(revenueEntries, customersByID)
 
     goLiveDateByClientTopName = defaultdict(lambda:None)
-
-    # Build index of (Date,ClientID)->Revenue
-    revenueByDateAndClientTopName = defaultdict(float)
-    for entry in revenueEntries:
-        amount = entry["amount"]
-        clientID = entry["clientID"]
-
-        if clientID != -1 and amount and clientID in customersByID:
-            key = (entry["month"], customersByID[clientID]["topName"])
-            revenueByDateAndClientTopName[key] += amount
-
-    for ((month, topName),amount) in revenueByDateAndClientTopName.iteritems():
-        # If we already have an earlier goLive date found, skip this entry
-        if topName in goLiveDateByClientTopName and month > goLiveDateByClientTopName[topName]:
-            continue
-
-        if bvFY(month) < 2011:
-        # Special logic for old never live clients - go live requires 3 consecutive months of >= $500 revenue
-            if amount >= goLiveRevenueAmount:
-                oneMonth = nextMonth(month)
-                twoMonths = nextMonth(oneMonth)
-                key1 = (oneMonth, topName)
-                key2 = (twoMonths, topName)
-                if key1 in revenueByDateAndClientTopName and key2 in revenueByDateAndClientTopName:
-                    if revenueByDateAndClientTopName[key1] >= goLiveRevenueAmount and revenueByDateAndClientTopName[key2] >= goLiveRevenueAmount:
-                        goLiveDateByClientTopName[topName] = month
-        else:
+    for topName in seriesIndex.keys():
+        # Special logic for old never live clients - go live requires 3 consecutive months of >= $500 revenue, starting before FY2011
+        oldGoLive = seriesIndex.firstRun(topName, 3, goLiveRevenueAmount, lambda month: bvFY(month) < 2011)
         # for new clients - go live on any positive revenue
-            if amount > 0:
-                goLiveDateByClientTopName[topName] = month
+        newGoLive = seriesIndex.firstMonth(topName, lambda month, amount: bvFY(month) >= 2011 and amount > 0)
+        goLive = min([month for month in [oldGoLive, newGoLive] if month is not None] or [None])
+        if goLive is not None:
+            goLiveDateByClientTopName[topName] = goLive
 
     return goLiveDateByClientTopName
 
 
 # This method updated the first client bookings dictionary  using the contract effective date
-def computeFirstBookings(contractsByID, firstBookingsByClientTopName, firstBookingsByClientTopNameAndProductID):
+# Only the first (earliest) contract of each client and product in the ContractTimeline needs looking at.  contracts is contractsByID or its ContractTimeline.
+def computeFirstBookings(contracts, firstBookingsByClientTopName, firstBookingsByClientTopNameAndProductID):
+    timeline = fdbContractTimeline.timelineOf(contracts)
     # Record earliest booking date on the customer.
-    for contract in contractsByID.itervalues():
+    for positions in timeline.byClientAndProduct.itervalues():
+        contract = timeline.contracts[positions[0]]
         topName = contract['customer']['topName']
 
         if (not topName in firstBookingsByClientTopName) or not firstBookingsByClientTopName[topName]:
@@ -966,145 +1449,11 @@ def computeFirstBookings(contractsByID, firstBookingsByClientTopName, firstBooki
             firstBookingsByClientTopNameAndProductID[key] = min(contract['effectiveDate'], firstBookingsByClientTopNameAndProductID[key])
 
 ''' This function identifies current clients through time based on revenue (boolean is provided for various set time periods) '''
-def identifyCurrentClientsThroughTime(revenueEntries, customersByID, overrideList, expressData):
-
-    # Convert express data into list
-    expressList = []
-    for row in expressData:
-        entry = {"month": row["month"],
-                 "itemID": -1,
-                 "clientID": row["clientId"],
-                 "recurring": 1,
-                 "amount": row["amount"],
-                 "entity":"EX"
-                 }
-        expressList.append(entry)
-
-    # Combine revenue entries with express data (note, express data is just flag but that shouldn't be a problem)
-    combinedRevEntries = revenueEntries + expressList
-
-    # Pull out two parts of override list
-    overrideDict = overrideList[0]
-    entitiesToExclude = overrideList[1]
-    ### ZB - This could be the structural problem getting in the way of making the entity assignment time dependent.
-    clientIdDict = {} # Format {AFID : NSID} - This dict will hold an arbitrary ID for a given bundle name
-
-    # Build index of (Date,ClientID)->Revenue
-    revenueByDateAndAccountName = defaultdict(float)
-    revenueByDateAndClientTopName = defaultdict(float)
-    uniqueClientList = []   # List contains unique list of client for sorting and lookup values
-    uniqueDateList = []     # List contains unique list of revenue recognition dates
-
-    # Capture unique list of account ids - sub top level client
-    uniqueIDSet = set([])
-    for entry in combinedRevEntries:
-        uniqueIDSet.add(entry["clientID"])
-
-    # Loop through all of the IDs we have and all the entries to get recurring revenue by client
-    # Note - this nested loop is horrendously inefficient, but I don't have the time to come up with something cooler now.  Fix this later to save run time.
-    for id in uniqueIDSet:
-        
-        for entry in combinedRevEntries:
-
-            # Set high level variables
-            amount = entry["amount"]
-            clientID = entry["clientID"]
+# expressRevenue is the Express revenue entries as readLegacyFiles returns them (getExpressRevenue converts readExpressFile rows)
+def identifyCurrentClientsThroughTime(revenueEntries, customersByID, overrideList, expressRevenue):
 
-            # Subset to only recurring revenue numbers
-            if entry["recurring"]!=1:
-                continue
-
-            # Only keep records that relate to this accont id
-            if entry["clientID"] != id:
-                continue
-
-            # Exclude wholly excluded entities from override file
-            if entitiesToExclude.count(clientID):  # Skip if this is an entity to exclude
-                continue
-            
-            if clientID != -1 and amount and clientID in customersByID:
-
-                topClientName = customersByID[clientID]["topName"].encode('ascii','ignore').lower() # Standardize top client name to match client names from override dictionary
-                afID = customersByID[clientID]["afID"]
-                             
-                if uniqueClientList.count(afID) == 0:      # Update unique client list & ID dictionary
-                        uniqueClientList.append(afID)
-                if uniqueDateList.count(entry["month"]) == 0:       # Update unique data list
-                    uniqueDateList.append(entry["month"])                             
-                if clientIdDict.has_key(afID):
-                    if clientIdDict[afID]['month'] < entry['month']:# Update assignment of AFID to customer id.  Handle such that client assignment goes in order BV, PR, CN, EX.
-                        clientIdDict[afID] = {'id':clientID,'month':entry['month'],'entity':entry['entity']}
-                    elif clientIdDict[afID]['month'] == entry['month'] and ((clientIdDict[afID]['entity']!='BV' and entry['entity']=='BV') or ((clientIdDict[afID]['entity']=='EX' or clientIdDict[afID]['entity']=='CN') and entry['entity']=='PR') or (clientIdDict[afID]['entity']=='EX' and entry['entity']=='CN')):
-                            clientIdDict[afID] = {'id':clientID,'month':entry['month'],'entity':entry['entity']}
-                else:
-                    clientIdDict[afID] = {'id':clientID,'month':entry['month'],'entity':entry['entity']}
-      
-                key = (entry["month"], id, afID)
-                revenueByDateAndAccountName[key] += amount # Increment if there is a positive value for an account that belongs to this client
-        
-
-    # Now that we have recurring revenue at the account level, collapse to the top parent level within entities
-    # Note - this nested loop is also disgustingly inefficient.  "Look away, I'm hideous!!!" - Kramer
-    for client in uniqueClientList:
-        for acct_key in revenueByDateAndAccountName.keys():
-            if acct_key[2]==client:
-              key = (acct_key[0],acct_key[2])
-              if revenueByDateAndAccountName[acct_key]>0.1:
-                  revenueByDateAndClientTopName[key] += 1
-
-    # Construct output dictionary
-    uniqueClientList.sort() # It's important that these lists be sorted correctly for the following code to work correctly
-    uniqueDateList.sort()
-    outDataDict = {} # {ClientName : {Date1:revenueBool1, Date2:revenueBool2, ...}}
-    
-    for i in range(0,len(uniqueClientList)):    # Loop through the "rows" of the eventual output data - customers
-        clientRevDict = defaultdict(lambda: 0)  # {Date1:revenueBool1, Date2:revenueBool2, ...} - default at 0
-
-        for j in range(0,len(uniqueDateList)):  # Loop through the "columns" of the eventual output data - revenue dates
-            key = (uniqueDateList[j],uniqueClientList[i])
-
-            # Update revenue flags for this client
-            if revenueByDateAndClientTopName[key] > 0:
-                clientRevDict[uniqueDateList[j]] = 1
-            else:
-                clientRevDict[uniqueDateList[j]] = 0
-
-        # Correct for adjustments - form Date1 = 1, Date2 = 0, Date3 = 1. Often occurs at the end of a financial period when accounts are trued up.
-        UpDownUpCorrection = {}
-        for j in range(0,len(uniqueDateList)):  # Loop through the "columns" of the eventual output data - revenue dates
-            UpDownUpCorrection[uniqueDateList[j]] = clientRevDict[uniqueDateList[j]] # Default the value to the simple revenue boolean
-            # Update the values based on the up/down criteria where applicable
-            if j >= 1 and j < len(uniqueDateList)-1:
-                if clientRevDict[uniqueDateList[j]]==0 and clientRevDict[uniqueDateList[j-1]]==1 and clientRevDict[uniqueDateList[j+1]]==1:
-                    UpDownUpCorrection[uniqueDateList[j]] = 1
-
-        # Update the row dict                
-        outDataDict[uniqueClientList[i]] = UpDownUpCorrection
-
-        # Add overrides
-        if overrideDict.has_key(uniqueClientList[i]): # Does the override file have this client?  If so, continue
-            for date in outDataDict[uniqueClientList[i]].keys():
-                if overrideDict[uniqueClientList[i]].has_key(date): # Does the override file have this date for this client?  If so, continue.
-                    if overrideDict[uniqueClientList[i]][date] != -1: # Does the override file have an override value for this date/client?  If so, update the value. (-1 means the value was blank)
-                        outDataDict[uniqueClientList[i]][date] = overrideDict[uniqueClientList[i]][date]
-        
-    # Adjust for clients in the override file that may not have ever had revenue - added for inclusion of some Shopzilla gains 12/2012
-    # This is yet another annoying nested loop that will have a long run time...
-    for afid in overrideDict:
-        if afid not in outDataDict: # First, identify override clients that have never had revenue & apply override value
-            temp_dict = {}
-            for date in overrideDict[afid]:
-                if overrideDict[afid][date] == 1: 
-                    temp_dict[date] = 1
-                else:
-                    temp_dict[date] = 0
-            outDataDict[afid] = temp_dict
-            for cust_id in customersByID: # Second, find an arbitrary client ID for the identified account family ids.
-                if afid in clientIdDict or customersByID[cust_id]["afID"] != afid:
-                    continue
-                clientIdDict[afid]={'id':cust_id,'entity':customersByID[cust_id]['entity']}
-         
-    return [outDataDict, clientIdDict]        
+    # Combine revenue entries with express data (note, express data is just flag but that shouldn't be a problem) and flag current clients by account family and month (see fdbCurrentClients)
+    return fdbCurrentClients.identifyCurrentClients(itertools.chain(revenueEntries, expressRevenue), customersByID, overrideList)
 
 
 
@@ -1125,6 +1474,24 @@ def outputCumulativeBookings(entries, filename):
 
     outfile.close()
 
+# Cumulative bookings spans (getMonthlyCumulativeASFEntries in 'spans' mode), one row for each run of months over which a client and product's ASF held
+def outputCumulativeBookingSpans(entries, filename):
+    outfile = open(filename, "wb")
+    writer = csv.writer(outfile, delimiter='|', quotechar='"', quoting=csv.QUOTE_ALL)
+    writer.writerow(["Valid From", "Valid To", "Product", "Client", "ASF"])
+
+    for entry in entries:
+        outrow = [entry["validFrom"].strftime("%Y%m%d"),
+                  entry["validTo"].strftime("%Y%m%d"),
+                  entry["itemID"],
+                  entry["clientID"],
+                  entry["asf"]
+                  ]
+
+        writer.writerow(outrow)
+
+    outfile.close()
+
 def outputIncrementalBookings(entries, filename):
     outfile = open(filename, "wb")
     writer = csv.writer(outfile, delimiter='|', quotechar='"', quoting=csv.QUOTE_ALL)
@@ -1311,8 +1678,14 @@ def outputImpMiDate(entries, filename):
 
     outfile.close()
 
-def outputClientMappingFile(entries):
-    filename = r"c:\Projects\fdb\accountFamilyMapping"+"\\"+str(today.year)+"."+str(today.month).zfill(2)+"."+str(today.day).zfill(2)+"_AF mapping file.csv"
+# With a mapping store, the entries are upserted into the store (only changed mappings are written, as a new version) and the store is written out to the folder's working mapping file instead of a new dated file
+def outputClientMappingFile(entries, folder=accountFamilyMappingFolder, mappingStore=None):
+    if mappingStore is not None:
+        fdbMappingStore.upsertMappings(mappingStore, [fdbMappingStore.customerMapping(entries[key]) for key in entries], "Extract run")
+        fdbMappingStore.exportMappingFile(mappingStore, os.path.join(folder, fdbMappingStore.workingMappingFilename))
+        return
+
+    filename = os.path.join(folder, str(today.year)+"."+str(today.month).zfill(2)+"."+str(today.day).zfill(2)+"_AF mapping file.csv")
     outfile = open(filename, "wb")
     writer = csv.writer(outfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
     writer.writerow(["NSID", "Child name", "Parent name", "AFID", "CIQ ID", "BU", "is_fortune500", "is_ir500","CIQ Ult Parent", "Customer origination"])
@@ -0,0 +1,297 @@
+# Benchmark suite for the fdb pipeline.
+# Generates fdbSynthetic data sets of increasing size and times each NetSuiteMod stage on them - the readers and Net Suite pulls, the combine/fix up/computation stages and the output writers.
+# Every stage records seconds, rows processed, rows/sec and peak memory.  Across sizes a power law (seconds ~ rows^k) is fitted per stage, so a stage that has gone quadratic shows up as k well above 1.
+# Results can be saved as a baseline (JSON); later runs are compared against it and any stage whose rows/sec falls by more than the tolerance, or whose scaling exponent grows, is flagged as a regression.
+# Each size runs in its own process so peak memory of one size does not carry into the next.
+#
+# Usage: python fdbBenchmark.py [--sizes 100,200,400,800] [--folder F] [--baseline FILE] [--save-baseline] [--tolerance 0.25] [--skip stage,stage]
+
+import argparse
+import gc
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import date
+from timeit import default_timer
+import fdbPool
+import fdbSynthetic
+
+defaultSizes = [100, 200, 400, 800]
+baselineFile = fdbPool.getSetting('Paths', 'benchmark_baseline', "../settings/fdb_benchmark_baseline.json")
+defaultTolerance = 0.25
+minComparableSeconds = 0.05 # Stages quicker than this are too noisy to compare or fit
+superlinearExponent = 1.3   # Fitted exponents above this are reported as superlinear
+exponentTolerance = 0.3     # Growth in a stage's exponent over the baseline that counts as a regression
+stageTimeLimit = 120        # A stage slower than this at one size is skipped at the larger sizes
+
+skipped = object()
+
+''''''''''''''' Measurement '''''''''''''''
+# Resets the process' peak memory mark so the next reading covers one stage only (Linux; elsewhere the peak is for the process so far)
+def resetPeakMemory():
+    try:
+        outfile = open("/proc/self/clear_refs", "w")
+        outfile.write("5")
+        outfile.close()
+    except (IOError, OSError):
+        pass
+
+# Peak resident memory of this process in KB, or None if it cannot be read on this platform
+def peakMemoryKB():
+    try:
+        for line in open("/proc/self/status"):
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset // 1024
+    except (ImportError, AttributeError):
+        return None
+
+class StageTimer(object):
+    """ Runs pipeline stages and records their timings in results {stage: {seconds, rows, rowsPerSecond, peakKB}}.
+    A stage named in skipStages, or given the result of a skipped stage, is not run and returns skipped. """
+
+    def __init__(self, skipStages=()):
+        self.skipStages = set(skipStages)
+        self.results = {}
+
+    ''' Times function(*args).  rows is the number of rows the stage handles, or a function computing it from the stage's result. '''
+    def run(self, name, rows, function, *args):
+        if name in self.skipStages or [arg for arg in args if arg is skipped]:
+            self.results[name] = {"skipped": True}
+            return skipped
+        gc.collect()
+        resetPeakMemory()
+        start = default_timer()
+        result = function(*args)
+        seconds = default_timer() - start
+        if callable(rows):
+            rows = rows(result)
+        self.results[name] = {"seconds": seconds,
+                              "rows": rows,
+                              "rowsPerSecond": rows/seconds if seconds > 0 else None,
+                              "peakKB": peakMemoryKB()
+                              }
+        return result
+
+''''''''''''''' Pipeline '''''''''''''''
+# Override list in the form grabOverrides returns, forcing a few account families on or off for a few months
+def syntheticOverrides(customersByID):
+    overrideDict = {}
+    afIDs = sorted(set([customer["afID"] for customer in customersByID.values()]))
+    for afID in afIDs[::25]:
+        overrideDict[afID] = {date(2012, 1, 1): 1, date(2012, 2, 1): -1, date(2012, 3, 1): 0}
+    entitiesToExclude = [str(customerID) for customerID in sorted(customersByID.keys())[::50]]
+    return [overrideDict, entitiesToExclude]
+
+''' Runs the extract's stages in the order netsuiteExtract does, against the data set named by FDB_SETTINGS.
+Payment and billing are pulled in full (no state store) and the query and input caches are off, so every run does the same work. '''
+def runPipeline(timer):
+    import NetSuiteMod
+    import fdbBookingSpans
+    import fdbInputCache
+    fdbInputCache.cacheEnabled = False
+
+    outputFolder = fdbPool.getSetting('Paths', 'output_folder')
+    legacyFolder = fdbPool.getSetting('Paths', 'legacy_folder')
+    mappingFolder = fdbPool.getSetting('Paths', 'account_family_mapping_folder')
+    stage = timer.run
+
+    # Readers
+    idMappingList = stage("getIDMappingFile", lambda result: len(result[0]), NetSuiteMod.getIDMappingFile, mappingFolder)
+    entityOverrides = stage("getEntityOverrideFile", len, NetSuiteMod.getEntityOverrideFile, fdbPool.getSetting('Paths', 'entity_overrides_folder'))
+    NSrevenueEntries = stage("readRevenueInput", len, NetSuiteMod.readRevenueInput, fdbPool.getSetting('Paths', 'revenue_input'))
+    legacyRev, legacyBill, legacyClient, expressClient, expressRevenue = stage("readLegacyFiles", lambda result: len(result[0]) + len(result[1]) + len(result[4]), NetSuiteMod.readLegacyFiles, os.path.join(legacyFolder, "Bible.csv"), os.path.join(legacyFolder, "Express.csv"))
+
+    # Net Suite pulls
+    cnxn = fdbPool.getNetsuiteConnection()
+    cursor = cnxn.cursor()
+    verticalsByID = stage("getNetsuiteVerticalIndex", len, NetSuiteMod.getNetsuiteVerticalIndex, cursor)
+    exchangeRatesByID = stage("getExchangeRateIndex", len, NetSuiteMod.getExchangeRateIndex, cursor)
+    NScustomersByID = stage("getNetsuiteCustomerIndex", len, NetSuiteMod.getNetsuiteCustomerIndex, cursor, verticalsByID)
+    itemsByID = stage("getNetsuiteItemsIndex", len, NetSuiteMod.getNetsuiteItemsIndex, cursor)
+    contractsByID = stage("getNetsuiteContractsIndex", len, NetSuiteMod.getNetsuiteContractsIndex, cursor, NScustomersByID, itemsByID)
+    paymentEntries, billingEntries = stage("getNetsuiteARTransactionEntries", lambda result: len(result[0]) + len(result[1]), lambda cursor, rates: NetSuiteMod.getNetsuiteARTransactionEntries(cursor, rates, serverAggregate=True), cursor, exchangeRatesByID)
+    stage("getNetsuiteRevenueEntries", len, NetSuiteMod.getNetsuiteRevenueEntries, cursor)
+    impRecords = stage("getNetsuiteImplementationRecords", lambda result: len(result[0]) + len(result[1]), NetSuiteMod.getNetsuiteImplementationRecords, cursor)
+    cursor.close()
+    cnxn.close()
+
+    # Combine, fix up and compute
+    customersByID = stage("combineCustomerIndicies", len, NetSuiteMod.combineCustomerIndicies, NScustomersByID, legacyClient, expressClient, idMappingList[0], idMappingList[1], idMappingList[2])
+    revenueEntries = stage("combineRevenue", len, NetSuiteMod.combineRevenue, NSrevenueEntries, legacyRev)
+    contractTimeline = stage("getContractTimeline", len, NetSuiteMod.getContractTimeline, contractsByID)
+    monthlyDealCount = stage("getMontlyDealCount", len(contractsByID), NetSuiteMod.getMontlyDealCount, contractTimeline)
+    firstBookingsByClientTopName = defaultdict(lambda:None)
+    firstBookingsByClientTopNameAndProductID = defaultdict(lambda:None)
+    stage("computeFirstBookings", len(contractsByID), NetSuiteMod.computeFirstBookings, contractTimeline, firstBookingsByClientTopName, firstBookingsByClientTopNameAndProductID)
+    goLiveDateByClientTopName = stage("computeClientGoLiveDates", len(revenueEntries), NetSuiteMod.computeClientGoLiveDates, revenueEntries, customersByID)
+    stage("fixupCustomerFirstBookingsAndCohorts", len(customersByID), NetSuiteMod.fixupCustomerFirstBookingsAndCohorts, customersByID, firstBookingsByClientTopName, goLiveDateByClientTopName)
+    stage("fixupContractTypes", len(contractsByID), NetSuiteMod.fixupContractTypes, contractTimeline, firstBookingsByClientTopName)
+    monthlyCumulativeBookings = stage("getMonthlyCumulativeASFEntries", len(contractsByID), NetSuiteMod.getMonthlyCumulativeASFEntries, contractTimeline)
+    monthlyIncrementalBookings = stage("getMonthlyIncrementalASFEntries", len(contractsByID), NetSuiteMod.getMonthlyIncrementalASFEntries, contractTimeline)
+    bookingSpans = stage("getMonthlyCumulativeASFEntries spans", len(contractsByID), NetSuiteMod.getMonthlyCumulativeASFEntries, contractTimeline, 'spans')
+    stage("checkBookingsView", len(bookingSpans[0]), fdbBookingSpans.checkBookingsView, bookingSpans[0], [month for month in contractTimeline.months if month <= date.today()])
+    connectionsOnlyIDs = stage("getConnectionsOnlyIDs", len(monthlyCumulativeBookings[1]), NetSuiteMod.getConnectionsOnlyIDs, monthlyCumulativeBookings[1])
+    customersByID = stage("fixUpConnectionsCustomer", len(customersByID), NetSuiteMod.fixUpConnectionsCustomer, customersByID, connectionsOnlyIDs, entityOverrides)
+    revenueEntries = stage("fixUpConnectionsRevenue", len(revenueEntries), NetSuiteMod.fixUpConnectionsRevenue, revenueEntries, connectionsOnlyIDs, entityOverrides)
+    clientList = stage("identifyCurrentClientsThroughTime", len(revenueEntries) + len(expressRevenue), NetSuiteMod.identifyCurrentClientsThroughTime, revenueEntries, customersByID, syntheticOverrides(customersByID), expressRevenue)
+
+    # Output writers
+    output = lambda name: os.path.join(outputFolder, name)
+    if clientList is not skipped:
+        stage("outputCurrentClientFactTable", sum([len(dates) for dates in clientList[0].values()]), NetSuiteMod.outputCurrentClientFactTable, clientList, output("fact_current_client.csv"))
+    stage("outputClientMappingFile", len(customersByID), NetSuiteMod.outputClientMappingFile, customersByID, outputFolder)
+    stage("outputCumulativeBookings", len(monthlyCumulativeBookings[0]), NetSuiteMod.outputCumulativeBookings, monthlyCumulativeBookings[0], output("fact_bookings.csv"))
+    stage("outputIncrementalBookings", len(monthlyIncrementalBookings), NetSuiteMod.outputIncrementalBookings, monthlyIncrementalBookings, output("fact_incremental_bookings.csv"))
+    stage("outputRevenue", len(revenueEntries), NetSuiteMod.outputRevenue, revenueEntries, output("fact_revenue.csv"))
+    stage("outputCustomers", len(customersByID), NetSuiteMod.outputCustomers, customersByID, output("dim_client.csv"))
+    stage("outputProducts", len(itemsByID), NetSuiteMod.outputProducts, itemsByID, output("dim_product.csv"))
+    stage("outputPayment", len(paymentEntries), NetSuiteMod.outputPayment, paymentEntries, output("fact_payment.csv"))
+    stage("outputBilling", len(billingEntries), NetSuiteMod.outputBilling, billingEntries, output("fact_billing.csv"))
+    stage("outputDealCount", len(monthlyDealCount), NetSuiteMod.outputDealCount, monthlyDealCount, output("fact_dealcount.csv"))
+    stage("outputImp", len(impRecords[0]), NetSuiteMod.outputImp, impRecords[0], output("impEntries.csv"))
+    return timer.results
+
+''''''''''''''' Suite '''''''''''''''
+# Generates the data set for one size and runs the pipeline over it in a child process.  Returns that size's stage results.
+def benchmarkSize(folder, size, skipStages):
+    dataFolder = os.path.join(folder, "size_" + str(size))
+    settingsFile = fdbSynthetic.generate(dataFolder, fdbSynthetic.SyntheticSettings(customers=size))
+    resultsFile = os.path.join(dataFolder, "stage_results.json")
+    environment = dict(os.environ)
+    environment["FDB_SETTINGS"] = os.path.abspath(settingsFile)
+    command = [sys.executable, os.path.abspath(__file__), "--worker", resultsFile, "--skip", ",".join(sorted(skipStages))]
+    subprocess.check_call(command, env=environment, cwd=os.path.dirname(os.path.abspath(__file__)))
+    infile = open(resultsFile, "rb")
+    try:
+        return json.load(infile)
+    finally:
+        infile.close()
+
+# Least squares slope of log(seconds) against log(rows) - the k in seconds ~ rows^k.  None if there are fewer than three usable sizes.
+def fitExponent(points):
+    points = [(math.log(rows), math.log(seconds)) for (rows, seconds) in points if rows > 0 and seconds >= minComparableSeconds]
+    if len(set([x for (x, y) in points])) < 3:
+        return None
+    meanX = sum([x for (x, y) in points])/len(points)
+    meanY = sum([y for (x, y) in points])/len(points)
+    return sum([(x-meanX)*(y-meanY) for (x, y) in points])/sum([(x-meanX)**2 for (x, y) in points])
+
+''' Runs every size and returns {"sizes": [...], "stages": {stage: {size: result}}, "exponents": {stage: k}}.
+Once a stage runs past stageTimeLimit it is skipped (with everything built from it) at the larger sizes. '''
+def runSuite(folder, sizes, skipStages=()):
+    skipStages = set(skipStages)
+    stages = {}
+    for size in sorted(sizes):
+        print "Benchmarking " + str(size) + " customers..."
+        results = benchmarkSize(folder, size, skipStages)
+        for (name, result) in results.items():
+            stages.setdefault(name, {})[str(size)] = result
+            if result.get("seconds", 0) > stageTimeLimit:
+                print "    " + name + " took " + str(int(result["seconds"])) + "s, skipping it at larger sizes"
+                skipStages.add(name)
+
+    exponents = {}
+    for (name, bySize) in stages.items():
+        exponents[name] = fitExponent([(result["rows"], result["seconds"]) for result in bySize.values() if not result.get("skipped")])
+    return {"sizes": sorted(sizes), "stages": stages, "exponents": exponents}
+
+# Returns a list of regression messages comparing run against baseline.  Exponents are only compared when both were fitted over the same sizes.
+def findRegressions(run, baseline, tolerance):
+    regressions = []
+    for (name, bySize) in sorted(run["stages"].items()):
+        for (size, result) in sorted(bySize.items(), key=lambda item: int(item[0])):
+            base = baseline["stages"].get(name, {}).get(size)
+            if not base or base.get("skipped") or result.get("skipped") or base["seconds"] < minComparableSeconds:
+                continue
+            if result["rowsPerSecond"] < base["rowsPerSecond"]*(1-tolerance):
+                regressions.append("%s at %s customers: %.0f rows/sec, baseline %.0f" % (name, size, result["rowsPerSecond"], base["rowsPerSecond"]))
+        if run["sizes"] != baseline["sizes"]:
+            continue
+        exponent = run["exponents"].get(name)
+        baseExponent = baseline["exponents"].get(name)
+        if exponent is not None and baseExponent is not None and exponent > baseExponent + exponentTolerance:
+            regressions.append("%s scaling exponent %.2f, baseline %.2f" % (name, exponent, baseExponent))
+    return regressions
+
+def printReport(run):
+    sizes = [str(size) for size in run["sizes"]]
+    print
+    print "%-36s" % "Stage" + "".join(["%24s" % (size + " customers") for size in sizes]) + "%10s" % "k"
+    for (name, bySize) in sorted(run["stages"].items()):
+        line = "%-36s" % name
+        for size in sizes:
+            result = bySize.get(size)
+            if not result or result.get("skipped"):
+                line += "%24s" % "skipped"
+            else:
+                peak = "%.0fMB" % (result["peakKB"]/1024.0) if result["peakKB"] else "?"
+                line += "%24s" % ("%.3fs %9.0f/s %s" % (result["seconds"], result["rowsPerSecond"] or 0, peak))
+        exponent = run["exponents"].get(name)
+        line += "%10s" % ("-" if exponent is None else "%.2f" % exponent)
+        if exponent is not None and exponent > superlinearExponent:
+            line += "  SUPERLINEAR"
+        print line
+
+def saveJson(data, filename):
+    folder = os.path.dirname(filename)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    outfile = open(filename, "wb")
+    json.dump(data, outfile, indent=1, sort_keys=True)
+    outfile.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each fdb pipeline stage on synthetic data sets of increasing size.")
+    parser.add_argument("--sizes", default=",".join([str(size) for size in defaultSizes]), help="comma separated customer counts")
+    parser.add_argument("--folder", help="where to generate the data sets (kept afterwards); a temporary folder by default")
+    parser.add_argument("--baseline", default=baselineFile)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=defaultTolerance, help="fractional drop in rows/sec that counts as a regression")
+    parser.add_argument("--skip", default="", help="comma separated stages not to run")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    skipStages = [name for name in args.skip.split(",") if name]
+
+    if args.worker:
+        saveJson(runPipeline(StageTimer(skipStages)), args.worker)
+        sys.exit(0)
+
+    folder = args.folder or tempfile.mkdtemp(prefix="fdb_benchmark_")
+    try:
+        run = runSuite(folder, [int(size) for size in args.sizes.split(",")], skipStages)
+    finally:
+        if not args.folder:
+            shutil.rmtree(folder, ignore_errors=True)
+    printReport(run)
+
+    if args.save_baseline:
+        saveJson(run, args.baseline)
+        print "Baseline saved to " + args.baseline
+    elif os.path.exists(args.baseline):
+        infile = open(args.baseline, "rb")
+        regressions = findRegressions(run, json.load(infile), args.tolerance)
+        infile.close()
+        if regressions:
+            print
+            print "Regressions against " + args.baseline + ":"
+            for regression in regressions:
+                print "    " + regression
+            sys.exit(1)
+        print "No regressions against " + args.baseline
+    else:
+        print "No baseline at " + args.baseline + " - run with --save-baseline to create one"
@@ -0,0 +1,84 @@
+# Cumulative bookings as changes and spans: a client and product's cumulative ASF stays the same from month to month until one of its contracts changes it,
+# so rather than a row for every client and product in every month (fact_bookings.csv) the bookings can be written as the rows where the ASF changed,
+# or as spans of months over which it held (valid from / valid to).  densifyBookings gives the month by month rows back from either, for whatever needs them.
+# Spans run over calendar months, so the fact_bookings_by_month view in tables.sql can expand them against dim_date; checkBookingsView runs that view in SQLite to check it.
+
+import operator
+import os
+import sqlite3
+from datetime import timedelta
+from fdbUtils import dateToDateKey, nextMonth
+
+tablesFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tables.sql")
+
+# First of the calendar month before month
+def previousMonth(month):
+    return (month.replace(day=1) - timedelta(days=1)).replace(day=1)
+
+# (itemID, clientID) of a bookings entry or span
+def entryKey(entry):
+    return (entry["itemID"], entry["clientID"])
+
+''' Spans {"itemID", "clientID", "validFrom", "validTo", "asf"} of change entries (NetSuiteMod.getMonthlyCumulativeASFEntries in 'changes' mode), months being the months the dense entries have rows for, in order.
+A span runs from its change's month to the calendar month before the client and product's next change, or to the last month.  Spans come in the order of their changes. '''
+def bookingSpans(changes, months):
+    if not months:
+        return []
+    lastMonth = months[-1]
+    spans = []
+    openSpans = {}
+    for entry in changes:
+        key = entryKey(entry)
+        if key in openSpans:
+            openSpans[key]["validTo"] = previousMonth(entry["month"])
+        span = {"itemID": entry["itemID"], "clientID": entry["clientID"], "validFrom": entry["month"], "validTo": lastMonth, "asf": entry["asf"]}
+        openSpans[key] = span
+        spans.append(span)
+    return spans
+
+''' Yields the dense entries {"itemID", "clientID", "month", "asf"} (as getMonthlyCumulativeASFEntries gives them in 'dense' mode) for the months of months, in month order, from spans or change entries.
+months can be the months with contracts, as the dense entries have, or every calendar month.  Months are walked in order keeping the spans that hold, so only one month's entries are made at a time. '''
+def densifyBookings(entries, months):
+    if entries and "month" in entries[0]:
+        entries = bookingSpans(entries, months)
+    spans = sorted(entries, key=operator.itemgetter("validFrom"))
+    position = 0
+    holding = []
+    for month in months:
+        while position < len(spans) and spans[position]["validFrom"] <= month:
+            holding.append(spans[position])
+            position += 1
+        holding = [span for span in holding if span["validTo"] >= month]
+        for span in holding:
+            yield {"itemID": span["itemID"], "clientID": span["clientID"], "month": month, "asf": span["asf"]}
+
+# The CREATE VIEW statement of fact_bookings_by_month in tables.sql
+def bookingsViewStatement():
+    for statement in open(tablesFile, "rb").read().split(";"):
+        if "CREATE VIEW fact_bookings_by_month" in statement:
+            return statement
+    raise ValueError("There is no fact_bookings_by_month view in " + tablesFile)
+
+''' Checks the fact_bookings_by_month view against densifyBookings: loads the spans and a dim_date (first and middle day of every calendar month from the first of months to the last) into SQLite,
+runs the view from tables.sql and compares its rows with the spans densified over the calendar months.  Raises ValueError if they differ. '''
+def checkBookingsView(spans, months):
+    if not months:
+        return
+    calendarMonths = [months[0]]
+    while calendarMonths[-1] < months[-1]:
+        calendarMonths.append(nextMonth(calendarMonths[-1]))
+    store = sqlite3.connect(":memory:")
+    try:
+        store.execute("CREATE TABLE fact_bookings_span (client_id TEXT, valid_from_key INTEGER, valid_to_key INTEGER, product_id INTEGER, asf REAL)")
+        store.execute("CREATE TABLE dim_date (date_key INTEGER, month_key INTEGER)")
+        store.executemany("INSERT INTO fact_bookings_span VALUES (?, ?, ?, ?, ?)", [(str(span["clientID"]), dateToDateKey(span["validFrom"]), dateToDateKey(span["validTo"]), span["itemID"], span["asf"]) for span in spans])
+        store.executemany("INSERT INTO dim_date VALUES (?, ?)", [(dateToDateKey(month) + day, dateToDateKey(month)//100) for month in calendarMonths for day in (0, 14)])
+        store.execute(bookingsViewStatement())
+        viewRows = set([tuple(row) for row in store.execute("SELECT client_id, date_key, product_id, asf FROM fact_bookings_by_month")])
+    finally:
+        store.close()
+    expectedRows = set([(str(entry["clientID"]), dateToDateKey(entry["month"]), entry["itemID"], entry["asf"]) for entry in densifyBookings(spans, calendarMonths)])
+    if viewRows != expectedRows:
+        missing = sorted(expectedRows - viewRows)
+        extra = sorted(viewRows - expectedRows)
+        raise ValueError("fact_bookings_by_month differs from the densified spans: " + str(len(missing)) + " rows missing (e.g. " + str(missing[:3]) + "), " + str(len(extra)) + " extra (e.g. " + str(extra[:3]) + ")")
@@ -0,0 +1,107 @@
+# On-disk cache of Net Suite query results.
+# Each entry holds one query's result set stored by column (zlib compressed pickle), keyed by a hash of the SQL text and its parameters.
+# An entry is only used if a cheap fingerprint query (row count, max id, max last modified date) still returns what it returned when the entry was written; otherwise the query is rerun and the entry replaced.
+# The cache is off unless cacheEnabled is set, and keeps its folder under cacheMaxBytes by evicting the least recently used entries.
+
+import cPickle
+import errno
+import hashlib
+import os
+import threading
+import zlib
+from itertools import izip
+import fdbPool
+import fdbQueryLog
+
+cacheEnabled = False
+cacheFolder = fdbPool.getSetting('Paths', 'query_cache_folder', "../cache/netsuite")
+cacheMaxBytes = 2*1024*1024*1024
+cacheLock = threading.Lock() # Entries are written and evicted from the concurrent pull threads
+
+def cacheKey(query, params):
+    return hashlib.sha1(query + "\0" + repr(tuple(params or ()))).hexdigest()
+
+def cachePath(key):
+    return os.path.join(cacheFolder, key + ".nsc")
+
+# Runs the fingerprint query and returns its first row as a tuple
+def getFingerprint(cursor, fingerprintQuery):
+    stats = fdbQueryLog.QueryStats(fingerprintQuery)
+    cursor.execute(fingerprintQuery)
+    stats.executed()
+    return tuple(fdbQueryLog.fetchOne(cursor, stats))
+
+# Returns an iterator over the cached rows of the query, or None if there is no entry or its fingerprint no longer matches
+def loadRows(query, params, fingerprint):
+    path = cachePath(cacheKey(query, params))
+    if not os.path.exists(path):
+        return None
+    infile = open(path, "rb")
+    try:
+        entry = cPickle.loads(zlib.decompress(infile.read()))
+    finally:
+        infile.close()
+    if entry["query"] != query or entry["fingerprint"] != fingerprint:
+        return None
+    os.utime(path, None) # Mark as recently used for eviction
+    return izip(*entry["columns"])
+
+''' Passes rows through unchanged while collecting them by column, then writes the cache entry once the last row has been read.
+If the caller stops early nothing is written. '''
+def storeRows(query, params, fingerprint, columnCount, rows):
+    columns = [[] for i in range(columnCount)]
+    for row in rows:
+        for i in range(columnCount):
+            columns[i].append(row[i])
+        yield row
+
+    if not os.path.isdir(cacheFolder):
+        os.makedirs(cacheFolder)
+    entry = {"query": query, "params": tuple(params or ()), "fingerprint": fingerprint, "columns": columns}
+    path = cachePath(cacheKey(query, params))
+    outfile = open(path + ".tmp", "wb")
+    outfile.write(zlib.compress(cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL), 1))
+    outfile.close()
+    with cacheLock:
+        removeEntry(path)
+        os.rename(path + ".tmp", path)
+    evictEntries()
+
+# Deletes an entry file, if it is still there (another process sharing the folder may have evicted it already)
+def removeEntry(path):
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+# Deletes the least recently used entries until the cache folder fits in cacheMaxBytes
+def evictEntries():
+    with cacheLock:
+        entries = []
+        totalBytes = 0
+        for name in os.listdir(cacheFolder):
+            if not name.endswith(".nsc"):
+                continue
+            path = os.path.join(cacheFolder, name)
+            try:
+                stat = os.stat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            totalBytes += stat.st_size
+        entries.sort()
+        for (usedTime, size, path) in entries:
+            if totalBytes <= cacheMaxBytes:
+                break
+            removeEntry(path)
+            totalBytes -= size
+
+# Deletes every entry
+def clearCache():
+    if os.path.isdir(cacheFolder):
+        for name in os.listdir(cacheFolder):
+            if name.endswith(".nsc"):
+                os.remove(os.path.join(cacheFolder, name))
@@ -0,0 +1,66 @@
+# Contract timeline: the contracts of a run (NetSuiteMod.getNetsuiteContractsIndex) sorted by effective date and grouped once, for all of the bookings computations.
+# The sorted contracts are cut into month buckets by start offsets, and indexed by client, by product and by client and product (lists of positions in the sorted contracts, so each group is in date order too).
+# The computations used to sort and bucket the contracts themselves, each one again.
+
+import operator
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date
+
+class ContractTimeline(object):
+    """ Contracts sorted by effectiveDate (ties in contractsByID order), with:
+    months - the months with contracts, ascending (first of the month); the contracts of months[i] are contracts[monthStarts[i]:monthStarts[i+1]] (monthStarts ends with len(contracts))
+    byClient, byProduct, byClientAndProduct - positions in contracts by customer nsID, item nsID and (customer nsID, item nsID), each ascending.
+    The contract dictionaries are the ones in contractsByID, so changes made to them (e.g. contractType) are seen through the timeline. """
+
+    def __init__(self, contractsByID):
+        self.contracts = sorted(contractsByID.values(), key=operator.itemgetter('effectiveDate'))
+        self.months = []
+        self.monthStarts = []
+        self.byClient = defaultdict(list)
+        self.byProduct = defaultdict(list)
+        self.byClientAndProduct = defaultdict(list)
+        for (position, contract) in enumerate(self.contracts):
+            contractDate = contract['effectiveDate']
+            month = date(contractDate.year, contractDate.month, 1)
+            if not self.months or self.months[-1] != month:
+                self.months.append(month)
+                self.monthStarts.append(position)
+            clientID = contract['customer']['nsID']
+            itemID = contract['item']['nsID']
+            self.byClient[clientID].append(position)
+            self.byProduct[itemID].append(position)
+            self.byClientAndProduct[(clientID, itemID)].append(position)
+        self.monthStarts.append(len(self.contracts))
+        self.monthPositions = dict([(month, i) for (i, month) in enumerate(self.months)])
+
+    def __len__(self):
+        return len(self.contracts)
+
+    # The contracts of the month (first of the month), in date order
+    def monthContracts(self, month):
+        i = self.monthPositions.get(month)
+        if i is None:
+            return []
+        return self.contracts[self.monthStarts[i]:self.monthStarts[i+1]]
+
+    # Yields (month, contracts of the month) for each month with contracts up to and including until (every month if until is None), in month order
+    def monthBuckets(self, until=None):
+        for (i, month) in enumerate(self.months):
+            if until is not None and month > until:
+                break
+            yield (month, self.contracts[self.monthStarts[i]:self.monthStarts[i+1]])
+
+    # The contracts of the months up to and including until, in date order (a prefix of contracts)
+    def contractsUntil(self, until):
+        return self.contracts[:self.monthStarts[bisect_right(self.months, until)]]
+
+    # The contracts at the positions of a group (e.g. self.byClient[clientID]), in date order
+    def groupContracts(self, positions):
+        return [self.contracts[position] for position in positions]
+
+# The timeline of contracts - contracts itself if it is one already, otherwise one built from contracts as contractsByID
+def timelineOf(contracts):
+    if isinstance(contracts, ContractTimeline):
+        return contracts
+    return ContractTimeline(contracts)
@@ -0,0 +1,135 @@
+# Current client engine: flags, for every account family (AFID) and revenue month, whether the family was a current (recurring revenue) client.
+# The revenue entries are read once, summing recurring revenue by month and account into a hash table and noting each account's latest entity on the way.
+# The flags are then a client x month matrix: set where an account of the family had more than 0.1 of recurring revenue in the month, with one month dips (1, 0, 1) filled in.
+# Overrides from the override workbook replace single flags, and every family gets a representative client id, preferring BV over PR over CN over EX accounts in its latest month.
+# With NumPy the matrix is a boolean array and the dip filling a single array expression; without it, rows of bytes.  The results are those of the nested loops the engine replaces,
+# down to which account represents a family when several tie.
+
+from collections import defaultdict
+from itertools import izip
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+currentRevenueThreshold = 0.1 # Recurring revenue of an account above this makes its family current in the month
+
+# True if an entry of newEntity in the same month takes over as a family's representative from one of entity (BV over PR, CN and EX; PR over CN and EX; CN over EX)
+def outranks(newEntity, entity):
+    return (entity != 'BV' and newEntity == 'BV') or ((entity == 'EX' or entity == 'CN') and newEntity == 'PR') or (entity == 'EX' and newEntity == 'CN')
+
+''' One pass over the revenue entries.  Only recurring entries with an amount, for clients in customersByID that are not excluded, count.
+Returns [accountRevenue {(month, clientID, afID): amount}, latestEntities {clientID: [latest month, entities of that month's entries in entry order]}, clientIDs, months, afIDs],
+clientIDs being the set of every entry's client id (counting or not) - the order the accounts were visited in before, which decides ties between representatives. '''
+def scanRevenue(revenueEntries, customersByID, entitiesToExclude):
+    excluded = set(entitiesToExclude)
+    accountRevenue = defaultdict(float)
+    latestEntities = {}
+    clientIDs = set()
+    months = set()
+    afIDs = set()
+    for entry in revenueEntries:
+        clientID = entry["clientID"]
+        clientIDs.add(clientID)
+        if entry["recurring"] != 1 or clientID in excluded:
+            continue
+        amount = entry["amount"]
+        if clientID != -1 and amount and clientID in customersByID:
+            month = entry["month"]
+            afID = customersByID[clientID]["afID"]
+            months.add(month)
+            afIDs.add(afID)
+            accountRevenue[(month, clientID, afID)] += amount
+
+            # Only the account's latest month can decide its family's representative
+            latest = latestEntities.get(clientID)
+            if latest is None or latest[0] < month:
+                latestEntities[clientID] = [month, [entry["entity"]]]
+            elif latest[0] == month and latest[1][-1] != entry["entity"]:
+                latest[1].append(entry["entity"])
+    return [accountRevenue, latestEntities, clientIDs, months, afIDs]
+
+''' Representative client of each family, {afID: {'id', 'month', 'entity'}}: the account with the family's latest revenue month, ties going to the higher ranked entity (see outranks)
+and then to the account visited first.  Accounts are visited in the order of clientIDs, each one's entries in entry order. '''
+def representativeClients(clientIDs, latestEntities, customersByID):
+    clientIdDict = {}
+    for clientID in clientIDs:
+        latest = latestEntities.get(clientID)
+        if latest is None:
+            continue
+        month, entities = latest
+        afID = customersByID[clientID]["afID"]
+        for entity in entities:
+            current = clientIdDict.get(afID)
+            if current is None or current['month'] < month or (current['month'] == month and outranks(entity, current['entity'])):
+                clientIdDict[afID] = {'id': clientID, 'month': month, 'entity': entity}
+    return clientIdDict
+
+# Client x month revenue flags, one row per client in clients and one column per month in months: set where an account of the client has more than currentRevenueThreshold of recurring revenue
+def revenueFlags(accountRevenue, clients, months):
+    clientRows = dict([(client, i) for (i, client) in enumerate(clients)])
+    monthColumns = dict([(month, j) for (j, month) in enumerate(months)])
+    cells = [(clientRows[afID], monthColumns[month]) for ((month, clientID, afID), amount) in accountRevenue.iteritems() if amount > currentRevenueThreshold]
+    if numpy is not None:
+        flags = numpy.zeros((len(clients), len(months)), dtype=bool)
+        if cells:
+            rows, columns = zip(*cells)
+            flags[list(rows), list(columns)] = True
+        return flags
+    flags = [bytearray(len(months)) for client in clients]
+    for (row, column) in cells:
+        flags[row][column] = 1
+    return flags
+
+# Fills in one month dips: a month without revenue between two months with revenue is flagged (the pattern left when accounts are trued up at the end of a period).  Looks at the unfilled flags only.
+def fillRevenueDips(flags):
+    if numpy is not None:
+        filled = flags.copy()
+        filled[:, 1:-1] |= flags[:, :-2] & ~flags[:, 1:-1] & flags[:, 2:]
+        return filled
+    filled = [bytearray(row) for row in flags]
+    for (row, filledRow) in izip(flags, filled):
+        for j in range(1, len(row)-1):
+            if not row[j] and row[j-1] and row[j+1]:
+                filledRow[j] = 1
+    return filled
+
+# The flag matrix as {client: {month: 0 or 1}}
+def flagDictionaries(flags, clients, months):
+    rows = flags.astype(int).tolist() if numpy is not None else [list(row) for row in flags]
+    return dict([(client, dict(izip(months, row))) for (client, row) in izip(clients, rows)])
+
+''' Applies the override workbook's flags, overrideDict {afID: {month: value}} (-1 where the workbook was blank), to outDataDict in place: a value replaces the flag of a month the client has a column for.
+Families in the workbook with no recurring revenue get a row of their own (1 where the workbook has 1, otherwise 0) and the first of their accounts in customersByID as representative. '''
+def applyOverrides(outDataDict, clientIdDict, overrideDict, customersByID):
+    firstCustomerByAFID = None
+    for (afID, overrides) in overrideDict.iteritems():
+        if afID in outDataDict:
+            flags = outDataDict[afID]
+            for (month, value) in overrides.iteritems():
+                if value != -1 and month in flags:
+                    flags[month] = value
+            continue
+        outDataDict[afID] = dict([(month, 1 if value == 1 else 0) for (month, value) in overrides.iteritems()])
+        if afID not in clientIdDict:
+            if firstCustomerByAFID is None:
+                firstCustomerByAFID = {}
+                for customerID in customersByID:
+                    firstCustomerByAFID.setdefault(customersByID[customerID]["afID"], customerID)
+            if afID in firstCustomerByAFID:
+                customerID = firstCustomerByAFID[afID]
+                clientIdDict[afID] = {'id': customerID, 'entity': customersByID[customerID]['entity']}
+
+''' Returns [outDataDict {afID: {month: current client flag}}, clientIdDict {afID: representative client}] for the revenue entries (NetSuite, legacy and Express alike).
+overrideList is [overrideDict, entitiesToExclude] as NetSuiteMod.grabOverrides returns it. '''
+def identifyCurrentClients(revenueEntries, customersByID, overrideList):
+    overrideDict, entitiesToExclude = overrideList
+    accountRevenue, latestEntities, clientIDs, months, afIDs = scanRevenue(revenueEntries, customersByID, entitiesToExclude)
+    clientIdDict = representativeClients(clientIDs, latestEntities, customersByID)
+
+    clients = sorted(afIDs)
+    months = sorted(months)
+    flags = fillRevenueDips(revenueFlags(accountRevenue, clients, months))
+    outDataDict = flagDictionaries(flags, clients, months)
+    applyOverrides(outDataDict, clientIdDict, overrideDict, customersByID)
+    return [outDataDict, clientIdDict]
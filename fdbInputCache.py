@@ -0,0 +1,72 @@
+# Compiled cache of the flat-file inputs (revenue input, legacy Bible and Express files, account family mapping and entity override files).
+# Each input is parsed from text once; what the reader returns is stored in binary form (cPickle, or typed arrays for the revenue input) and loaded from there while its source files are unchanged.
+# An entry records the path, size, modification time and SHA-1 of every source file it was built from and is only used if all of them still match, so a file that is edited, replaced or copied over is re-parsed.
+# The cache is on unless cacheEnabled is cleared, and lives in the input_cache_folder set in the Paths section of fdb.ini.
+
+import cPickle
+import hashlib
+import os
+import fdbPool
+
+cacheEnabled = True
+cacheFolder = fdbPool.getSetting('Paths', 'input_cache_folder', "../cache/inputs")
+formatVersion = 1 # Bump when a reader's output changes, so entries written by older code are not used
+hashBlockBytes = 4*1024*1024
+
+# Returns [absolute path, size, modification time, SHA-1 of the contents] for a source file
+def fileSignature(path):
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    digest = hashlib.sha1()
+    infile = open(path, "rb")
+    try:
+        while True:
+            block = infile.read(hashBlockBytes)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        infile.close()
+    return [path, stat.st_size, stat.st_mtime, digest.hexdigest()]
+
+def entryPath(kind, paths):
+    key = hashlib.sha1(kind + "\0" + "\0".join([os.path.abspath(path) for path in paths])).hexdigest()
+    return os.path.join(cacheFolder, kind + "_" + key + ".fic")
+
+''' Returns what parse() reads from the source files in paths, loading it from the cache while every source file is unchanged and otherwise parsing and storing it.
+kind names the reader (one entry is kept per kind and set of paths).  If expand is given, parse() returns the compiled form that is stored and expand(stored) builds the result from it.
+A result loaded from the cache is built afresh on every load, so callers are free to change it. '''
+def cachedInput(kind, paths, parse, expand=None):
+    if not cacheEnabled:
+        return expand(parse()) if expand else parse()
+    signatures = [fileSignature(path) for path in paths]
+    path = entryPath(kind, paths)
+    if os.path.exists(path):
+        infile = open(path, "rb")
+        try:
+            entry = cPickle.load(infile)
+        except Exception: # Unreadable or partly written entry; rebuild it
+            entry = None
+        finally:
+            infile.close()
+        if entry and entry["version"] == formatVersion and entry["signatures"] == signatures:
+            return expand(entry["data"]) if expand else entry["data"]
+
+    data = parse()
+    if not os.path.isdir(cacheFolder):
+        os.makedirs(cacheFolder)
+    entry = {"version": formatVersion, "kind": kind, "signatures": signatures, "data": data}
+    outfile = open(path + ".tmp", "wb")
+    cPickle.dump(entry, outfile, cPickle.HIGHEST_PROTOCOL)
+    outfile.close()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + ".tmp", path)
+    return expand(data) if expand else data
+
+# Deletes every entry
+def clearCache():
+    if os.path.isdir(cacheFolder):
+        for name in os.listdir(cacheFolder):
+            if name.endswith(".fic"):
+                os.remove(os.path.join(cacheFolder, name))
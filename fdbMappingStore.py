@@ -0,0 +1,279 @@
+# Local store for the account family mappings (NSID -> AFID, parent name, CIQ and BU details) and the entity overrides.
+# Both are kept in SQLite tables keyed (and so indexed) by NSID, and changed by upserts: only rows whose values differ are written.
+# Every batch of changes is recorded as a new version, and the row each change wrote (or deleted) is kept in a history table, so any mapping can be traced back to the run or file that set it.
+# New AFIDs are numbered from per-entity counters held in the store, in NSID order, and saved as soon as they are handed out, so a client keeps its AFID from run to run.
+# The dated mapping and override files are imported the first time they are seen (tracked by SHA-1); the mapping file is also written back out (one working copy, not a dated copy per run) for hand edits, which the next run picks up.
+# The store is at the mapping_store path in the Paths section of fdb.ini.
+
+import csv
+import os
+import sqlite3
+from collections import defaultdict
+from datetime import datetime
+import fdbInputCache
+import fdbPool
+from fdbUtils import *
+
+mappingStorePath = fdbPool.getSetting('Paths', 'mapping_store', "../settings/fdb_mappings.db")
+workingMappingFilename = "AF mapping file.csv"
+
+# (mapping dictionary key, column) pairs in mapping file order
+mappingFields = [('NSID', 'nsid'), ('ChildName', 'child_name'), ('ParentName', 'parent_name'), ('AFID', 'afid'), ('ciqID', 'ciq_id'), ('BU', 'bu'),
+                 ('isFortune500', 'is_fortune500'), ('isIr500', 'is_ir500'), ('ciqUltParent', 'ciq_ult_parent'), ('custOrigination', 'cust_origination')]
+mappingIntegerFields = ['isFortune500', 'isIr500']
+mappingHeaders = ["NSID", "Child name", "Parent name", "AFID", "CIQ ID", "BU", "is_fortune500", "is_ir500", "CIQ Ult Parent", "Customer origination"]
+overrideFields = [('clientID', 'client_id'), ('clientName', 'client_name'), ('entity', 'entity'), ('note', 'note')]
+
+# AFIDs are "AF-" and eight digits: BV numbers start at 00000000 and PR numbers at 10000000
+firstAFIDNumbers = {'BV': 0, 'PR': 10000000}
+
+def openMappingStore(path=None):
+    store = sqlite3.connect(path or mappingStorePath, timeout=60, detect_types=sqlite3.PARSE_DECLTYPES)
+    store.text_factory = str # Names are kept as the latin-1 bytes the mapping files hold
+    mappingColumns = ", ".join([column + (" INTEGER" if key in mappingIntegerFields else " TEXT") for (key, column) in mappingFields[1:]])
+    overrideColumns = ", ".join([column + " TEXT" for (key, column) in overrideFields[1:]])
+    store.execute("CREATE TABLE IF NOT EXISTS versions (version INTEGER PRIMARY KEY, created TIMESTAMP, source TEXT)")
+    store.execute("CREATE TABLE IF NOT EXISTS mappings (nsid TEXT PRIMARY KEY, " + mappingColumns + ", version INTEGER NOT NULL)")
+    store.execute("CREATE INDEX IF NOT EXISTS mappings_by_afid ON mappings (afid)")
+    store.execute("CREATE TABLE IF NOT EXISTS mapping_history (version INTEGER NOT NULL, change TEXT NOT NULL, nsid TEXT NOT NULL, " + mappingColumns + ")")
+    store.execute("CREATE INDEX IF NOT EXISTS mapping_history_by_nsid ON mapping_history (nsid, version)")
+    store.execute("CREATE TABLE IF NOT EXISTS overrides (client_id TEXT PRIMARY KEY, " + overrideColumns + ", version INTEGER NOT NULL)")
+    store.execute("CREATE TABLE IF NOT EXISTS override_history (version INTEGER NOT NULL, change TEXT NOT NULL, client_id TEXT NOT NULL, " + overrideColumns + ")")
+    store.execute("CREATE INDEX IF NOT EXISTS override_history_by_client ON override_history (client_id, version)")
+    store.execute("CREATE TABLE IF NOT EXISTS afid_counters (entity TEXT PRIMARY KEY, last_number INTEGER NOT NULL)")
+    store.execute("CREATE TABLE IF NOT EXISTS imported_files (kind TEXT NOT NULL, sha1 TEXT NOT NULL, path TEXT, imported TIMESTAMP, PRIMARY KEY (kind, sha1))")
+    store.commit()
+    return store
+
+# Sort key putting numeric NSIDs first in number order, then the others (legacy PR/Express ids) in text order
+def nsidSortKey(nsID):
+    try:
+        return (0, int(nsID), "")
+    except (TypeError, ValueError):
+        return (1, 0, str(nsID))
+
+def formatAFID(number):
+    return "AF-" + str(number).zfill(8)
+
+# Entity whose counter numbers an AFID ('BV' or 'PR'), from its first digit
+def afidEntity(afID):
+    digits = afID.split('-')[1]
+    if digits[0] == '1':
+        return 'PR'
+    if digits[0] == '0':
+        return 'BV'
+    raise ValueError("Unexpected AFID " + afID)
+
+# Text as the mapping files hold it
+def textValue(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return csvFormat(value)
+    return str(value)
+
+# Mapping (keyed as in mappingFields) with its values in stored form
+def normalizeMapping(mapping):
+    values = {}
+    for (key, column) in mappingFields:
+        values[key] = int(mapping[key]) if key in mappingIntegerFields else textValue(mapping[key])
+    return values
+
+def normalizeOverride(override):
+    return dict([(key, textValue(override[key])) for (key, column) in overrideFields])
+
+# The mapping file row of a combined customer (see NetSuiteMod.combineCustomerIndicies)
+def customerMapping(customer):
+    return normalizeMapping({'NSID': customer["nsID"], 'ChildName': customer["name"], 'ParentName': customer["topName"], 'AFID': customer["afID"], 'ciqID': customer["ciqID"], 'BU': customer["BU"],
+                             'isFortune500': customer["isFortune500"], 'isIr500': customer["isIr500"], 'ciqUltParent': customer["ciqUltParent"], 'custOrigination': customer["custOrigination"]})
+
+def rowMapping(row):
+    return dict([(key, row[i]) for (i, (key, column)) in enumerate(mappingFields)])
+
+def rowOverride(row):
+    return dict([(key, row[i]) for (i, (key, column)) in enumerate(overrideFields)])
+
+''''''''''''''' Lookups '''''''''''''''
+# Returns the mapping of one NSID (keyed as in mappingFields), or None if it is not mapped
+def getMapping(store, nsID):
+    row = store.execute("SELECT " + ", ".join([column for (key, column) in mappingFields]) + " FROM mappings WHERE nsid = ?", (textValue(nsID),)).fetchone()
+    return rowMapping(row) if row else None
+
+# Returns the NSIDs mapped to an AFID
+def findAFID(store, afID):
+    return [row[0] for row in store.execute("SELECT nsid FROM mappings WHERE afid = ?", (afID,))]
+
+def getOverride(store, clientID):
+    row = store.execute("SELECT " + ", ".join([column for (key, column) in overrideFields]) + " FROM overrides WHERE client_id = ?", (textValue(clientID),)).fetchone()
+    return rowOverride(row) if row else None
+
+# Returns [mappingDict, maxAFIDBV, maxAFIDPR] as NetSuiteMod.getIDMappingFile does, the maxima being the last numbers handed out by the store's counters
+def getMappings(store):
+    mappingDict = defaultdict(dict)
+    for row in store.execute("SELECT " + ", ".join([column for (key, column) in mappingFields]) + " FROM mappings"):
+        mappingDict[row[0]] = rowMapping(row)
+    return [mappingDict, lastAFIDNumber(store, 'BV'), lastAFIDNumber(store, 'PR')]
+
+# Returns the entity overrides by client id as NetSuiteMod.getEntityOverrideFile does
+def getOverrides(store):
+    overrideDict = defaultdict(dict)
+    for row in store.execute("SELECT " + ", ".join([column for (key, column) in overrideFields]) + " FROM overrides"):
+        overrideDict[row[0]] = rowOverride(row)
+    return overrideDict
+
+# Returns [version, created, source, change, mapping] for every change made to an NSID's mapping, oldest first.  A deleted mapping is listed with its last values.
+def getMappingHistory(store, nsID):
+    columns = ", ".join(["h." + column for (key, column) in mappingFields])
+    return [[row[0], row[1], row[2], row[3], rowMapping(row[4:])] for row in store.execute("SELECT h.version, v.created, v.source, h.change, " + columns + " FROM mapping_history h JOIN versions v ON v.version = h.version WHERE h.nsid = ? ORDER BY h.version", (textValue(nsID),))]
+
+def getOverrideHistory(store, clientID):
+    columns = ", ".join(["h." + column for (key, column) in overrideFields])
+    return [[row[0], row[1], row[2], row[3], rowOverride(row[4:])] for row in store.execute("SELECT h.version, v.created, v.source, h.change, " + columns + " FROM override_history h JOIN versions v ON v.version = h.version WHERE h.client_id = ? ORDER BY h.version", (textValue(clientID),))]
+
+# Returns [version, created, source] for every version, oldest first
+def getVersions(store):
+    return [[row[0], row[1], row[2]] for row in store.execute("SELECT version, created, source FROM versions ORDER BY version")]
+
+''''''''''''''' Changes '''''''''''''''
+''' Writes a batch of changes as one new version, without committing.  mappingChanges and overrideChanges are lists of [change, values], change being "insert", "update" or "delete" and values keyed as in mappingFields/overrideFields.
+Returns the new version, or None (and writes nothing) if there are no changes. '''
+def writeVersion(store, source, mappingChanges=[], overrideChanges=[]):
+    if not mappingChanges and not overrideChanges:
+        return None
+    version = store.execute("INSERT INTO versions (created, source) VALUES (?, ?)", (datetime.now(), source)).lastrowid
+    writeChanges(store, version, "mappings", "mapping_history", mappingFields, mappingChanges)
+    writeChanges(store, version, "overrides", "override_history", overrideFields, overrideChanges)
+    return version
+
+def writeChanges(store, version, tableName, historyName, fields, changes):
+    columns = [column for (key, column) in fields]
+    for (change, values) in changes:
+        row = tuple([values[key] for (key, column) in fields])
+        if change == "delete":
+            store.execute("DELETE FROM " + tableName + " WHERE " + columns[0] + " = ?", (row[0],))
+        else:
+            store.execute("INSERT OR REPLACE INTO " + tableName + " (" + ", ".join(columns) + ", version) VALUES (" + ", ".join(["?"]*len(columns)) + ", ?)", row + (version,))
+        store.execute("INSERT INTO " + historyName + " (version, change, " + ", ".join(columns) + ") VALUES (?, ?, " + ", ".join(["?"]*len(columns)) + ")", (version, change) + row)
+
+# [change, values] for each mapping that is new or differs from the stored one
+def changedMappings(store, mappings):
+    changes = []
+    for mapping in mappings:
+        mapping = normalizeMapping(mapping)
+        stored = getMapping(store, mapping['NSID'])
+        if stored is None:
+            changes.append(["insert", mapping])
+        elif stored != mapping:
+            changes.append(["update", mapping])
+    return changes
+
+''' Inserts new mappings and updates changed ones as one version (mappings keyed as in mappingFields); mappings not listed are left alone.
+Raises the AFID counters past any AFID written, so they are never handed out again.  Returns the new version, or None if nothing changed. '''
+def upsertMappings(store, mappings, source):
+    changes = changedMappings(store, mappings)
+    version = writeVersion(store, source, mappingChanges=changes)
+    for (change, mapping) in changes:
+        raiseAFIDCounter(store, afidEntity(mapping['AFID']), int(mapping['AFID'].split('-')[1]))
+    store.commit()
+    return version
+
+def deleteMapping(store, nsID, source):
+    mapping = getMapping(store, nsID)
+    version = writeVersion(store, source, mappingChanges=[["delete", mapping]] if mapping else [])
+    store.commit()
+    return version
+
+''' Inserts new overrides and updates changed ones as one version.  With replace=True the overrides are the whole list and stored overrides not in it are deleted.
+Returns the new version, or None if nothing changed. '''
+def upsertOverrides(store, overrides, source, replace=False):
+    changes = []
+    listed = set()
+    for override in overrides:
+        override = normalizeOverride(override)
+        listed.add(override['clientID'])
+        stored = getOverride(store, override['clientID'])
+        if stored is None:
+            changes.append(["insert", override])
+        elif stored != override:
+            changes.append(["update", override])
+    if replace:
+        for (clientID, stored) in sorted(getOverrides(store).items()):
+            if clientID not in listed:
+                changes.append(["delete", stored])
+    version = writeVersion(store, source, overrideChanges=changes)
+    store.commit()
+    return version
+
+''''''''''''''' AFID allocation '''''''''''''''
+# Last AFID number handed out for the entity ('BV' or 'PR'); before any, one below its first number
+def lastAFIDNumber(store, entity):
+    row = store.execute("SELECT last_number FROM afid_counters WHERE entity = ?", (entity,)).fetchone()
+    if row:
+        return row[0]
+    return firstAFIDNumbers[entity] - 1
+
+# Moves the entity's counter up to number if it is behind it (counters never go down, so an AFID is never handed out twice), without committing
+def raiseAFIDCounter(store, entity, number):
+    if number > lastAFIDNumber(store, entity):
+        store.execute("INSERT OR REPLACE INTO afid_counters (entity, last_number) VALUES (?, ?)", (entity, number))
+
+''' Gives each customer (combined customer dictionaries, see NetSuiteMod.combineCustomerIndicies) that has no mapping a new AFID and stores its mapping, as one version.
+AFIDs are numbered on from the BV counter for BV customers and the PR counter for the others, in NSID order, so the numbering does not depend on the order the customers come in.
+A customer that is already mapped keeps its stored AFID.  Sets customer["afID"] on every customer. '''
+def allocateAFIDs(store, customers, source="AFID allocation"):
+    changes = []
+    lastNumbers = {'BV': lastAFIDNumber(store, 'BV'), 'PR': lastAFIDNumber(store, 'PR')}
+    for customer in sorted(customers, key=lambda customer: nsidSortKey(customer["nsID"])):
+        stored = getMapping(store, customer["nsID"])
+        if stored:
+            customer["afID"] = stored['AFID']
+            continue
+        entity = 'BV' if customer["entity"] == 'BV' else 'PR'
+        lastNumbers[entity] += 1
+        customer["afID"] = formatAFID(lastNumbers[entity])
+        changes.append(["insert", customerMapping(customer)])
+    writeVersion(store, source, mappingChanges=changes)
+    for entity in lastNumbers:
+        raiseAFIDCounter(store, entity, lastNumbers[entity])
+    store.commit()
+
+''''''''''''''' Files '''''''''''''''
+def fileHash(path):
+    return fdbInputCache.fileSignature(path)[3]
+
+# True if the file's current contents have been imported (or written out) as the kind ("mapping" or "override") before
+def isImported(store, kind, path):
+    return store.execute("SELECT COUNT(*) FROM imported_files WHERE kind = ? AND sha1 = ?", (kind, fileHash(path))).fetchone()[0] > 0
+
+def recordImport(store, kind, path):
+    store.execute("INSERT OR REPLACE INTO imported_files (kind, sha1, path, imported) VALUES (?, ?, ?, ?)", (kind, fileHash(path), os.path.abspath(path), datetime.now()))
+    store.commit()
+
+''' Imports the mappings read from a mapping file (see NetSuiteMod.parseIDMappingFile): upserts them and raises the AFID counters to the file's maxima.
+Mappings missing from the file are kept, so their AFIDs stay reserved.  Returns the new version, or None if nothing changed. '''
+def importMappings(store, mappingDict, maxAFIDBV, maxAFIDPR, path):
+    version = upsertMappings(store, mappingDict.values(), "Mapping file " + os.path.basename(path))
+    raiseAFIDCounter(store, 'BV', maxAFIDBV)
+    raiseAFIDCounter(store, 'PR', maxAFIDPR)
+    recordImport(store, "mapping", path)
+    return version
+
+# Imports the overrides read from an override file (see NetSuiteMod.parseEntityOverrideFile).  The file is the whole list, so overrides it no longer has are deleted.
+def importOverrides(store, overrideDict, path):
+    version = upsertOverrides(store, overrideDict.values(), "Override file " + os.path.basename(path), replace=True)
+    recordImport(store, "override", path)
+    return version
+
+# Writes every stored mapping to a mapping file, in NSID order, and records it as imported so an unedited copy is not read back in
+def exportMappingFile(store, filename):
+    mappings = getMappings(store)[0]
+    outfile = open(filename + ".tmp", "wb")
+    writer = csv.writer(outfile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(mappingHeaders)
+    for nsID in sorted(mappings, key=nsidSortKey):
+        writer.writerow([mappings[nsID][key] for (key, column) in mappingFields])
+    outfile.close()
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(filename + ".tmp", filename)
+    recordImport(store, "mapping", filename)
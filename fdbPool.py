@@ -0,0 +1,194 @@
+# Connection pool and pull scheduler for the Net Suite extract.
+# Opens a fixed number of pyodbc connections from the connection string in the fdb.ini file and runs the independent data pulls concurrently.
+# Each pull waits only for the pulls whose results it is built from (e.g. contracts wait for customers and items), not for everything queued ahead of it.
+# Settings are read from ../settings/fdb.ini, or from the file named by the FDB_SETTINGS environment variable.
+
+import ConfigParser
+import Queue
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+settingsFile = os.environ.get("FDB_SETTINGS", "../settings/fdb.ini")
+defaultPoolSize = 4
+chunkIdleWait = 0.2 # Seconds a chunk helper waits before looking for an idle connection again
+
+def getNetsuiteSettings():
+    parser = ConfigParser.RawConfigParser()
+    parser.read(settingsFile)
+    return parser
+
+# Returns an optional setting from the fdb.ini file, or default if it is not there
+def getSetting(section, option, default=None):
+    parser = getNetsuiteSettings()
+    if parser.has_option(section, option):
+        return parser.get(section, option)
+    return default
+
+# Opens a single connection to Net Suite using the connection string in the fdb.ini file.
+# If the Netsuite section has a sqlite_path instead, the local stand-in (see fdbSqliteSource) is opened so the extract can run offline.
+# "driver = turbodbc" in the Netsuite section opens the ODBC connection with turbodbc, whose cursors can fill NumPy column buffers (see fdbColumnar), instead of pyodbc.
+def getNetsuiteConnection():
+    parser = getNetsuiteSettings()
+    if parser.has_option('Netsuite', 'sqlite_path'):
+        import fdbSqliteSource
+        return fdbSqliteSource.connect(parser.get('Netsuite', 'sqlite_path'))
+    if getDriver() == 'turbodbc':
+        import turbodbc
+        return turbodbc.connect(connection_string=parser.get('Netsuite', 'connection_string'))
+    import pyodbc
+    return pyodbc.connect(parser.get('Netsuite', 'connection_string'))
+
+def getDriver():
+    return getSetting('Netsuite', 'driver', 'pyodbc')
+
+# Pool size comes from the optional pool_size setting in the Netsuite section of fdb.ini
+def getPoolSize():
+    return int(getSetting('Netsuite', 'pool_size', defaultPoolSize))
+
+class NetsuiteConnectionPool(object):
+    """ Fixed size pool of Net Suite connections.  A connection is only ever used by one thread at a time.
+    Use as: with pool.cursor() as cursor: ... """
+
+    def __init__(self, size=None):
+        self.size = size or getPoolSize()
+        self.connections = []
+        self.idle = Queue.Queue()
+        for i in range(self.size):
+            cnxn = getNetsuiteConnection()
+            self.connections.append(cnxn)
+            self.idle.put(cnxn)
+
+    # Checks out a connection (blocking until one is free) and yields a fresh cursor on it.  With wait=False it yields None instead of blocking if every connection is in use.
+    @contextmanager
+    def cursor(self, wait=True):
+        try:
+            cnxn = self.idle.get(wait)
+        except Queue.Empty:
+            yield None
+            return
+        try:
+            cursor = cnxn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+        finally:
+            self.idle.put(cnxn)
+
+    def close(self):
+        for cnxn in self.connections:
+            cnxn.close()
+        self.connections = []
+
+''' Runs data pulls concurrently over the pool.
+pulls is a list of (name, function, dependencyNames).  Each function is called as function(cursor, *dependencyResults) once every named dependency has finished.
+Returns dict {name: result}.  If any pull fails, its dependents are skipped and the first failure is re-raised once all threads have stopped.
+Unknown dependencies and dependency cycles (whose pulls would wait on each other forever) are refused before any pull starts. '''
+def runPulls(pool, pulls):
+    names = set([name for (name, function, dependencies) in pulls])
+    for (name, function, dependencies) in pulls:
+        for dependency in dependencies:
+            if dependency not in names:
+                print "The pull " + name + " depends on " + dependency + ", which is not in the pull list."
+                raise KeyError(dependency)
+    checkPullOrder(pulls)
+
+    results = {}
+    errors = []
+    finished = dict([(name, threading.Event()) for name in names])
+
+    def runPull(name, function, dependencies):
+        try:
+            for dependency in dependencies:
+                finished[dependency].wait()
+            if errors:
+                return
+            args = [results[dependency] for dependency in dependencies]
+            with pool.cursor() as cursor:
+                results[name] = function(cursor, *args)
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            finished[name].set()
+
+    threads = []
+    for (name, function, dependencies) in pulls:
+        thread = threading.Thread(target=runPull, name=name, args=(name, function, dependencies))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+# Raises ValueError if the pulls' dependencies form a cycle: pulls are taken off in dependency order (a pull once all its dependencies are off), and any left over are in a cycle or wait on one
+def checkPullOrder(pulls):
+    waitingOn = dict([(name, set(dependencies)) for (name, function, dependencies) in pulls])
+    ready = [name for name in waitingOn if not waitingOn[name]]
+    while ready:
+        done = ready.pop()
+        del waitingOn[done]
+        for (name, dependencies) in waitingOn.items():
+            if done in dependencies:
+                dependencies.discard(done)
+                if not dependencies:
+                    ready.append(name)
+    if waitingOn:
+        print "The pulls " + ", ".join(sorted(waitingOn)) + " can never start: their dependencies run in a cycle."
+        raise ValueError("Dependency cycle among the pulls " + ", ".join(sorted(waitingOn)))
+
+''' Runs function(cursor, chunk) for every chunk of a chunked pull.
+The caller's cursor works through the chunks; if pool is given, helper threads also take chunks, each on a pool connection checked out only while it is idle and only for one chunk.  A pull running its chunks therefore never waits on a connection another pull holds.
+If a chunk fails, no more chunks are started and the first failure is re-raised once the running ones have stopped. '''
+def runChunks(pool, cursor, chunks, function):
+    pending = Queue.Queue()
+    for chunk in chunks:
+        pending.put(chunk)
+    errors = []
+
+    def nextChunk():
+        if errors:
+            return None
+        try:
+            return pending.get(False)
+        except Queue.Empty:
+            return None
+
+    def runHelper():
+        try:
+            while not errors and not pending.empty():
+                with pool.cursor(wait=False) as helperCursor:
+                    if helperCursor is None:
+                        time.sleep(chunkIdleWait)
+                        continue
+                    chunk = nextChunk()
+                    if chunk is not None:
+                        function(helperCursor, chunk)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    helpers = []
+    if pool:
+        for i in range(pool.size-1):
+            thread = threading.Thread(target=runHelper, name=threading.current_thread().name) # Named after the calling pull, so its queries are logged against it
+            thread.daemon = True
+            thread.start()
+            helpers.append(thread)
+    try:
+        chunk = nextChunk()
+        while chunk is not None:
+            function(cursor, chunk)
+            chunk = nextChunk()
+    except Exception:
+        errors.append(sys.exc_info())
+    for thread in helpers:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
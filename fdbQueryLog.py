@@ -0,0 +1,182 @@
+# Instrumentation of the Net Suite queries.
+# Every query run through NetSuiteMod.executeQuery gets a QueryStats record: SQL hash, execute latency, time to first row, rows, bytes converted and throughput, and which pull ran it.
+# Time is split three ways so a slow pull can be pinned on the server (execute and time to first row), on the driver fetching and converting rows (fetch), or on our own code consuming them (client).
+# Finished records are appended to a JSON lines log; queries slower than slowQuerySeconds are also kept in a slow query list, saved across runs with the worst time seen per query.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+import fdbPool
+
+logEnabled = True
+queryLogFile = fdbPool.getSetting('Paths', 'query_log', "../logs/netsuite_queries.log")
+slowQueryFile = fdbPool.getSetting('Paths', 'slow_query_list', "../logs/netsuite_slow_queries.json")
+slowQuerySeconds = 5.0
+slowQueryListSize = 50
+
+queryLog = [] # Records finished in this run
+logLock = threading.Lock()
+
+# Bytes of a fetched row, counting strings by length and everything else as 8 bytes.  Batches are estimated from their first row.
+def rowBytes(row):
+    size = 0
+    for value in row:
+        if isinstance(value, basestring):
+            size += len(value)
+        elif value is not None:
+            size += 8
+    return size
+
+class QueryStats(object):
+    """ Timings of one query.  Call executed() once the statement returns, fetched() after each batch of rows and finish() at the end. """
+
+    def __init__(self, query, params=None, source="netsuite"):
+        self.query = query
+        self.params = params
+        self.source = source
+        self.pull = threading.current_thread().name # fdbPool.runPulls names its threads after the pulls
+        self.started = datetime.now()
+        self.start = time.time()
+        self.executeSeconds = None
+        self.firstRowSeconds = None
+        self.fetchSeconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.finished = False
+
+    def executed(self):
+        self.executeSeconds = time.time() - self.start
+
+    def fetched(self, rowCount, fetchSeconds, sampleRow=None):
+        if rowCount and self.firstRowSeconds is None:
+            self.firstRowSeconds = time.time() - self.start
+        self.fetchSeconds += fetchSeconds
+        self.rows += rowCount
+        if sampleRow is not None:
+            self.bytes += rowBytes(sampleRow)*rowCount
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        record = self.toRecord()
+        with logLock:
+            queryLog.append(record)
+            if logEnabled:
+                writeRecord(record)
+
+    def toRecord(self):
+        totalSeconds = time.time() - self.start
+        executeSeconds = self.executeSeconds or 0.0
+        return {"time": self.started.strftime("%Y-%m-%d %H:%M:%S"),
+                "pull": self.pull,
+                "source": self.source,
+                "sqlHash": hashlib.sha1(self.query).hexdigest()[0:12],
+                "sql": self.query,
+                "params": len(self.params or ()),
+                "executeSeconds": round(executeSeconds, 4),
+                "firstRowSeconds": None if self.firstRowSeconds is None else round(self.firstRowSeconds, 4),
+                "fetchSeconds": round(self.fetchSeconds, 4),
+                "clientSeconds": round(max(totalSeconds - executeSeconds - self.fetchSeconds, 0), 4),
+                "totalSeconds": round(totalSeconds, 4),
+                "rows": self.rows,
+                "bytes": self.bytes,
+                "rowsPerSecond": round(self.rows/totalSeconds, 1) if totalSeconds > 0 else None,
+                "bytesPerSecond": round(self.bytes/totalSeconds, 1) if totalSeconds > 0 else None
+                }
+
+# Passes column batches (see fdbColumnar) through unchanged, recording the time spent fetching each and the rows in it, and finishes stats when the stream ends or is abandoned
+def trackBatches(stats, batches):
+    batches = iter(batches)
+    try:
+        while True:
+            start = time.time()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                break
+            rowCount = len(batch[0]) if len(batch) else 0
+            stats.fetched(rowCount, time.time() - start, [column[0] for column in batch] if rowCount else None)
+            yield batch
+    finally:
+        stats.finish()
+
+# Passes rows that need no fetching (such as cached results) through unchanged, counting them, and finishes stats when the stream ends or is abandoned
+def trackRows(stats, rows):
+    rows = iter(rows)
+    rowCount = 0
+    sampleRow = None
+    try:
+        for row in rows:
+            sampleRow = row
+            stats.fetched(1, 0.0, row)
+            yield row
+            break
+        for row in rows:
+            rowCount += 1
+            yield row
+    finally:
+        stats.fetched(rowCount, 0.0, sampleRow)
+        stats.finish()
+
+# Fetches the single row of a query run for stats (counts, min/max lookups) and finishes stats
+def fetchOne(cursor, stats):
+    start = time.time()
+    row = cursor.fetchone()
+    stats.fetched(1 if row else 0, time.time() - start, row)
+    stats.finish()
+    return row
+
+def writeRecord(record):
+    folder = os.path.dirname(queryLogFile)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    outfile = open(queryLogFile, "ab")
+    outfile.write(json.dumps(record, sort_keys=True) + "\n")
+    outfile.close()
+
+# Queries of this run slower than slowQuerySeconds, slowest first
+def slowQueries():
+    return sorted([record for record in queryLog if record["totalSeconds"] >= slowQuerySeconds], key=lambda record: -record["totalSeconds"])
+
+''' Merges this run's slow queries into the saved slow query list (worst time per query hash, slowest first, at most slowQueryListSize entries).
+Returns the updated list. '''
+def saveSlowQueries():
+    slowList = {}
+    if os.path.exists(slowQueryFile):
+        infile = open(slowQueryFile, "rb")
+        for record in json.load(infile):
+            slowList[record["sqlHash"]] = record
+        infile.close()
+    for record in slowQueries():
+        if record["sqlHash"] not in slowList or record["totalSeconds"] > slowList[record["sqlHash"]]["totalSeconds"]:
+            slowList[record["sqlHash"]] = record
+    slowList = sorted(slowList.values(), key=lambda record: -record["totalSeconds"])[0:slowQueryListSize]
+
+    folder = os.path.dirname(slowQueryFile)
+    if folder and not os.path.isdir(folder):
+        os.makedirs(folder)
+    outfile = open(slowQueryFile, "wb")
+    json.dump(slowList, outfile, indent=1, sort_keys=True)
+    outfile.close()
+    return slowList
+
+# Prints time per pull (split into execute, fetch and client time) and this run's slow queries
+def printSummary():
+    byPull = {}
+    for record in queryLog:
+        totals = byPull.setdefault(record["pull"], [0, 0, 0.0, 0.0, 0.0, 0.0])
+        totals[0] += 1
+        totals[1] += record["rows"]
+        totals[2] += record["totalSeconds"]
+        totals[3] += record["executeSeconds"]
+        totals[4] += record["fetchSeconds"]
+        totals[5] += record["clientSeconds"]
+    print "%-20s %8s %10s %9s %9s %9s %9s" % ("Pull", "Queries", "Rows", "Total s", "Execute", "Fetch", "Client")
+    for (pull, totals) in sorted(byPull.items(), key=lambda item: -item[1][2]):
+        print "%-20s %8d %10d %9.2f %9.2f %9.2f %9.2f" % (pull[0:20], totals[0], totals[1], totals[2], totals[3], totals[4], totals[5])
+    for record in slowQueries():
+        print "Slow query " + record["sqlHash"] + " (" + record["pull"] + "): %.1fs, %d rows - %s" % (record["totalSeconds"], record["rows"], record["sql"][0:120])
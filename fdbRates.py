@@ -0,0 +1,169 @@
+# As-of exchange rate index for the Net Suite pulls.
+# CurrencyRates only has rows on the days a rate was set (no weekends or holidays), so looking a transaction's date up exactly misses many days.
+# The index keeps each currency's rates to USD as a date sorted series and answers "the rate in effect on date D" by binary search - the latest rate set on or before D.
+# Currencies with no USD based rates get a series derived through USD: from USD based rows the other way round (inverted), or from rates against another currency that has a USD rate (crossed).
+# Every lookup is counted by how it was answered, so the extract can report how many fell back to an earlier rate (or found none).
+# Whole amount arrays are converted at once with NumPy when it is available.
+
+import threading
+from bisect import bisect_right
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+usdCurrencyID = 1
+lookupKinds = ["exact", "earlier", "later", "missing"] # Rate set on the day; latest earlier rate; no rate yet, so the first later one; no rate at all (0.0)
+
+# Day number of a date or datetime (the time of day is ignored)
+def dayNumber(value):
+    return value.toordinal()
+
+# Returns the index of the rate in effect on day in a sorted list of days and the kind of lookup it was, or [None, "missing"] for an empty series
+def findRate(days, day):
+    if not days:
+        return [None, "missing"]
+    position = bisect_right(days, day) - 1
+    if position < 0:
+        return [0, "later"]
+    if days[position] == day:
+        return [position, "exact"]
+    return [position, "earlier"]
+
+class ExchangeRateIndex(object):
+    """ Rates to USD by currency, as of any date.  Built from CurrencyRates rows (baseCurrencyID, currencyID, effectiveDate, rate), where one unit of currencyID is worth rate units of baseCurrencyID.
+    index[(currencyID, date)] is the rate taking currencyID amounts to USD on that date, so the index drops in where the (currency, date) rate dictionary was used. """
+
+    def __init__(self, rows):
+        pairs = {}
+        self.rowCount = 0
+        for (baseCurrencyID, currencyID, effective, rate) in rows:
+            if baseCurrencyID is None or currencyID is None or effective is None or rate is None:
+                continue
+            pairs.setdefault((int(baseCurrencyID), int(currencyID)), {})[dayNumber(effective)] = float(rate) # The last rate of a day wins
+            self.rowCount += 1
+
+        # USD series: [sorted days, rates] per currency, direct where possible, otherwise derived through USD
+        self.series = {}
+        self.derived = set()
+        for ((baseCurrencyID, currencyID), rates) in pairs.items():
+            if baseCurrencyID == usdCurrencyID:
+                self.series[currencyID] = sortedSeries(rates)
+        for ((baseCurrencyID, currencyID), rates) in pairs.items():
+            if currencyID == usdCurrencyID and baseCurrencyID not in self.series:
+                self.series[baseCurrencyID] = sortedSeries(dict([(day, 1/rate) for (day, rate) in rates.items() if rate]))
+                self.derived.add(baseCurrencyID)
+        for ((baseCurrencyID, currencyID), rates) in sorted(pairs.items()):
+            if currencyID not in self.series and baseCurrencyID != usdCurrencyID and baseCurrencyID in self.series:
+                self.series[currencyID] = crossSeries(sortedSeries(rates), self.series[baseCurrencyID])
+                self.derived.add(currencyID)
+
+        self.resolved = {} # (currencyID, day): [rate, kind], so repeated lookups skip the search
+        self.counts = dict([(kind, 0) for kind in lookupKinds])
+        self.crossLookups = 0
+        self.countLock = threading.Lock()
+
+    def __len__(self):
+        return self.rowCount
+
+    def __getitem__(self, key):
+        return self.usdRate(key[0], key[1])
+
+    # Rate taking amounts in currencyID to USD on the date (0.0 if the currency has no rates or there is no date)
+    def usdRate(self, currencyID, when):
+        if currencyID == usdCurrencyID:
+            return 1.0
+        key = (currencyID, None if when is None else dayNumber(when))
+        found = self.resolved.get(key)
+        if found is None:
+            found = self.resolve(currencyID, key[1])
+            self.resolved[key] = found
+        with self.countLock:
+            self.counts[found[1]] += 1
+            if currencyID in self.derived:
+                self.crossLookups += 1
+        return found[0]
+
+    def resolve(self, currencyID, day):
+        days, rates = self.series.get(currencyID, [[], []])
+        if day is None:
+            return [0.0, "missing"]
+        position, kind = findRate(days, day)
+        if position is None:
+            return [0.0, kind]
+        return [rates[position], kind]
+
+    # Rate taking amounts in fromCurrencyID to toCurrencyID on the date, crossed through USD (0.0 if either has no rate)
+    def rate(self, fromCurrencyID, toCurrencyID, when):
+        toRate = self.usdRate(toCurrencyID, when)
+        if not toRate:
+            return 0.0
+        return self.usdRate(fromCurrencyID, when)/toRate
+
+    ''' Rates to USD for whole arrays at once: currencyIDs and days (day numbers, see dayNumber) are equal length integer sequences.
+    Each currency's days are looked up with one numpy.searchsorted call.  Returns a NumPy array of rates (1.0 for USD, 0.0 where there is no rate). '''
+    def usdRateArray(self, currencyIDs, days):
+        currencyIDs = numpy.asarray(currencyIDs, dtype=numpy.int64)
+        days = numpy.asarray(days, dtype=numpy.int64)
+        rates = numpy.ones(len(currencyIDs))
+        counts = dict([(kind, 0) for kind in lookupKinds])
+        crossLookups = 0
+        for currencyID in numpy.unique(currencyIDs).tolist():
+            if currencyID == usdCurrencyID:
+                continue
+            selected = currencyIDs == currencyID
+            seriesDays, seriesRates = self.series.get(currencyID, [[], []])
+            if not seriesDays:
+                rates[selected] = 0.0
+                counts["missing"] += int(selected.sum())
+                continue
+            seriesDays = numpy.array(seriesDays, dtype=numpy.int64)
+            lookupDays = days[selected]
+            positions = numpy.searchsorted(seriesDays, lookupDays, side="right") - 1
+            before = positions < 0
+            positions[before] = 0
+            exact = (seriesDays[positions] == lookupDays) & ~before
+            rates[selected] = numpy.array(seriesRates)[positions]
+            counts["exact"] += int(exact.sum())
+            counts["later"] += int(before.sum())
+            counts["earlier"] += len(lookupDays) - int(exact.sum()) - int(before.sum())
+            if currencyID in self.derived:
+                crossLookups += len(lookupDays)
+        with self.countLock:
+            for kind in lookupKinds:
+                self.counts[kind] += counts[kind]
+            self.crossLookups += crossLookups
+        return rates
+
+    # Converts an amount array in the given currencies on the given days to USD
+    def toUSD(self, amounts, currencyIDs, days):
+        return numpy.asarray(amounts, dtype=numpy.float64)*self.usdRateArray(currencyIDs, days)
+
+    # Lookup counts so far: {kind: count} for the kinds in lookupKinds, plus "cross" for lookups answered through a derived series
+    def lookupCounts(self):
+        with self.countLock:
+            counts = dict(self.counts)
+            counts["cross"] = self.crossLookups
+        return counts
+
+    def printLookupSummary(self):
+        counts = self.lookupCounts()
+        print "Exchange rate lookups: " + str(counts["exact"]) + " on a rate date, " + str(counts["earlier"]) + " fell back to an earlier rate, " + str(counts["later"]) + " used the first later rate, " + str(counts["missing"]) + " had no rate (" + str(counts["cross"]) + " crossed through USD)"
+
+# [sorted days, rates] from {day: rate}
+def sortedSeries(ratesByDay):
+    days = sorted(ratesByDay)
+    return [days, [ratesByDay[day] for day in days]]
+
+# USD series for a currency quoted against base: on every day either series changes, the currency's rate to base times base's rate to USD, both as of that day
+def crossSeries(baseSeries, usdBaseSeries):
+    days = sorted(set(baseSeries[0]) | set(usdBaseSeries[0]))
+    crossed = {}
+    for day in days:
+        position, kind = findRate(baseSeries[0], day)
+        usdPosition, usdKind = findRate(usdBaseSeries[0], day)
+        if kind in ("exact", "earlier") and usdKind in ("exact", "earlier"):
+            crossed[day] = baseSeries[1][position]*usdBaseSeries[1][usdPosition]
+    if not crossed and baseSeries[0] and usdBaseSeries[0]: # The two series never overlap; use their first rates
+        crossed[max(baseSeries[0][0], usdBaseSeries[0][0])] = baseSeries[1][0]*usdBaseSeries[1][0]
+    return sortedSeries(crossed)
@@ -0,0 +1,210 @@
+# Fast reader for the revenue input file (fact_revenue_input.csv): lines of Date (yyyymmdd), ProductID, ClientID, Recurring (0 or 1), Revenue after a header line.
+# Lines are read in blocks and each block is split once and converted a column at a time (map over the column rather than a csv row object, strptime and a dict per line);
+# the few distinct yyyymmdd and client id keys are converted once each through memo tables.  Garbage collection is paused while a block is converted - the millions of small
+# containers built would otherwise trigger collections that cost more than the parsing, and none of them can form cycles.
+# Large files are split into byte ranges on line boundaries and the ranges parsed by a process pool.  Results come back as a generator of entries or as whole columns.
+
+import gc
+import multiprocessing
+import os
+from array import array
+from contextlib import contextmanager
+from datetime import date
+from itertools import izip
+
+blockBytes = 4*1024*1024 # Bytes of lines read and converted at a time
+rangeBytes = 16*1024*1024 # Smallest byte range handed to a worker process
+parallelMinBytes = 64*1024*1024 # Files this large are parsed by a process pool when processes is not given
+
+class DateMemo(dict):
+    """ yyyymmdd text -> date, parsing each distinct key once. """
+
+    def __missing__(self, key):
+        value = date(int(key[0:4]), int(key[4:6]), int(key[6:8]))
+        self[key] = value
+        return value
+
+class ClientIDMemo(dict):
+    """ Client id text -> normalized id string (str(int(text)), e.g. without leading zeros), converting each distinct key once. """
+
+    def __missing__(self, key):
+        value = str(int(key))
+        self[key] = value
+        return value
+
+# Pauses cyclic garbage collection inside the block (if it was on)
+@contextmanager
+def pausedGC():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def emptyColumns():
+    return {"month": [], "itemID": array('l'), "clientID": [], "recurring": array('l'), "amount": array('d')}
+
+''' Converts a block of lines (without line ends; blank lines are skipped) to columns {"month": dates, "itemID": ints, "clientID": strings, "recurring": ints, "amount": floats}.
+The block is split in one go and the columns sliced out of it; a block with a line of more (or fewer) than five fields is split line by line instead, extra fields ignored.
+memos is [DateMemo, ClientIDMemo], kept across the blocks of a file. '''
+def parseLines(lines, memos):
+    columns = emptyColumns()
+    lines = filter(None, lines)
+    if not lines:
+        return columns
+    dateMemo, clientIDMemo = memos
+    with pausedGC():
+        fields = ",".join(lines).split(",")
+        if len(fields) == 5*len(lines):
+            fields = [fields[i::5] for i in range(5)]
+        else:
+            fields = zip(*[line.split(",") for line in lines])
+        columns["month"] = map(dateMemo.__getitem__, fields[0])
+        columns["itemID"] = array('l', map(int, fields[1]))
+        columns["clientID"] = map(clientIDMemo.__getitem__, fields[2])
+        columns["recurring"] = array('l', map(int, fields[3]))
+        columns["amount"] = array('d', map(float, fields[4]))
+    return columns
+
+# Yields the columns of each block of lines in the file's byte range [start, end)
+def parseRangeBlocks(filename, start, end):
+    memos = [DateMemo(), ClientIDMemo()]
+    infile = open(filename, "rb")
+    try:
+        infile.seek(start)
+        remaining = end - start
+        carry = ""
+        while remaining > 0:
+            data = infile.read(min(blockBytes, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            lines = (carry + data).splitlines()
+            carry = ""
+            if remaining > 0 and not data.endswith("\n"):
+                carry = lines.pop() # Partial last line, finished by the next block
+            yield parseLines(lines, memos)
+        if carry:
+            yield parseLines([carry], memos)
+    finally:
+        infile.close()
+
+# Parses a whole byte range into one set of columns (the process pool's unit of work)
+def parseRange(arguments):
+    filename, start, end = arguments
+    columns = emptyColumns()
+    for block in parseRangeBlocks(filename, start, end):
+        appendColumns(columns, block)
+    return columns
+
+def appendColumns(columns, block):
+    for name in columns:
+        columns[name].extend(block[name])
+
+''' Splits the data lines of the file (everything after the header line) into about parts byte ranges [start, end) that each begin at the start of a line.
+Returns [] for a file with no data lines. '''
+def splitRanges(filename, parts):
+    size = os.path.getsize(filename)
+    infile = open(filename, "rb")
+    try:
+        infile.readline() # Header line
+        dataStart = infile.tell()
+        boundaries = [dataStart]
+        for i in range(1, parts):
+            position = dataStart + (size - dataStart)*i/parts
+            if position <= boundaries[-1]:
+                continue
+            infile.seek(position - 1)
+            infile.readline() # Move to the start of the next line (stays put if position is already at one)
+            if infile.tell() < size and infile.tell() > boundaries[-1]:
+                boundaries.append(infile.tell())
+    finally:
+        infile.close()
+    if dataStart >= size:
+        return []
+    return [[low, high] for (low, high) in zip(boundaries, boundaries[1:] + [size])]
+
+''' Parsing processes for a file: processes if given, otherwise one per CPU for files of parallelMinBytes or more and 1 (parse in this process) below that.
+Processes are only picked automatically where they are forked; on Windows each one would start by re-running the calling script, so pass processes only from a script whose top level is guarded by if __name__ == "__main__". '''
+def processCount(filename, processes=None):
+    if processes:
+        return processes
+    if os.name != "posix" or os.path.getsize(filename) < parallelMinBytes:
+        return 1
+    return multiprocessing.cpu_count()
+
+# Yields the file's rows as blocks of columns (see parseLines), in file order
+def iterRevenueBlocks(filename, processes=None):
+    processes = processCount(filename, processes)
+    if processes <= 1:
+        for (start, end) in splitRanges(filename, 1):
+            for block in parseRangeBlocks(filename, start, end):
+                yield block
+        return
+    parts = max(1, min(processes*4, os.path.getsize(filename)/rangeBytes))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for block in pool.imap(parseRange, [(filename, start, end) for (start, end) in splitRanges(filename, parts)]):
+            yield block
+    finally:
+        pool.terminate()
+
+# Returns the whole file as columns {"month": [date], "itemID": array of int, "clientID": [str], "recurring": array of int, "amount": array of float}
+def readRevenueColumns(filename, processes=None):
+    columns = emptyColumns()
+    for block in iterRevenueBlocks(filename, processes):
+        appendColumns(columns, block)
+    return columns
+
+# Yields the file's revenue entries, each {"month", "itemID", "clientID", "recurring", "amount", "entity"} as NetSuiteMod.readRevenueInput returns them
+def iterRevenueEntries(filename, processes=None):
+    for block in iterRevenueBlocks(filename, processes):
+        for entry in iterColumnEntries(block):
+            yield entry
+
+def iterColumnEntries(columns):
+    for (month, itemID, clientID, recurring, amount) in izip(columns["month"], columns["itemID"], columns["clientID"], columns["recurring"], columns["amount"]):
+        yield {"month": month, "itemID": itemID, "clientID": clientID, "recurring": recurring, "amount": amount, "entity": "BV"}
+
+# Returns the file's revenue entries as a list (see iterRevenueEntries), with garbage collection paused while the entry dictionaries are built
+def readRevenueEntries(filename, processes=None):
+    with pausedGC():
+        return list(iterRevenueEntries(filename, processes))
+
+''''''''''''''' Compiled form '''''''''''''''
+# Typed binary form of the columns, as fdbInputCache stores it: every column an array held as its raw bytes (pickled arrays would be written value by value),
+# months and client ids as positions in small tables of their distinct values.
+def compileColumns(columns):
+    monthTable = sorted(set(columns["month"]))
+    clientIDTable = sorted(set(columns["clientID"]))
+    monthPositions = dict([(month, i) for (i, month) in enumerate(monthTable)])
+    clientIDPositions = dict([(clientID, i) for (i, clientID) in enumerate(clientIDTable)])
+    return {"monthTable": monthTable,
+            "clientIDTable": clientIDTable,
+            "month": array('l', map(monthPositions.__getitem__, columns["month"])).tostring(),
+            "itemID": columns["itemID"].tostring(),
+            "clientID": array('l', map(clientIDPositions.__getitem__, columns["clientID"])).tostring(),
+            "recurring": columns["recurring"].tostring(),
+            "amount": columns["amount"].tostring()
+            }
+
+def loadArray(typecode, data):
+    values = array(typecode)
+    values.fromstring(data)
+    return values
+
+# The columns (see readRevenueColumns) back from their compiled form
+def expandColumns(compiled):
+    return {"month": map(compiled["monthTable"].__getitem__, loadArray('l', compiled["month"])),
+            "itemID": loadArray('l', compiled["itemID"]),
+            "clientID": map(compiled["clientIDTable"].__getitem__, loadArray('l', compiled["clientID"])),
+            "recurring": loadArray('l', compiled["recurring"]),
+            "amount": loadArray('d', compiled["amount"])
+            }
+
+# The revenue entries (see iterRevenueEntries) from the compiled form
+def compiledEntries(compiled):
+    with pausedGC():
+        return list(iterColumnEntries(expandColumns(compiled)))
@@ -0,0 +1,93 @@
+# Monthly revenue series index: for every key (e.g. top client name) a month sorted series of revenue totals.
+# Months are numbered as integer offsets (year*12 + month - 1), so the month after a month is always offset + 1 whatever day the month's date falls on,
+# and rules over consecutive months become scans over each series with a rolling window rather than lookups of computed dates in a (month, key) table.
+# Built once from the revenue entries, the index can be shared by every stage that needs revenue by client and month.
+
+from bisect import bisect_left
+
+# Integer month number of a date (consecutive months have consecutive numbers)
+def monthOffset(month):
+    return month.year*12 + month.month - 1
+
+''' Key function for series by top client: the topName of the entry's client, or None (entry left out) for entries with no amount, the -1 client or clients not in customersByID. '''
+def topClientKey(customersByID):
+    def keyOf(entry):
+        clientID = entry["clientID"]
+        if clientID != -1 and entry["amount"] and clientID in customersByID:
+            return customersByID[clientID]["topName"]
+        return None
+    return keyOf
+
+class RevenueSeriesIndex(object):
+    """ Revenue totals by key and month.  keyOf(entry) gives the series an entry is added to, or None to leave it out.
+    Each series is [offsets, months, amounts]: the month offsets with revenue in ascending order, the month of each (as the first of its entries gives it) and the month's total. """
+
+    def __init__(self, revenueEntries, keyOf):
+        totals = {}
+        for entry in revenueEntries:
+            key = keyOf(entry)
+            if key is None:
+                continue
+            offset = monthOffset(entry["month"])
+            points = totals.get(key)
+            if points is None:
+                points = totals[key] = {}
+            point = points.get(offset)
+            if point is None:
+                points[offset] = [entry["month"], 0.0 + entry["amount"]]
+            else:
+                point[1] += entry["amount"]
+
+        self.seriesByKey = {}
+        for (key, points) in totals.iteritems():
+            offsets = sorted(points)
+            self.seriesByKey[key] = [offsets, [points[offset][0] for offset in offsets], [points[offset][1] for offset in offsets]]
+
+    def __len__(self):
+        return len(self.seriesByKey)
+
+    def __contains__(self, key):
+        return key in self.seriesByKey
+
+    def keys(self):
+        return self.seriesByKey.keys()
+
+    # [offsets, months, amounts] for the key (empty lists if it has no revenue)
+    def series(self, key):
+        return self.seriesByKey.get(key, [[], [], []])
+
+    # Revenue of the key in the month (0.0 if none)
+    def amount(self, key, month):
+        offsets, months, amounts = self.series(key)
+        offset = monthOffset(month)
+        position = bisect_left(offsets, offset)
+        if position < len(offsets) and offsets[position] == offset:
+            return amounts[position]
+        return 0.0
+
+    # First month of the key whose revenue satisfies where(month, amount), or None
+    def firstMonth(self, key, where):
+        offsets, months, amounts = self.series(key)
+        for (month, amount) in zip(months, amounts):
+            if where(month, amount):
+                return month
+        return None
+
+    ''' First month of the key that starts length consecutive months each with revenue of at least minimum, or None.  If startsWhere is given only runs starting in a month for which startsWhere(month) is true count.
+    The series is scanned once, keeping the length of the current run of qualifying consecutive months. '''
+    def firstRun(self, key, length, minimum, startsWhere=None):
+        offsets, months, amounts = self.series(key)
+        run = 0
+        for i in range(len(offsets)):
+            if amounts[i] < minimum:
+                run = 0
+                continue
+            if run and offsets[i] == offsets[i-1] + 1:
+                run += 1
+            else:
+                run = 1
+            if run >= length:
+                start = i - length + 1
+                if startsWhere is None or startsWhere(months[start]):
+                    return months[start]
+        return None
@@ -0,0 +1,118 @@
+# Local SQLite stand-in for the Net Suite ODBC source.
+# Serves the same tables and columns the NetSuiteMod data pulls read, so the exact SQL they issue can be replayed offline (benchmarking, profiling, development on a box without NetSuite access).
+# Point fdb.ini at a stand-in file by adding "sqlite_path = <file>" to the Netsuite section; fdbPool.getNetsuiteConnection then opens it instead of the ODBC connection string.
+
+import re
+import sqlite3
+from datetime import datetime
+
+# Column layout of the Net Suite tables used by NetSuiteMod.  Date columns are declared TIMESTAMP so they come back as datetimes, as they do from pyodbc.
+sourceTables = [
+    "CREATE TABLE IF NOT EXISTS Customers (customer_id INTEGER PRIMARY KEY, full_name TEXT, country TEXT, vertical_id INTEGER, parent_id INTEGER, last_modified_date TIMESTAMP)",
+    "CREATE TABLE IF NOT EXISTS Contract (contract_id INTEGER PRIMARY KEY, customer_name_id INTEGER, product_type_id INTEGER, isf REAL, msf_booking REAL, effective_date TIMESTAMP, renewal_contract TEXT, live_adjustment TEXT, implementation_debooking TEXT, last_modified_date TIMESTAMP)",
+    "CREATE TABLE IF NOT EXISTS transactions (transaction_id INTEGER PRIMARY KEY, trandate TIMESTAMP, currency_id INTEGER, transaction_type TEXT, billing_frequency_id INTEGER, accounting_period_id INTEGER, last_modified_date TIMESTAMP)",
+    "CREATE TABLE IF NOT EXISTS transaction_lines (transaction_id INTEGER, transaction_line_id INTEGER, amount REAL, company_id INTEGER, subsidiary_id INTEGER, account_id INTEGER, item_id INTEGER, non_posting_line TEXT)",
+    "CREATE TABLE IF NOT EXISTS accounts (account_id INTEGER PRIMARY KEY, type_name TEXT)",
+    "CREATE TABLE IF NOT EXISTS accounting_periods (accounting_period_id INTEGER PRIMARY KEY, starting TIMESTAMP)",
+    "CREATE TABLE IF NOT EXISTS CurrencyRates (BASE_CURRENCY_ID INTEGER, CURRENCY_ID INTEGER, DATE_EFFECTIVE TIMESTAMP, EXCHANGE_RATE REAL)",
+    "CREATE TABLE IF NOT EXISTS Currencies (currency_id INTEGER PRIMARY KEY, symbol TEXT)",
+    "CREATE TABLE IF NOT EXISTS Items (item_id INTEGER PRIMARY KEY, name TEXT)",
+    "CREATE TABLE IF NOT EXISTS Vertical (list_id INTEGER PRIMARY KEY, list_item_name TEXT)",
+    "CREATE TABLE IF NOT EXISTS billing_cycle (list_id INTEGER PRIMARY KEY, list_item_name TEXT)",
+    "CREATE TABLE IF NOT EXISTS implementations (implementation_customer_nam_id INTEGER, projected_bv_launch TIMESTAMP, actual_client_launch TIMESTAMP, imp_phase_id INTEGER, implementation_msf REAL, last_modified_date TIMESTAMP)",
+    "CREATE TABLE IF NOT EXISTS implementation_phase (list_id INTEGER PRIMARY KEY, list_item_name TEXT)",
+    "CREATE INDEX IF NOT EXISTS transaction_lines_by_transaction ON transaction_lines (transaction_id)",
+    "CREATE INDEX IF NOT EXISTS transaction_lines_by_account ON transaction_lines (account_id)",
+    "CREATE INDEX IF NOT EXISTS transactions_by_modified ON transactions (last_modified_date)",
+    "CREATE INDEX IF NOT EXISTS rates_by_currency ON CurrencyRates (CURRENCY_ID, DATE_EFFECTIVE)"
+]
+
+timestampPattern = re.compile(r"^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(\.\d+)?$")
+
+# Net Suite's TRUNC(date, format) for the formats the pulls use ('MM' month start, 'YYYY' year start, 'DD' day)
+def truncDate(value, fmt):
+    if value is None:
+        return None
+    d = parseTimestamp(value)
+    fmt = fmt.upper()
+    if fmt == 'MM':
+        d = datetime(d.year, d.month, 1)
+    elif fmt in ('YYYY', 'YEAR'):
+        d = datetime(d.year, 1, 1)
+    else:
+        d = datetime(d.year, d.month, d.day)
+    return d.strftime("%Y-%m-%d %H:%M:%S")
+
+# Datetime of a stand-in date ("YYYY-MM-DD") or timestamp ("YYYY-MM-DD HH:MM:SS", fractions of a second dropped).
+# Parsed by slicing rather than with strptime, whose first call imports _strptime lazily - not thread safe on Python 2, and the pool's pull threads call this at the same time.
+def parseTimestamp(value):
+    if isinstance(value, datetime):
+        return value
+    if len(value) == 10:
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+# Creates the stand-in tables in the file (if they are not already there) and returns the open sqlite connection for loading data
+def createSource(path):
+    cnxn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    for statement in sourceTables:
+        cnxn.execute(statement)
+    cnxn.commit()
+    return cnxn
+
+# Opens the stand-in with a pyodbc-like interface
+def connect(path):
+    return SqliteSourceConnection(path)
+
+class SqliteSourceConnection(object):
+    """ Connection to the stand-in.  Safe to hand to another thread, as fdbPool does, as long as only one thread uses it at a time. """
+
+    def __init__(self, path):
+        self.cnxn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.cnxn.create_function("TRUNC", 2, truncDate)
+
+    def cursor(self):
+        return SqliteSourceCursor(self.cnxn.cursor())
+
+    def commit(self):
+        self.cnxn.commit()
+
+    def close(self):
+        self.cnxn.close()
+
+class SqliteSourceCursor(object):
+    """ Cursor over the stand-in.  Computed date columns (e.g. TRUNC or CASE over a date) come back from sqlite as text, so timestamp strings are turned back into datetimes the way pyodbc returns them. """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def execute(self, query, params=()):
+        self.cursor.execute(query, params)
+        return self
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return convertRow(row)
+
+    def fetchmany(self, size):
+        return [convertRow(row) for row in self.cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [convertRow(row) for row in self.cursor.fetchall()]
+
+    def close(self):
+        self.cursor.close()
+
+def convertRow(row):
+    return tuple([convertValue(value) for value in row])
+
+def convertValue(value):
+    if isinstance(value, basestring) and timestampPattern.match(value):
+        return parseTimestamp(value)
+    return value
@@ -0,0 +1,126 @@
+# Local state store for incremental (delta) extracts of the Net Suite transaction pulls.
+# For each pulled table it keeps a watermark (latest transactions.last_modified_date seen) and the USD amount each transaction contributed to each client/month key.
+# A delta pull only reads transactions modified since the watermark; their contributions replace whatever they contributed before, so edited transactions are not double counted.
+# Every transaction modified since the watermark has its contributions replaced, including those whose lines no longer match the pull (e.g. moved to another account), which are dropped.
+# Transactions deleted in Net Suite are not seen by a delta pull - they are dropped by reconciling the store against the transactions still there (keepTransactions), or by a full refresh.
+# Full reads can also be chunked: the transaction ids are split into ranges whose contributions are stored as each range is read, so a failed pull resumes from the unfinished ranges.
+
+import sqlite3
+import fdbPool
+
+stateStorePath = fdbPool.getSetting('Paths', 'state_store', "../settings/fdb_state.db")
+
+# Columns holding the contribution keys after the transaction id.  Payments use the first two of the default columns, billings all four.
+defaultKeyColumns = ["client_id", "month", "trans_type", "bill_freq_id"]
+tableKeyColumns = {
+    'revenue': ["client_id", "month", "item_id", "recurring"]
+}
+
+def keyColumns(tableName):
+    return tableKeyColumns.get(tableName, defaultKeyColumns)
+
+def openStateStore(path=None):
+    store = sqlite3.connect(path or stateStorePath, timeout=60, detect_types=sqlite3.PARSE_DECLTYPES)
+    store.execute("CREATE TABLE IF NOT EXISTS watermarks (table_name TEXT PRIMARY KEY, last_modified TIMESTAMP)")
+    store.execute("CREATE TABLE IF NOT EXISTS contributions (table_name TEXT NOT NULL, transaction_id INTEGER NOT NULL, client_id INTEGER, month DATE, trans_type INTEGER, bill_freq_id INTEGER, item_id INTEGER, recurring INTEGER, amount REAL)")
+    columns = [row[1] for row in store.execute("PRAGMA table_info(contributions)")]
+    for column in ["item_id", "recurring"]: # Stores created before the revenue pull was stored
+        if column not in columns:
+            store.execute("ALTER TABLE contributions ADD COLUMN " + column + " INTEGER")
+    store.execute("CREATE INDEX IF NOT EXISTS contributions_by_transaction ON contributions (table_name, transaction_id)")
+    store.execute("CREATE TABLE IF NOT EXISTS chunk_plans (table_name TEXT PRIMARY KEY, last_modified TIMESTAMP)")
+    store.execute("CREATE TABLE IF NOT EXISTS chunks (table_name TEXT NOT NULL, low_id INTEGER NOT NULL, high_id INTEGER NOT NULL, completed INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (table_name, low_id))")
+    store.commit()
+    return store
+
+# Returns the table's lastModified watermark, or None if it has never been pulled
+def getWatermark(store, tableName):
+    row = store.execute("SELECT last_modified FROM watermarks WHERE table_name = ?", (tableName,)).fetchone()
+    if row:
+        return row[0]
+    return None
+
+# Throws away everything stored for the table so the next pull starts from a full scan
+def resetTable(store, tableName):
+    store.execute("DELETE FROM contributions WHERE table_name = ?", (tableName,))
+    store.execute("DELETE FROM watermarks WHERE table_name = ?", (tableName,))
+    store.execute("DELETE FROM chunks WHERE table_name = ?", (tableName,))
+    store.execute("DELETE FROM chunk_plans WHERE table_name = ?", (tableName,))
+    store.commit()
+
+''' Merges freshly pulled contributions into the store and advances the watermark.
+contributions is dict {(transactionID, key...): amount}, the key laid out as keyColumns(tableName) (e.g. (transactionID, clientID, month[, transType, billFreqID]) for payments and billings).
+Every transaction in the dict, and every one in changedTransactionIDs (the transactions modified since the watermark, matching lines or not), has its previous contributions replaced. '''
+def mergeContributions(store, tableName, contributions, lastModified, changedTransactionIDs=()):
+    storeContributions(store, tableName, contributions, changedTransactionIDs)
+    oldLastModified = getWatermark(store, tableName)
+    if oldLastModified and (not lastModified or oldLastModified > lastModified):
+        lastModified = oldLastModified
+    store.execute("INSERT OR REPLACE INTO watermarks (table_name, last_modified) VALUES (?, ?)", (tableName, lastModified))
+    store.commit()
+
+# Replaces the stored contributions of every transaction in contributions or in replacedTransactionIDs (those left with no contributions are dropped), without committing
+def storeContributions(store, tableName, contributions, replacedTransactionIDs=()):
+    transactionIDs = set([key[0] for key in contributions]) | set(replacedTransactionIDs)
+    store.executemany("DELETE FROM contributions WHERE table_name = ? AND transaction_id = ?", [(tableName, transactionID) for transactionID in transactionIDs])
+    columns = ["transaction_id"] + keyColumns(tableName)
+    rows = []
+    for (key, amount) in contributions.iteritems():
+        paddedKey = tuple(key) + (None,)*(len(columns)-len(key))
+        rows.append((tableName,) + paddedKey + (float(amount),))
+    store.executemany("INSERT INTO contributions (table_name, " + ", ".join(columns) + ", amount) VALUES (?, " + ", ".join(["?"]*len(columns)) + ", ?)", rows)
+
+# Reconciles the table against Net Suite: drops the contributions of every transaction not in transactionIDs (the ids of the pull's transactions still in Net Suite), i.e. of deleted transactions.  Returns how many transactions were dropped.
+def keepTransactions(store, tableName, transactionIDs):
+    store.execute("CREATE TEMP TABLE IF NOT EXISTS kept_transactions (transaction_id INTEGER PRIMARY KEY)")
+    store.execute("DELETE FROM kept_transactions")
+    store.executemany("INSERT OR IGNORE INTO kept_transactions (transaction_id) VALUES (?)", [(transactionID,) for transactionID in transactionIDs])
+    dropped = store.execute("SELECT COUNT(DISTINCT transaction_id) FROM contributions WHERE table_name = ? AND transaction_id NOT IN (SELECT transaction_id FROM kept_transactions)", (tableName,)).fetchone()[0]
+    store.execute("DELETE FROM contributions WHERE table_name = ? AND transaction_id NOT IN (SELECT transaction_id FROM kept_transactions)", (tableName,))
+    store.execute("DELETE FROM kept_transactions")
+    store.commit()
+    return dropped
+
+''' Starts a chunked full read of the table: clears what is stored for it and splits transaction ids lowID..highID into [low, high] ranges of chunkSize ids.
+lastModified is read when the pull is planned and only becomes the watermark once every chunk is in, so changes made while the chunks are being read are picked up by the next delta pull. '''
+def planChunks(store, tableName, lowID, highID, lastModified, chunkSize):
+    resetTable(store, tableName)
+    chunks = []
+    if lowID is not None:
+        for low in range(lowID, highID+1, chunkSize):
+            chunks.append([low, min(low+chunkSize-1, highID)])
+    store.executemany("INSERT INTO chunks (table_name, low_id, high_id) VALUES (?, ?, ?)", [(tableName, low, high) for (low, high) in chunks])
+    store.execute("INSERT INTO chunk_plans (table_name, last_modified) VALUES (?, ?)", (tableName, lastModified))
+    store.commit()
+    return chunks
+
+# True while a chunked read of the table has been planned and not finished
+def hasChunkPlan(store, tableName):
+    return store.execute("SELECT COUNT(*) FROM chunk_plans WHERE table_name = ?", (tableName,)).fetchone()[0] > 0
+
+# Returns the [low, high] ranges of the table's chunked read that are still to be read, in id order
+def getUnfinishedChunks(store, tableName):
+    return [[row[0], row[1]] for row in store.execute("SELECT low_id, high_id FROM chunks WHERE table_name = ? AND completed = 0 ORDER BY low_id", (tableName,))]
+
+# Stores one chunk's contributions and marks the chunk read in the same transaction
+def completeChunk(store, tableName, chunk, contributions):
+    storeContributions(store, tableName, contributions)
+    store.execute("UPDATE chunks SET completed = 1 WHERE table_name = ? AND low_id = ?", (tableName, chunk[0]))
+    store.commit()
+
+# Ends a chunked read once every chunk is in: sets the watermark recorded when it was planned and drops the plan
+def finishChunks(store, tableName):
+    row = store.execute("SELECT last_modified FROM chunk_plans WHERE table_name = ?", (tableName,)).fetchone()
+    if row:
+        store.execute("INSERT OR REPLACE INTO watermarks (table_name, last_modified) VALUES (?, ?)", (tableName, row[0]))
+    store.execute("DELETE FROM chunks WHERE table_name = ?", (tableName,))
+    store.execute("DELETE FROM chunk_plans WHERE table_name = ?", (tableName,))
+    store.commit()
+
+# Returns the stored totals for the table as dict {(clientID, month[, transType, billFreqID]): amount} (keyed as keyColumns(tableName)).  keyLength picks how many key columns the table uses.
+def getTotals(store, tableName, keyLength):
+    columns = keyColumns(tableName)[0:keyLength]
+    totals = {}
+    for row in store.execute("SELECT " + ", ".join(columns) + ", SUM(amount) FROM contributions WHERE table_name = ? GROUP BY " + ", ".join(columns), (tableName,)):
+        totals[tuple(row[0:keyLength])] = row[keyLength]
+    return totals
@@ -0,0 +1,382 @@
+# Synthetic data generator for load testing the fdb pipeline.
+# Produces a referentially consistent, scalable data set:
+#   - a SQLite stand-in for Net Suite (see fdbSqliteSource) with customers and parent hierarchies, contracts with renewal/adjustment flags,
+#     multi-currency AR transactions with exchange rates, revenue postings, billing cycles and implementations
+#   - the flat files the pipeline reads: fact_revenue_input.csv, the legacy PowerReviews Bible.csv and Express.csv,
+#     a dated account family mapping file and a dated entity override file
+#   - an fdb.ini pointing the extract at all of the above (use it by setting FDB_SETTINGS to its path)
+# Size is controlled by the customer count and scale; skew makes a few customers carry most of the contracts and transactions, as in the real data.
+#
+# Usage: python fdbSynthetic.py <output folder> [--customers N] [--scale X] [--months N] [--skew S] [--seed N]
+
+import argparse
+import csv
+import os
+import random
+from datetime import date, datetime, timedelta
+import fdbSqliteSource
+from fdbMappings import productFamilyMap, countryRegionMap, accountIDRecurringMap
+from fdbUtils import nextMonth
+
+connectionsProducts = [81, 82, 83, 84, 85, 123, 355, 356, 357]
+verticalNames = ["Retail", "Media", "Travel & Leisure", "Manufacturing", "Financial Services", "Healthcare", "Technology"]
+billingCycles = [(1, "Monthly"), (2, "Quarterly"), (3, "Semi-Annual"), (4, "Annual")]
+billingCycleMonths = {1: 1, 2: 3, 3: 6, 4: 12}
+implementationPhases = [(1, "Kickoff"), (2, "In Progress"), (3, "Live"), (4, "Completed"), (5, "Cancelled"), (6, "Not Implemented - Retired")]
+# currency id: (symbol, subsidiary id, starting rate to USD, countries billed in it)
+currencies = {
+    1: ("USD", 1, 1.0, ["US", "MX", "BR", "CL"]),
+    2: ("GBP", 2, 1.6, ["GB", "IE", "JE"]),
+    3: ("EUR", 3, 1.35, ["DE", "FR", "NL", "ES", "IT", "BE", "FI"]),
+    4: ("CAD", 4, 0.98, ["CA"]),
+    5: ("AUD", 5, 1.02, ["AU", "NZ"])
+}
+arAccountID = 1
+revenueAccountIDs = sorted(accountIDRecurringMap.keys())
+
+class SyntheticSettings(object):
+    """ Size and shape of the generated data.  scale multiplies every count. """
+
+    def __init__(self, customers=500, scale=1.0, months=60, skew=1.1, seed=20130101, startMonth=date(2009, 1, 1),
+                 parentFraction=0.2, contractsPerCustomer=4, legacyClients=150, expressClients=200,
+                 unmappedFraction=0.05, nonRecurringFraction=0.1):
+        self.customers = int(customers*scale)
+        self.months = months
+        self.skew = skew
+        self.seed = seed
+        self.startMonth = startMonth
+        self.parentFraction = parentFraction
+        self.contractsPerCustomer = contractsPerCustomer
+        self.legacyClients = int(legacyClients*scale)
+        self.expressClients = int(expressClients*scale)
+        self.unmappedFraction = unmappedFraction
+        self.nonRecurringFraction = nonRecurringFraction
+
+def monthList(settings):
+    months = [settings.startMonth]
+    while len(months) < settings.months:
+        months.append(nextMonth(months[-1]))
+    return months
+
+# Zipf-like activity weights, normalized to a mean of 1, so a few customers dominate volume
+def activityWeights(count, skew, rng):
+    weights = [1.0/((rank+1)**skew) for rank in range(count)]
+    rng.shuffle(weights)
+    mean = sum(weights)/max(count, 1)
+    return [weight/mean for weight in weights]
+
+def poissonish(rng, mean):
+    # Small-mean count draw that keeps the long tail of the weights
+    whole = int(mean)
+    return whole + (1 if rng.random() < mean - whole else 0)
+
+''' Generates the whole data set into folder and returns the path of the fdb.ini written for it. '''
+def generate(folder, settings=None):
+    settings = settings or SyntheticSettings()
+    rng = random.Random(settings.seed)
+    months = monthList(settings)
+    for sub in ["input", "output", "accountFamilyMapping", "entityOverridesFolder", "legacy"]:
+        if not os.path.isdir(os.path.join(folder, sub)):
+            os.makedirs(os.path.join(folder, sub))
+
+    sourcePath = os.path.join(folder, "netsuite.db")
+    if os.path.exists(sourcePath):
+        os.remove(sourcePath)
+    cnxn = fdbSqliteSource.createSource(sourcePath)
+
+    writeReferenceTables(cnxn, months, rng)
+    customers = writeCustomers(cnxn, settings, months, rng)
+    revenueRows = writeContractsAndTransactions(cnxn, settings, customers, months, rng)
+    cnxn.commit()
+    cnxn.close()
+
+    writeRevenueInput(os.path.join(folder, "input", "fact_revenue_input.csv"), revenueRows)
+    legacyIDs = writeLegacyBible(os.path.join(folder, "legacy", "Bible.csv"), settings, months, rng)
+    expressIDs = writeExpressFile(os.path.join(folder, "legacy", "Express.csv"), settings, months, rng)
+    writeMappingFile(os.path.join(folder, "accountFamilyMapping"), settings, customers, legacyIDs, expressIDs, rng)
+    writeEntityOverrideFile(os.path.join(folder, "entityOverridesFolder"), customers, rng)
+    return writeSettings(folder, sourcePath)
+
+def writeReferenceTables(cnxn, months, rng):
+    cnxn.executemany("INSERT INTO Vertical VALUES (?, ?)", [(i+1, name) for (i, name) in enumerate(verticalNames)])
+    cnxn.executemany("INSERT INTO billing_cycle VALUES (?, ?)", billingCycles)
+    cnxn.executemany("INSERT INTO implementation_phase VALUES (?, ?)", implementationPhases)
+    cnxn.executemany("INSERT INTO Currencies VALUES (?, ?)", [(currencyID, currencies[currencyID][0]) for currencyID in currencies])
+    itemIDs = sorted(set([id for id in productFamilyMap if id > 0] + connectionsProducts))
+    cnxn.executemany("INSERT INTO Items VALUES (?, ?)", [(id, "Product " + str(id)) for id in itemIDs])
+    cnxn.executemany("INSERT INTO accounts VALUES (?, ?)", [(arAccountID, "Accounts Receivable")] + [(id, "Income") for id in revenueAccountIDs])
+    cnxn.executemany("INSERT INTO accounting_periods VALUES (?, ?)", [(i+1, datetime(month.year, month.month, 1)) for (i, month) in enumerate(months)])
+
+    # Business day rates relative to USD (base currency 1) for each foreign currency, as a random walk.  Weekends have no rate.
+    # A GBP based EUR cross rate is included as well, as Net Suite carries some non-USD base pairs.
+    rateRows = []
+    day = datetime(months[0].year, months[0].month, 1)
+    lastDay = datetime(nextMonth(months[-1]).year, nextMonth(months[-1]).month, 1)
+    levels = dict([(currencyID, currencies[currencyID][2]) for currencyID in currencies])
+    while day < lastDay:
+        if day.weekday() < 5:
+            for currencyID in currencies:
+                if currencyID == 1:
+                    continue
+                levels[currencyID] *= 1 + rng.gauss(0, 0.004)
+                rateRows.append((1, currencyID, day, round(levels[currencyID], 6)))
+            rateRows.append((2, 3, day, round(levels[3]/levels[2], 6)))
+        day += timedelta(1)
+    cnxn.executemany("INSERT INTO CurrencyRates VALUES (?, ?, ?, ?)", rateRows)
+
+def writeCustomers(cnxn, settings, months, rng):
+    weights = activityWeights(settings.customers, settings.skew, rng)
+    currencyByCountry = {}
+    for currencyID in currencies:
+        for country in currencies[currencyID][3]:
+            currencyByCountry[country] = currencyID
+    countries = sorted(countryRegionMap.keys())
+
+    customers = []
+    topLevel = []
+    for i in range(settings.customers):
+        customerID = 1000 + i
+        parentID = None
+        if topLevel and rng.random() < settings.parentFraction:
+            parentID = rng.choice(topLevel)["id"]
+        country = rng.choice(countries) if rng.random() < 0.3 else "US"
+        customer = {"id": customerID,
+                    "name": "Synthetic Client " + str(customerID),
+                    "country": country,
+                    "verticalID": rng.randint(1, len(verticalNames)),
+                    "parentID": parentID,
+                    "currencyID": currencyByCountry.get(country, 1),
+                    "weight": weights[i],
+                    "billingCycle": rng.choice(billingCycles)[0]}
+        if parentID is None:
+            topLevel.append(customer)
+        customers.append(customer)
+
+    modified = datetime(months[-1].year, months[-1].month, 1)
+    cnxn.executemany("INSERT INTO Customers VALUES (?, ?, ?, ?, ?, ?)",
+                     [(c["id"], c["name"], c["country"], c["verticalID"], c["parentID"], modified) for c in customers])
+    return customers
+
+''' Writes contracts, implementations and the AR/revenue transactions that follow from them.
+Returns the revenue rows (month, itemID, clientID, recurring, amount) that the revenue input file is built from. '''
+def writeContractsAndTransactions(cnxn, settings, customers, months, rng):
+    itemIDs = [id for id in productFamilyMap if id > 0]
+    monthIndex = dict([(month, i) for (i, month) in enumerate(months)])
+    contractID, transactionID = 1, 1
+    revenueRows = []
+    batch = {"Contract": [], "implementations": [], "transactions": [], "transaction_lines": []}
+
+    def flush():
+        cnxn.executemany("INSERT INTO Contract VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch["Contract"])
+        cnxn.executemany("INSERT INTO implementations VALUES (?, ?, ?, ?, ?, ?)", batch["implementations"])
+        cnxn.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?)", batch["transactions"])
+        cnxn.executemany("INSERT INTO transaction_lines VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch["transaction_lines"])
+        for rows in batch.values():
+            del rows[:]
+
+    for customer in customers:
+        # Contracts: a first booking, then upticks, downticks (live adjustments / debookings) and renewals
+        contractCount = max(1, poissonish(rng, settings.contractsPerCustomer*customer["weight"]))
+        firstMonth = rng.randrange(len(months))
+        msfByItemAndMonth = {}
+        for n in range(contractCount):
+            monthNumber = min(len(months)-1, firstMonth + (0 if n == 0 else rng.randrange(0, 24)))
+            effective = datetime(months[monthNumber].year, months[monthNumber].month, rng.randint(1, 28))
+            itemID = rng.choice(connectionsProducts) if rng.random() < 0.1 else rng.choice(itemIDs)
+            renewal = 'T' if n > 0 and rng.random() < 0.1 else rng.choice(['F', None])
+            liveAdjustment, debooking, msf = 'F', 'F', round(rng.uniform(500, 8000)*customer["weight"]**0.5, 2)
+            kind = rng.random()
+            if n > 0 and kind < 0.1:
+                liveAdjustment, msf = 'T', -round(msf/2, 2)
+            elif n > 0 and kind < 0.15:
+                debooking, msf = 'T', -round(msf/2, 2)
+            elif kind < 0.25:
+                liveAdjustment, debooking = None, None
+            if rng.random() < 0.02:
+                msf = 0
+            batch["Contract"].append((contractID, customer["id"], itemID, round(msf*rng.choice([0, 1, 2]), 2), msf, effective, renewal, liveAdjustment, debooking, effective))
+            if renewal != 'T' and msf:
+                key = (itemID, monthNumber)
+                msfByItemAndMonth[key] = msfByItemAndMonth.get(key, 0) + msf
+
+            # Implementation record for new business
+            if msf > 0 and rng.random() < 0.7:
+                projected = effective + timedelta(rng.randint(30, 120))
+                actual = projected + timedelta(rng.randint(-15, 60)) if rng.random() < 0.6 else None
+                if rng.random() < 0.05:
+                    projected, actual = None, None
+                batch["implementations"].append((customer["id"], projected, actual, rng.choice(implementationPhases)[0], msf, effective))
+            contractID += 1
+
+        # Recurring revenue: the cumulative MSF by item, recognized from a couple of months after booking (go live)
+        liveLag = rng.randint(0, 4)
+        running = {}
+        revenueByMonth = {}
+        for monthNumber in range(len(months)):
+            for (itemID, bookedMonth) in [key for key in msfByItemAndMonth if key[1] == monthNumber - liveLag]:
+                running[itemID] = running.get(itemID, 0) + msfByItemAndMonth[(itemID, bookedMonth)]
+            month = months[monthNumber]
+            rows = []
+            for itemID in running:
+                if running[itemID] > 0:
+                    rows.append((month, itemID, customer["id"], 1, round(running[itemID], 2)))
+            if running and rng.random() < settings.nonRecurringFraction:
+                rows.append((month, rng.choice(itemIDs), customer["id"], 0, round(rng.uniform(1000, 20000), 2)))
+            revenueByMonth[monthNumber] = rows
+            revenueRows.extend(rows)
+
+        # Transactions in the customer's currency: invoices on the billing cycle, payments a month later, occasional credit memos,
+        # and a monthly revenue journal posting to the revenue accounts
+        currencyID = customer["currencyID"]
+        subsidiaryID = currencies[currencyID][1]
+        cycle = billingCycleMonths[customer["billingCycle"]]
+        for monthNumber in range(len(months)):
+            month = months[monthNumber]
+            monthlyRevenue = revenueByMonth[monthNumber]
+            billed = sum([row[4] for row in monthlyRevenue if row[3] == 1])
+            period = monthNumber + 1
+
+            if billed and monthNumber % cycle == 0:
+                invoiceDate = datetime(month.year, month.month, rng.randint(1, 10))
+                for (kind, sign) in [("Invoice", 1), ("Credit Memo", -1)]:
+                    if kind == "Credit Memo" and rng.random() > 0.05:
+                        continue
+                    amount = sign*round(billed*cycle*(1 if sign > 0 else rng.uniform(0.05, 0.5)), 2)
+                    batch["transactions"].append((transactionID, invoiceDate, currencyID, kind, customer["billingCycle"], period, invoiceDate + timedelta(rng.randint(0, 40))))
+                    batch["transaction_lines"].append((transactionID, 1, amount, customer["id"], subsidiaryID, arAccountID, None, 'No'))
+                    transactionID += 1
+                    if kind == "Invoice":
+                        paid = invoiceDate + timedelta(rng.randint(15, 60))
+                        lines = 1 + (1 if rng.random() < 0.2 else 0)
+                        paidPeriod = monthIndex.get(date(paid.year, paid.month, 1), len(months) - 1) + 1
+                        batch["transactions"].append((transactionID, paid, currencyID, "Payment", None, paidPeriod, paid))
+                        for line in range(lines):
+                            batch["transaction_lines"].append((transactionID, line + 1, -round(amount/lines, 2), customer["id"], subsidiaryID, arAccountID, None, 'No'))
+                        transactionID += 1
+
+            if monthlyRevenue:
+                postDate = datetime(month.year, month.month, 28)
+                batch["transactions"].append((transactionID, postDate, currencyID, "Journal", None, period, postDate))
+                for (line, row) in enumerate(monthlyRevenue):
+                    accountID = rng.choice([id for id in revenueAccountIDs if accountIDRecurringMap[id] == bool(row[3])])
+                    batch["transaction_lines"].append((transactionID, line + 1, row[4], customer["id"], subsidiaryID, accountID, row[1], 'No'))
+                batch["transaction_lines"].append((transactionID, len(monthlyRevenue) + 1, 0, customer["id"], subsidiaryID, revenueAccountIDs[0], None, 'Yes'))
+                transactionID += 1
+
+        if len(batch["transaction_lines"]) > 50000:
+            flush()
+    flush()
+    return revenueRows
+
+def writeRevenueInput(filename, revenueRows):
+    outfile = open(filename, "wb")
+    writer = csv.writer(outfile, delimiter=",", quoting=csv.QUOTE_NONE)
+    writer.writerow(["Date", "Product", "Client", "Recurring", "Revenue"])
+    for (month, itemID, clientID, recurring, amount) in revenueRows:
+        writer.writerow([month.strftime("%Y%m%d"), itemID, clientID, recurring, amount])
+    outfile.close()
+
+# Legacy PowerReviews Bible: a billing (B) and revenue (R) row per client, with twelve month columns starting at column 26
+def writeLegacyBible(filename, settings, months, rng):
+    legacyMonths = months[-12:]
+    headers = ["Client", "Client ID", "B/R"] + ["Col" + str(i) for i in range(3, 26)] + [month.strftime("%Y%m") for month in legacyMonths]
+    headers[8] = "Pay Freq"
+    outfile = open(filename, "wb")
+    writer = csv.writer(outfile, delimiter=",", quoting=csv.QUOTE_NONE)
+    writer.writerow(headers)
+    legacyIDs = []
+    for i in range(settings.legacyClients):
+        sourceID = "SF" + str(10000 + i)
+        legacyIDs.append("PR" + sourceID[-5:])
+        monthly = rng.uniform(200, 5000)
+        for kind in ["B", "R"]:
+            row = ["PR Client " + str(i), sourceID, kind] + [""]*23
+            row[8] = rng.choice(["Monthly", "Quarterly", "Annual"])
+            for month in legacyMonths:
+                row.append("" if rng.random() < 0.1 else str(round(monthly*rng.uniform(0.9, 1.1), 2)))
+            writer.writerow(row)
+    outfile.close()
+    return legacyIDs
+
+# Legacy Express file: one row per client, with a 0/1 live flag for twelve months starting at column 102
+def writeExpressFile(filename, settings, months, rng):
+    legacyMonths = months[-12:]
+    headers = ["Client ID"] + ["Col" + str(i) for i in range(1, 102)] + [month.strftime("%Y%m") for month in legacyMonths]
+    headers[6] = "Client Name"
+    outfile = open(filename, "wb")
+    writer = csv.writer(outfile, delimiter=",", quoting=csv.QUOTE_NONE)
+    writer.writerow(headers)
+    expressIDs = []
+    for i in range(settings.expressClients):
+        clientID = "EX" + str(20000 + i)
+        expressIDs.append(clientID)
+        row = [clientID] + [""]*101
+        row[6] = "Express Client " + str(i)
+        start = rng.randrange(12)
+        row += [("1" if n >= start else "0") for n in range(12)]
+        writer.writerow(row)
+    outfile.close()
+    return expressIDs
+
+# Dated account family mapping file.  Children share their parent's AFID; a few clients are left out so new AFIDs get allocated.
+def writeMappingFile(folder, settings, customers, legacyIDs, expressIDs, rng):
+    filename = os.path.join(folder, date.today().strftime("%Y.%m.%d") + "_AF mapping file.csv")
+    outfile = open(filename, "wb")
+    writer = csv.writer(outfile, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(["NSID", "Child name", "Parent name", "AFID", "CIQ ID", "BU", "is_fortune500", "is_ir500", "CIQ Ult Parent", "Customer origination"])
+    byID = dict([(c["id"], c) for c in customers])
+    afidByTop = {}
+    for customer in customers:
+        if rng.random() < settings.unmappedFraction:
+            continue
+        top = byID[customer["parentID"]] if customer["parentID"] else customer
+        if top["id"] not in afidByTop:
+            afidByTop[top["id"]] = "AF-0" + str(len(afidByTop) + 1).zfill(7)
+        writer.writerow([customer["id"], customer["name"], top["name"], afidByTop[top["id"]], "CIQ" + str(top["id"]), "Enterprise",
+                         int(rng.random() < 0.05), int(rng.random() < 0.1), top["name"], rng.choice(["Organic sale", "PowerReviews acquisition"])])
+    for (n, clientID) in enumerate(legacyIDs + expressIDs):
+        if rng.random() < settings.unmappedFraction:
+            continue
+        writer.writerow([clientID, "Legacy " + clientID, "Legacy " + clientID, "AF-1" + str(n + 1).zfill(7), "TBD", "PowerReviews", 0, 0, "TBD", "PowerReviews acquisition"])
+    outfile.close()
+
+def writeEntityOverrideFile(folder, customers, rng):
+    filename = os.path.join(folder, date.today().strftime("%Y.%m.%d") + "_entity overrides.csv")
+    outfile = open(filename, "wb")
+    writer = csv.writer(outfile, delimiter=",", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(["clientID", "clientName", "entity", "note"])
+    for customer in rng.sample(customers, min(len(customers), max(1, len(customers)/50))):
+        writer.writerow([customer["id"], customer["name"], rng.choice(["CN", "BV"]), "Synthetic override"])
+    outfile.close()
+
+def writeSettings(folder, sourcePath):
+    filename = os.path.join(folder, "fdb.ini")
+    outfile = open(filename, "wb")
+    outfile.write("[Netsuite]\n")
+    outfile.write("sqlite_path = " + os.path.abspath(sourcePath) + "\n")
+    outfile.write("\n[Paths]\n")
+    outfile.write("output_folder = " + os.path.abspath(os.path.join(folder, "output")) + "\n")
+    outfile.write("revenue_input = " + os.path.abspath(os.path.join(folder, "input", "fact_revenue_input.csv")) + "\n")
+    outfile.write("legacy_folder = " + os.path.abspath(os.path.join(folder, "legacy")) + "\n")
+    outfile.write("account_family_mapping_folder = " + os.path.abspath(os.path.join(folder, "accountFamilyMapping")) + "\n")
+    outfile.write("entity_overrides_folder = " + os.path.abspath(os.path.join(folder, "entityOverridesFolder")) + "\n")
+    outfile.write("state_store = " + os.path.abspath(os.path.join(folder, "fdb_state.db")) + "\n")
+    outfile.write("mapping_store = " + os.path.abspath(os.path.join(folder, "fdb_mappings.db")) + "\n")
+    outfile.write("query_cache_folder = " + os.path.abspath(os.path.join(folder, "cache")) + "\n")
+    outfile.write("input_cache_folder = " + os.path.abspath(os.path.join(folder, "cache", "inputs")) + "\n")
+    outfile.write("query_log = " + os.path.abspath(os.path.join(folder, "logs", "netsuite_queries.log")) + "\n")
+    outfile.write("slow_query_list = " + os.path.abspath(os.path.join(folder, "logs", "netsuite_slow_queries.json")) + "\n")
+    outfile.close()
+    return filename
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Net Suite data set and flat file inputs for load testing.")
+    parser.add_argument("folder")
+    parser.add_argument("--customers", type=int, default=500)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--months", type=int, default=60)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--seed", type=int, default=20130101)
+    args = parser.parse_args()
+    settingsFile = generate(args.folder, SyntheticSettings(customers=args.customers, scale=args.scale, months=args.months, skew=args.skew, seed=args.seed))
+    print "Synthetic data written to " + args.folder + ".  Set FDB_SETTINGS=" + os.path.abspath(settingsFile) + " to run the extract against it."
@@ -0,0 +1,194 @@
+# Streaming reader for .xlsx workbooks, in plain Python (zipfile and ElementTree), so workbooks can be read without Excel - and so off Windows - and several at once.
+# A worksheet's XML is parsed incrementally and each row is dropped once it has been handed out, so reading the top of a large sheet does not load the rest of it.
+# Cell values come back as Excel's COM Range.Value gives them: numbers as floats, dates (cells with a date number format) as datetimes, text as unicode, booleans as bools and empty cells as None.
+
+import re
+import zipfile
+from datetime import datetime, timedelta
+from xml.etree import cElementTree
+
+builtInDateFormats = set(range(14, 23) + range(45, 48)) # Number format ids Excel has built in for dates and times
+dateFormatCodePattern = re.compile(r"[dmyhs]", re.IGNORECASE)
+formatLiteralPattern = re.compile(r'"[^"]*"|\[[^\]]*\]|\\.') # Quoted text, [colour]/[locale] sections and escaped characters, which are not date parts
+
+# Element name without its namespace, so both the transitional and the strict spreadsheet namespaces are read
+def localName(tag):
+    return tag.rsplit('}', 1)[-1]
+
+# Zero based column number of a cell reference such as "AB12"
+def columnNumber(reference):
+    number = 0
+    for character in reference:
+        if not character.isalpha():
+            break
+        number = number*26 + ord(character.upper()) - ord('A') + 1
+    return number - 1
+
+# True for a custom number format code that shows a date or time
+def isDateFormatCode(formatCode):
+    return dateFormatCodePattern.search(formatLiteralPattern.sub("", formatCode)) is not None
+
+# Date of an Excel date number.  In the 1900 date system Excel counts 29 February 1900, which never happened, so numbers before it are a day further from the base.
+def excelDate(number, date1904=False):
+    if date1904:
+        base = datetime(1904, 1, 1)
+    elif number < 61:
+        base = datetime(1899, 12, 31)
+    else:
+        base = datetime(1899, 12, 30)
+    days = int(number)
+    return base + timedelta(days=days, seconds=round((number - days)*86400))
+
+class XlsxWorkbook(object):
+    """ Read-only .xlsx workbook.  Worksheets are read a row at a time with iterRows, or as the block of cells around A1 with readTable. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.archive = zipfile.ZipFile(filename)
+        self.sheetPaths = self.readSheetPaths()
+        self.sharedStrings = self.readSharedStrings()
+        self.dateStyles = self.readDateStyles()
+
+    def close(self):
+        self.archive.close()
+
+    def sheetNames(self):
+        return [name for (name, path) in self.sheetPaths]
+
+    # [sheet name, path in the archive] for each worksheet, in workbook order
+    def readSheetPaths(self):
+        targets = {}
+        for element in cElementTree.fromstring(self.archive.read("xl/_rels/workbook.xml.rels")):
+            target = element.get("Target")
+            targets[element.get("Id")] = target.lstrip("/") if target.startswith("/") else "xl/" + target
+        workbook = cElementTree.fromstring(self.archive.read("xl/workbook.xml"))
+        self.date1904 = False
+        sheetPaths = []
+        for element in workbook.iter():
+            if localName(element.tag) == "workbookPr":
+                self.date1904 = element.get("date1904") in ("1", "true")
+            elif localName(element.tag) == "sheet":
+                relationshipID = [value for (key, value) in element.items() if localName(key) == "id" and key.startswith("{")][0]
+                sheetPaths.append([element.get("name"), targets[relationshipID]])
+        return sheetPaths
+
+    # The shared string table, read incrementally.  Rich text strings are the text of their runs joined; phonetic hints are left out.
+    def readSharedStrings(self):
+        strings = []
+        if "xl/sharedStrings.xml" not in self.archive.namelist():
+            return strings
+        infile = self.archive.open("xl/sharedStrings.xml")
+        try:
+            for (event, element) in cElementTree.iterparse(infile):
+                if localName(element.tag) == "si":
+                    strings.append(stringText(element))
+                    element.clear()
+        finally:
+            infile.close()
+        return strings
+
+    # Style numbers (the s attribute of a cell) whose number format is a date format
+    def readDateStyles(self):
+        dateStyles = set()
+        if "xl/styles.xml" not in self.archive.namelist():
+            return dateStyles
+        styles = cElementTree.fromstring(self.archive.read("xl/styles.xml"))
+        dateFormats = set(builtInDateFormats)
+        for element in styles.iter():
+            if localName(element.tag) == "numFmt" and isDateFormatCode(element.get("formatCode", "")):
+                dateFormats.add(int(element.get("numFmtId")))
+        for element in styles:
+            if localName(element.tag) == "cellXfs":
+                for (style, xf) in enumerate(element):
+                    if int(xf.get("numFmtId", 0)) in dateFormats:
+                        dateStyles.add(style)
+        return dateStyles
+
+    def sheetPath(self, sheetName):
+        for (name, path) in self.sheetPaths:
+            if name == sheetName:
+                return path
+        raise KeyError("The workbook " + self.filename + " has no worksheet " + sheetName)
+
+    ''' Yields the sheet's rows from row 1 down, each a list of cell values from column A to the row's last stored cell (None for empty cells).
+    Rows the sheet does not store (empty rows) are yielded as []. '''
+    def iterRows(self, sheetName):
+        infile = self.archive.open(self.sheetPath(sheetName))
+        try:
+            rowNumber = 0
+            for (event, element) in cElementTree.iterparse(infile):
+                if localName(element.tag) != "row":
+                    continue
+                number = int(element.get("r", rowNumber + 1))
+                while rowNumber + 1 < number:
+                    rowNumber += 1
+                    yield []
+                rowNumber = number
+                yield self.rowValues(element)
+                element.clear()
+        finally:
+            infile.close()
+
+    def rowValues(self, rowElement):
+        values = []
+        for cell in rowElement:
+            if localName(cell.tag) != "c":
+                continue
+            reference = cell.get("r")
+            column = columnNumber(reference) if reference else len(values)
+            while len(values) < column:
+                values.append(None)
+            values.append(self.cellValue(cell))
+        return values
+
+    def cellValue(self, cell):
+        cellType = cell.get("t", "n")
+        if cellType == "inlineStr":
+            for child in cell:
+                if localName(child.tag) == "is":
+                    return stringText(child)
+            return None
+        text = None
+        for child in cell:
+            if localName(child.tag) == "v":
+                text = child.text
+        if text is None:
+            return None
+        if cellType == "s":
+            return self.sharedStrings[int(text)]
+        if cellType in ("str", "e"):
+            return unicode(text)
+        if cellType == "b":
+            return text == "1"
+        number = float(text)
+        if int(cell.get("s", 0)) in self.dateStyles:
+            return excelDate(number, self.date1904)
+        return number
+
+    ''' Returns the block of cells from A1 as a tuple of row tuples, as Range(A1, last cell).Value does in Excel: columns up to the last filled cell of the run
+    from A1 along row 1 (or the first columns columns if given) and rows down to the last filled cell of the run from A1 down column A.
+    Only the rows of the block are read. '''
+    def readTable(self, sheetName, columns=None):
+        rows = []
+        for values in self.iterRows(sheetName):
+            if not values or values[0] is None:
+                break
+            if columns is None:
+                columns = 0
+                while columns < len(values) and values[columns] is not None:
+                    columns += 1
+            rows.append(tuple(values[0:columns] + [None]*(columns - len(values))))
+        return tuple(rows)
+
+# Text of a shared or inline string: its own text, or the text of its runs, leaving out phonetic hints
+def stringText(element):
+    parts = []
+    for child in element:
+        name = localName(child.tag)
+        if name == "t":
+            parts.append(child.text or u"")
+        elif name == "r":
+            for run in child:
+                if localName(run.tag) == "t":
+                    parts.append(run.text or u"")
+    return u"".join([unicode(part) for part in parts])
@@ -1,5 +1,22 @@
 import NetSuiteMod
+import fdbCache
+import fdbMappingStore
+import fdbPool
+import fdbQueryLog
+import os
 from collections import defaultdict
+from functools import partial
+
+# File locations.  The optional Paths section of fdb.ini overrides the usual Windows folders, e.g. to run against the local SQLite stand-in on another machine.
+outputFolder = fdbPool.getSetting('Paths', 'output_folder', 'c:/temp')
+revenueInputFile = fdbPool.getSetting('Paths', 'revenue_input', 'c:/temp/fact_revenue_input.csv')
+legacyFolder = fdbPool.getSetting('Paths', 'legacy_folder', 'C:/Projects/fdb/BV west legacy files')
+mappingFolder = fdbPool.getSetting('Paths', 'account_family_mapping_folder', NetSuiteMod.accountFamilyMappingFolder)
+entityOverridesFolder = fdbPool.getSetting('Paths', 'entity_overrides_folder', NetSuiteMod.entityOverridesFolder)
+
+# Cumulative bookings are written for every month (dense, fact_bookings.csv), only where they change (changes) or as valid from / valid to spans (spans)
+bookingsMode = fdbPool.getSetting('Output', 'bookings_mode', 'dense')
+assert bookingsMode in NetSuiteMod.cumulativeBookingsFiles
 
 # Determine legacy file settings
 pr_flag = 'y' # Always do PR legacy files for now
@@ -17,66 +34,107 @@ if cc_flag.lower() == 'y':
         except:
             print "The overrides file must be a *.XLSX format."
             raise
+
+# Determine payment, billing & revenue refresh settings.  Payment, billing and revenue pulls are incremental - only transactions changed since the last run are read - unless a full refresh is requested.
+# Full reads are chunked by transaction id; if one fails part way, the next run picks up from the unfinished chunks.
+fr_flag = raw_input("Would you like a full refresh of payment, billing and revenue transactions this time? y/n: ")
+assert fr_flag.lower()=='y' or fr_flag.lower()=='n'
+fullRefresh = fr_flag.lower()=='y'
+
+# Determine query cache settings.  Cached query results are reused only while a fingerprint of their source table (row count, max id, last modified) is unchanged.
+qc_flag = raw_input("Would you like to reuse cached NetSuite query results where the source data is unchanged? y/n: ")
+assert qc_flag.lower()=='y' or qc_flag.lower()=='n'
+fdbCache.cacheEnabled = qc_flag.lower()=='y'
     
 # Set up default dictionaries
 firstBookingsByClientTopName = defaultdict(lambda:None)
 firstBookingsByClientTopNameAndProductID = defaultdict(lambda:None)
 
-# Set up cursor to traverse NS tables
-cursor = NetSuiteMod.getNetsuiteCursor()
+# Set up connection pool to traverse NS tables
+pool = fdbPool.NetsuiteConnectionPool()
+
+# Account family mappings and entity overrides are kept in the mapping store; new dated files in their folders are imported into it
+mappingStore = fdbMappingStore.openMappingStore()
 
 # Pull id mapping translation table
-idMappingList = NetSuiteMod.getIDMappingFile()
+idMappingList = NetSuiteMod.getIDMappingFile(mappingFolder, mappingStore)
 idMappingDict = idMappingList[0]
 maxAFIDBV = idMappingList[1]
 maxAFIDPR = idMappingList[2]
 
 # Pull entity override file - temporary while they build out seperate revenue accounts in NetSuite
-entityOverrides = NetSuiteMod.getEntityOverrideFile()
-
-# Pull NS data into dictionaries
-verticalsByID = NetSuiteMod.getNetsuiteVerticalIndex(cursor)
-exchangeRatesByID = NetSuiteMod.getExchangeRateIndex(cursor)
-NScustomersByID = NetSuiteMod.getNetsuiteCustomerIndex(cursor, verticalsByID)
-itemsByID = NetSuiteMod.getNetsuiteItemsIndex(cursor)
-contractsByID = NetSuiteMod.getNetsuiteContractsIndex(cursor, NScustomersByID, itemsByID)
-monthlyDealCount = NetSuiteMod.getMontlyDealCount(contractsByID)
-currenciesByID = NetSuiteMod.getCurrencyIndex(cursor)
-paymentEntries = NetSuiteMod.getNetsuitePaymentEntries(cursor,exchangeRatesByID)
-NSrevenueEntries = NetSuiteMod.readRevenueInput("c:/temp/fact_revenue_input.csv")
-billFreqByID = NetSuiteMod.getNetsuiteBillingFreqEntries(cursor)
-billingEntries = NetSuiteMod.getNetsuiteBillingsEntries(cursor,exchangeRatesByID)
-impEntries, impEntriesNoDate = NetSuiteMod.getNetsuiteImplementationRecords(cursor)
-
-#revenueEntries = getNetsuiteRevenueEntries(cursor) - Method not working because inability to tie revenue through automated pull
+entityOverrides = NetSuiteMod.getEntityOverrideFile(entityOverridesFolder, mappingStore)
+
+# AR transaction lines are fetched and summed by column when the driver can fill NumPy column buffers itself; with row based drivers the row by row sums are about as quick
+columnarFetch = fdbPool.getDriver() == 'turbodbc'
+
+# Delta pulls drop the stored totals of transactions deleted in Net Suite by checking the store against the ids of the transactions still there.  Setting reconcile_deletions = no in the Netsuite section skips that read; a full refresh picks deletions up either way.
+reconcileDeletions = fdbPool.getSetting('Netsuite', 'reconcile_deletions', 'yes') != 'no'
+
+# Revenue is read from the revenue account posting lines.  Setting revenue_source = file in the Netsuite section of fdb.ini falls back to the hand exported revenue input file.
+revenueFromFile = fdbPool.getSetting('Netsuite', 'revenue_source', 'netsuite') == 'file'
+
+# Pull NS data into dictionaries.  Independent pulls run concurrently over the pool; each one waits only for the pulls listed as its dependencies.
+nsPulls = [
+    ('verticalsByID', NetSuiteMod.getNetsuiteVerticalIndex, []),
+    ('exchangeRatesByID', NetSuiteMod.getExchangeRateIndex, []),
+    ('NScustomersByID', NetSuiteMod.getNetsuiteCustomerIndex, ['verticalsByID']),
+    ('itemsByID', NetSuiteMod.getNetsuiteItemsIndex, []),
+    ('contractsByID', NetSuiteMod.getNetsuiteContractsIndex, ['NScustomersByID', 'itemsByID']),
+    ('currenciesByID', NetSuiteMod.getCurrencyIndex, []),
+    ('arEntries', partial(NetSuiteMod.getNetsuiteARTransactionEntries, incremental=True, fullRefresh=fullRefresh, serverAggregate=True, chunked=True, pool=pool, columnar=columnarFetch, reconcile=reconcileDeletions), ['exchangeRatesByID']),
+    ('billFreqByID', NetSuiteMod.getNetsuiteBillingFreqEntries, []),
+    ('impRecords', NetSuiteMod.getNetsuiteImplementationRecords, [])
+]
+if not revenueFromFile:
+    nsPulls.append(('revenueEntries', partial(NetSuiteMod.getNetsuiteRevenueEntries, incremental=True, fullRefresh=fullRefresh, chunked=True, pool=pool, reconcile=reconcileDeletions), []))
+nsData = fdbPool.runPulls(pool, nsPulls)
+pool.close()
+
+# Report where the pull time went (see fdbQueryLog for the per query log) and keep the slow query list up to date
+fdbQueryLog.printSummary()
+fdbQueryLog.saveSlowQueries()
+
+verticalsByID = nsData['verticalsByID']
+exchangeRatesByID = nsData['exchangeRatesByID']
+exchangeRatesByID.printLookupSummary()
+NScustomersByID = nsData['NScustomersByID']
+itemsByID = nsData['itemsByID']
+contractsByID = nsData['contractsByID']
+contractTimeline = NetSuiteMod.getContractTimeline(contractsByID) # Contracts sorted and grouped once, for all of the bookings computations
+monthlyDealCount = NetSuiteMod.getMontlyDealCount(contractTimeline)
+currenciesByID = nsData['currenciesByID']
+paymentEntries, billingEntries = nsData['arEntries']
+if revenueFromFile:
+    NSrevenueEntries = NetSuiteMod.readRevenueInput(revenueInputFile)
+else:
+    NSrevenueEntries = nsData['revenueEntries']
+billFreqByID = nsData['billFreqByID']
+impEntries, impEntriesNoDate = nsData['impRecords']
 
 # Prep legacy PowerReviews files
 if pr_flag.lower()=='y':
-    bibleObj = NetSuiteMod.readLegacyBible("C:/Projects/fdb/BV west legacy files/Bible.csv")
-    legacyRev = NetSuiteMod.getLegacyBibleRevenue(bibleObj)
-    legacyBill = NetSuiteMod.getLegacyBibleBilling(bibleObj)
-    legacyClient = NetSuiteMod.getLegacyBibleClients(bibleObj)
-    expressObj = NetSuiteMod.readExpressFile(r'C:\Projects\fdb\BV west legacy files\Express.csv')
-    expressClient = NetSuiteMod.getExpressClients(expressObj)
+    legacyRev, legacyBill, legacyClient, expressClient, expressRevenue = NetSuiteMod.readLegacyFiles(os.path.join(legacyFolder, 'Bible.csv'), os.path.join(legacyFolder, 'Express.csv'))
 else:
-    legacyRev,legacyBill,legacyClient,expressClient = [],[],[],[]
+    legacyRev,legacyBill,legacyClient,expressClient,expressRevenue = [],[],[],[],[]
     
 # Consolidate NetSuite and legacy
-customersByID = NetSuiteMod.combineCustomerIndicies(NScustomersByID, legacyClient, expressClient, idMappingDict, maxAFIDBV, maxAFIDPR)
+customersByID = NetSuiteMod.combineCustomerIndicies(NScustomersByID, legacyClient, expressClient, idMappingDict, maxAFIDBV, maxAFIDPR, mappingStore)
 revenueEntries = NetSuiteMod.combineRevenue(NSrevenueEntries, legacyRev)
 
 # Compute the first booking and go live dates
-NetSuiteMod.computeFirstBookings(contractsByID, firstBookingsByClientTopName, firstBookingsByClientTopNameAndProductID)
-goLiveDateByClientTopName = NetSuiteMod.computeClientGoLiveDates(revenueEntries, customersByID)
+NetSuiteMod.computeFirstBookings(contractTimeline, firstBookingsByClientTopName, firstBookingsByClientTopNameAndProductID)
+revenueSeriesIndex = NetSuiteMod.getRevenueSeriesIndex(revenueEntries, customersByID)
+goLiveDateByClientTopName = NetSuiteMod.computeClientGoLiveDates(revenueEntries, customersByID, revenueSeriesIndex)
 
 # Fix up the first booking and contract types 
 NetSuiteMod.fixupCustomerFirstBookingsAndCohorts(customersByID, firstBookingsByClientTopName, goLiveDateByClientTopName)
-NetSuiteMod.fixupContractTypes(contractsByID, firstBookingsByClientTopName)
+NetSuiteMod.fixupContractTypes(contractTimeline, firstBookingsByClientTopName)
 #fixupLinkedTransactionLineItems(transactionLinesByKey, transactionLinksByKey)
 
 # Prepare bookings data
-monthlyCumulativeBookings = NetSuiteMod.getMonthlyCumulativeASFEntries(contractsByID)
-monthlyIncrementalBookings = NetSuiteMod.getMonthlyIncrementalASFEntries(contractsByID)
+monthlyCumulativeBookings = NetSuiteMod.getMonthlyCumulativeASFEntries(contractTimeline, bookingsMode)
+monthlyIncrementalBookings = NetSuiteMod.getMonthlyIncrementalASFEntries(contractTimeline)
 
 # Identify BrandAnswers/Connections only clients
 connectionsOnlyIDs = NetSuiteMod.getConnectionsOnlyIDs(monthlyCumulativeBookings[1])
@@ -86,21 +144,25 @@ revenueEntries = NetSuiteMod.fixUpConnectionsRevenue(revenueEntries,connectionsO
 # Prepare current client flags
 if cc_flag.lower() =='y':
     clientOverrideList = NetSuiteMod.grabOverrides(overrideFilePath)
-    clientList = NetSuiteMod.identifyCurrentClientsThroughTime(revenueEntries, customersByID, clientOverrideList, expressObj)
-    NetSuiteMod.outputCurrentClientFactTable(clientList, r'c:/temp/fact_current_client.csv')
+    clientList = NetSuiteMod.identifyCurrentClientsThroughTime(revenueEntries, customersByID, clientOverrideList, expressRevenue)
+    NetSuiteMod.outputCurrentClientFactTable(clientList, os.path.join(outputFolder, 'fact_current_client.csv'))
 
 # Output updated bundling file
-NetSuiteMod.outputClientMappingFile(customersByID)
+NetSuiteMod.outputClientMappingFile(customersByID, mappingFolder, mappingStore)
+mappingStore.close()
 
 # Output fact & dim tables
-NetSuiteMod.outputCumulativeBookings(monthlyCumulativeBookings[0], "c:/temp/fact_bookings.csv")
-NetSuiteMod.outputIncrementalBookings(monthlyIncrementalBookings, "c:/temp/fact_incremental_bookings.csv")
-NetSuiteMod.outputRevenue(revenueEntries, "c:/temp/fact_revenue.csv")
-NetSuiteMod.outputCustomers(customersByID, "c:/temp/dim_client.csv")
-NetSuiteMod.outputProducts(itemsByID, "c:/temp/dim_product.csv")
-NetSuiteMod.outputPayment(paymentEntries, "c:/temp/fact_payment.csv")
-NetSuiteMod.outputBilling(billingEntries,"c:/temp/fact_billing.csv")
-NetSuiteMod.outputDealCount(monthlyDealCount,"c:/temp/fact_dealcount.csv")
-NetSuiteMod.outputImp(impEntries,"c:/temp/impEntries.csv")
-NetSuiteMod.outputImpMiDate(impEntriesNoDate,"c:/temp/noDateEntries.csv")
-NetSuiteMod.outputBillFreq(billFreqByID, "c:/temp/dim_billfreq.csv")
+if bookingsMode == 'spans':
+    NetSuiteMod.outputCumulativeBookingSpans(monthlyCumulativeBookings[0], os.path.join(outputFolder, NetSuiteMod.cumulativeBookingsFiles[bookingsMode]))
+else:
+    NetSuiteMod.outputCumulativeBookings(monthlyCumulativeBookings[0], os.path.join(outputFolder, NetSuiteMod.cumulativeBookingsFiles[bookingsMode]))
+NetSuiteMod.outputIncrementalBookings(monthlyIncrementalBookings, os.path.join(outputFolder, "fact_incremental_bookings.csv"))
+NetSuiteMod.outputRevenue(revenueEntries, os.path.join(outputFolder, "fact_revenue.csv"))
+NetSuiteMod.outputCustomers(customersByID, os.path.join(outputFolder, "dim_client.csv"))
+NetSuiteMod.outputProducts(itemsByID, os.path.join(outputFolder, "dim_product.csv"))
+NetSuiteMod.outputPayment(paymentEntries, os.path.join(outputFolder, "fact_payment.csv"))
+NetSuiteMod.outputBilling(billingEntries, os.path.join(outputFolder, "fact_billing.csv"))
+NetSuiteMod.outputDealCount(monthlyDealCount, os.path.join(outputFolder, "fact_dealcount.csv"))
+NetSuiteMod.outputImp(impEntries, os.path.join(outputFolder, "impEntries.csv"))
+NetSuiteMod.outputImpMiDate(impEntriesNoDate, os.path.join(outputFolder, "noDateEntries.csv"))
+NetSuiteMod.outputBillFreq(billFreqByID, os.path.join(outputFolder, "dim_billfreq.csv"))
@@ -1,4 +1,6 @@
+DROP VIEW fact_bookings_by_month;
 DROP TABLE fact_bookings;
+DROP TABLE fact_bookings_span;
 DROP TABLE fact_incremental_bookings;
 DROP TABLE fact_content;
 DROP TABLE fact_revenue;
@@ -120,6 +122,24 @@ ALTER TABLE fact_bookings
 ADD CONSTRAINT uc_fact_bookings1 UNIQUE (client_id, date_key, product_id);
 
 
+CREATE TABLE fact_bookings_span(
+	client_id VARCHAR(8) NOT NULL,		/* Client Dimension */
+	valid_from_key INTEGER NOT NULL,	/* Date Dimension: first month the ASF holds */
+	valid_to_key INTEGER NOT NULL,		/* Date Dimension: last month the ASF holds */
+	product_id INTEGER NOT NULL,		/* Product Dimension */
+	asf DECIMAL(12,2) NOT NULL		/* Cumulative ASF for Dimensions */
+);
+
+ALTER TABLE fact_bookings_span
+ADD CONSTRAINT uc_fact_bookings_span1 UNIQUE (client_id, valid_from_key, product_id);
+
+/* Cumulative bookings by month from the spans (bookings_mode = spans), as fact_bookings has them - but for every month of each span, not only the months with contracts */
+CREATE VIEW fact_bookings_by_month AS
+SELECT s.client_id, d.date_key, s.product_id, s.asf
+FROM fact_bookings_span s
+JOIN dim_date d ON d.date_key BETWEEN s.valid_from_key AND s.valid_to_key AND d.date_key = d.month_key*100 + 1;
+
+
 CREATE TABLE fact_incremental_bookings(
 	client_id VARCHAR(8) NOT NULL,		/* Client Dimension */
 	date_key INTEGER NOT NULL,		
@@ -215,6 +235,11 @@ CREATE INDEX id_index_bookings_date ON fact_bookings(date_key);
 CREATE INDEX id_index_bookings_client ON fact_bookings(client_id);
 CREATE INDEX id_index_bookings_product ON fact_bookings(product_id);
 
+CREATE INDEX id_index_bookings_span_from ON fact_bookings_span(valid_from_key);
+CREATE INDEX id_index_bookings_span_to ON fact_bookings_span(valid_to_key);
+CREATE INDEX id_index_bookings_span_client ON fact_bookings_span(client_id);
+CREATE INDEX id_index_bookings_span_product ON fact_bookings_span(product_id);
+
 CREATE INDEX id_index_bookings_date ON fact_incremental_bookings(date_key);
 CREATE INDEX id_index_bookings_client ON fact_incremental_bookings(client_id);
 CREATE INDEX id_index_bookings_product ON fact_incremental_bookings(product_id);